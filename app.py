@@ -1,37 +1,68 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from streamlit_mic_recorder import mic_recorder
 import altair as alt
 
 import datetime
 import re
 import pytz
-import io
 import json
+import logging
 import urllib.parse
 import hashlib
 import os
+import shutil
+import sqlite3
+import sys
 import tempfile
-
-from typing import Optional, Any
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Any
 from openai import OpenAI
 
+from ingest import mesi, parse_workbook, parse_workbooks
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: niente lock tra processi, la pubblicazione resta comunque atomica
+    fcntl = None
+
 # -------------------- COSTANTI --------------------
 timezone = pytz.timezone("Europe/Rome")
 
 DEFAULT_SPEC = ["MMG"]
 SPEC_EXTRA = ["ORT", "FIS", "REU", "DOL", "OTO", "DER", "INT", "END", "DIA"]
 
-mesi = [
-    "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno",
-    "luglio", "agosto", "settembre", "ottobre", "novembre", "dicembre"
-]
 month_order = {m: i + 1 for i, m in enumerate(mesi)}
 
 giorni_settimana = ["lunedì", "martedì", "mercoledì", "giovedì", "venerdì"]
+fasce_giornata = ["mattina", "pomeriggio"]
+DAY_SLOT_COLS = [f"{g} {suf}" for g in giorni_settimana for suf in fasce_giornata]
+
+SLOT_DAY_START_MIN = 7 * 60
+SLOT_DAY_END_MIN = 19 * 60
+SLOT_BUCKET_MIN = 15
+OCCUPANCY_BUCKETS = (SLOT_DAY_END_MIN - SLOT_DAY_START_MIN) // SLOT_BUCKET_MIN
+
+CACHE_DIR = os.getenv("MEDICI_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "medici_cache")
 
 TRANSCRIBE_MODEL = "gpt-4o-mini-transcribe"
 VOICE_PARSER_MODEL = "gpt-4o-mini"
+VOICE_WORKERS = int(os.getenv("MEDICI_VOICE_WORKERS", "4"))
+VOICE_QUEUE_MAX = int(os.getenv("MEDICI_VOICE_QUEUE_MAX", "32"))
+VOICE_SESSION_MAX = 1
+VOICE_QUEUE_WAIT_S = 60
+VOICE_JOB_TIMEOUT_S = 60
+VOICE_JOB_TTL_S = 300
+VOICE_POLL_S = 0.5
 
 st.set_page_config(page_title="Filtro Medici - Ricevimento Settimanale", layout="centered")
 
@@ -44,21 +75,339 @@ def _cache_data_decorator():
         return st.cache(allow_output_mutation=False)
 
 
-cache_data = _cache_data_decorator()
+def _cache_resource_decorator():
+    try:
+        return st.cache_resource(show_spinner=False)
+    except Exception:
+        return st.cache(allow_output_mutation=True)
+
+
+_st_cache_resource = _cache_resource_decorator()
+
+
+# ---------- METRICHE (CACHE, SESSIONI, RERUN) -----------------------------------
+# esportazione in formato Prometheus: file per il textfile collector di node_exporter
+# (MEDICI_METRICS_FILE) e/o endpoint HTTP locale (MEDICI_METRICS_PORT)
+METRICS_FILE = os.getenv("MEDICI_METRICS_FILE", "")
+METRICS_PORT = int(os.getenv("MEDICI_METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("MEDICI_METRICS_HOST", "127.0.0.1")
+METRICS_WRITE_INTERVAL_S = 15
+METRICS_SESSION_TTL_S = 3600
+METRICS_SESSION_KEY_MIN_BYTES = 64 * 1024
+
+
+@_st_cache_resource
+def get_metrics_registry() -> dict:
+    return {
+        "lock": threading.Lock(),
+        "reruns": 0,
+        "functions": {},
+        "sessions": {},
+        "sources": {},
+        "last_write": 0.0,
+    }
+
+
+def _object_nbytes(value, depth: int = 0) -> int:
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if depth < 3 and isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(_object_nbytes(v, depth + 1) for v in value)
+    if depth < 3 and isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_object_nbytes(v, depth + 1) for v in value.values())
+    return sys.getsizeof(value)
+
+
+def _counted_cache(decorator):
+    # conta chiamate, ricalcoli e voci della funzione in cache: le hit sono la differenza.
+    # Le cache sono senza max_entries né ttl, quindi una voce esce solo con clear(): quelle sono le evictions
+    def wrap(fn):
+        name = fn.__name__
+
+        def _stats(reg: dict) -> dict:
+            return reg["functions"].setdefault(
+                name, {"calls": 0, "misses": 0, "entries": 0, "evictions": 0, "max_entry_bytes": 0}
+            )
+
+        @wraps(fn)
+        def compute(*args, **kwargs):
+            value = fn(*args, **kwargs)
+            size = _object_nbytes(value)
+            reg = get_metrics_registry()
+            with reg["lock"]:
+                stats = _stats(reg)
+                stats["misses"] += 1
+                stats["entries"] += 1
+                stats["max_entry_bytes"] = max(stats["max_entry_bytes"], size)
+            return value
+
+        cached = decorator(compute)
+
+        @wraps(fn)
+        def call(*args, **kwargs):
+            reg = get_metrics_registry()
+            with reg["lock"]:
+                _stats(reg)["calls"] += 1
+            return cached(*args, **kwargs)
+
+        def clear():
+            cached.clear()
+            reg = get_metrics_registry()
+            with reg["lock"]:
+                stats = _stats(reg)
+                stats["evictions"] += stats["entries"]
+                stats["entries"] = 0
+
+        call.clear = clear
+        return call
+
+    return wrap
+
+
+cache_data = _counted_cache(_cache_data_decorator())
+cache_resource = _counted_cache(_st_cache_resource)
+
+
+def register_metrics_source(name: str, source: dict):
+    reg = get_metrics_registry()
+    with reg["lock"]:
+        reg["sources"][name] = source
+
+
+def _session_id() -> str:
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx is not None else "bare"
+    except Exception:
+        return "bare"
+
+
+def record_rerun():
+    sizes, other = {}, 0
+    for k in list(st.session_state.keys()):
+        try:
+            n = _object_nbytes(st.session_state[k])
+        except Exception:
+            continue
+        if n >= METRICS_SESSION_KEY_MIN_BYTES:
+            sizes[k] = n
+        else:
+            other += n
+    sizes["_altro"] = other
+
+    now = time.time()
+    reg = get_metrics_registry()
+    with reg["lock"]:
+        reg["reruns"] += 1
+        sess = reg["sessions"].setdefault(_session_id(), {"reruns": 0})
+        sess.update(reruns=sess["reruns"] + 1, bytes=sizes, last_seen=now)
+        for sid in [sid for sid, v in reg["sessions"].items() if now - v["last_seen"] > METRICS_SESSION_TTL_S]:
+            del reg["sessions"][sid]
+
+
+def _dataset_nbytes(entry: dict) -> int:
+    # il DataFrame non cambia dopo la preparazione: la misura profonda si fa una volta
+    if "_df_nbytes" not in entry:
+        entry["_df_nbytes"] = int(entry["df"].memory_usage(deep=True).sum())
+    arrays = sum(v.nbytes for v in entry.values() if isinstance(v, np.ndarray))
+    return entry["_df_nbytes"] + arrays
+
+
+def _prom_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    def esc(v) -> str:
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+
+def render_prometheus_metrics() -> str:
+    reg = get_metrics_registry()
+    with reg["lock"]:
+        reruns = reg["reruns"]
+        functions = {k: dict(v) for k, v in reg["functions"].items()}
+        sessions = {k: {"reruns": v["reruns"], "bytes": dict(v["bytes"])} for k, v in reg["sessions"].items()}
+        sources = dict(reg["sources"])
+
+    families = {
+        "medici_reruns_total": ("counter", "Rerun dello script da avvio processo.", [({}, reruns)]),
+        "medici_sessions_active": ("gauge", "Sessioni viste nell'ultima ora.", [({}, len(sessions))]),
+        "medici_session_reruns_total": ("counter", "Rerun per sessione.", []),
+        "medici_session_state_bytes": ("gauge", "Byte stimati in session_state per chiave.", []),
+        "medici_cache_hits_total": ("counter", "Letture servite dalla cache.", []),
+        "medici_cache_misses_total": ("counter", "Ricalcoli (cache miss).", []),
+        "medici_cache_evictions_total": (
+            "counter",
+            "Voci rimosse per limiti di memoria o numero; per le funzioni cache_data/cache_resource "
+            "(senza limiti) solo gli svuotamenti espliciti con clear().",
+            [],
+        ),
+        "medici_cache_entries": ("gauge", "Voci presenti in cache.", []),
+        "medici_cache_bytes": ("gauge", "Byte occupati dalla cache.", []),
+        "medici_cache_entry_max_bytes": ("gauge", "Byte della voce più grande calcolata.", []),
+    }
+
+    for sid, sess in sessions.items():
+        families["medici_session_reruns_total"][2].append(({"session": sid[:8]}, sess["reruns"]))
+        for key, n in sess["bytes"].items():
+            families["medici_session_state_bytes"][2].append(({"session": sid[:8], "key": key}, n))
+
+    for name, stats in functions.items():
+        families["medici_cache_hits_total"][2].append(({"cache": name}, stats["calls"] - stats["misses"]))
+        families["medici_cache_misses_total"][2].append(({"cache": name}, stats["misses"]))
+        families["medici_cache_evictions_total"][2].append(({"cache": name}, stats["evictions"]))
+        families["medici_cache_entries"][2].append(({"cache": name}, stats["entries"]))
+        families["medici_cache_entry_max_bytes"][2].append(({"cache": name}, stats["max_entry_bytes"]))
+
+    try:
+        from streamlit.runtime.caching import get_data_cache_stats_provider
+        for stats in get_data_cache_stats_provider().get_stats().values():
+            for stat in stats:
+                families["medici_cache_bytes"][2].append(({"cache": stat.cache_name.rsplit(".", 1)[-1]}, stat.byte_length))
+    except Exception:
+        pass
+
+    fc = sources.get("filter_results")
+    if fc is not None:
+        with fc["lock"]:
+            fc_stats = (fc["hits"], fc["misses"], fc["evictions"], len(fc["entries"]), fc["bytes"])
+        labels = {"cache": "filter_results"}
+        for fam, v in zip(
+            ["medici_cache_hits_total", "medici_cache_misses_total", "medici_cache_evictions_total",
+             "medici_cache_entries", "medici_cache_bytes"],
+            fc_stats,
+        ):
+            families[fam][2].append((labels, v))
+
+    blobs = sources.get("session_blobs")
+    if blobs is not None:
+        with blobs["lock"]:
+            blob_stats = (blobs["restores"], blobs["spills"], len(blobs["memory"]), blobs["bytes"])
+        labels = {"cache": "session_blobs"}
+        for fam, v in zip(
+            ["medici_cache_misses_total", "medici_cache_evictions_total", "medici_cache_entries", "medici_cache_bytes"],
+            blob_stats,
+        ):
+            families[fam][2].append((labels, v))
+
+    voice = sources.get("voice_jobs")
+    if voice is not None:
+        with voice["lock"]:
+            families["medici_voice_jobs_queued"] = (
+                "gauge", "Comandi vocali in attesa di un worker.", [({}, voice["queued"])]
+            )
+            families["medici_voice_jobs_total"] = ("counter", "Comandi vocali per esito.", [
+                ({"esito": "ok"}, voice["done"]),
+                ({"esito": "errore"}, voice["failed"]),
+                ({"esito": "rifiutato"}, voice["rejected"]),
+            ])
+            families["medici_voice_parse_coalesced_total"] = (
+                "counter", "Interpretazioni condivise con una richiesta identica in corso.", [({}, voice["coalesced"])]
+            )
+
+    registry = sources.get("datasets")
+    if registry is not None:
+        with registry["lock"]:
+            entries = list(registry["datasets"].values())
+        labels = {"cache": "datasets"}
+        families["medici_cache_entries"][2].append((labels, len(entries)))
+        families["medici_cache_bytes"][2].append((labels, sum(_dataset_nbytes(e) for e in entries)))
+
+    lines = []
+    for fam, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {fam} {help_text}")
+        lines.append(f"# TYPE {fam} {kind}")
+        for labels, value in samples:
+            lines.append(f"{fam}{_prom_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(force: bool = False):
+    if not METRICS_FILE:
+        return
+    reg = get_metrics_registry()
+    now = time.time()
+    with reg["lock"]:
+        if not force and now - reg["last_write"] < METRICS_WRITE_INTERVAL_S:
+            return
+        reg["last_write"] = now
+    try:
+        tmp_path = f"{METRICS_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(render_prometheus_metrics())
+        os.replace(tmp_path, METRICS_FILE)
+    except Exception:
+        pass
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@_st_cache_resource
+def start_metrics_server(host: str, port: int) -> Optional[ThreadingHTTPServer]:
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError:
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True, name="medici-metrics").start()
+    return server
+
+
+record_rerun()
+if METRICS_PORT:
+    start_metrics_server(METRICS_HOST, METRICS_PORT)
+write_metrics_file()
 
 
 # ---------- OPENAI --------------------------------------------------------------
+@cache_resource
+def _shared_openai_client(api_key: str, base_url: Optional[str]) -> OpenAI:
+    # un solo client per processo: il pool di connessioni è condiviso dai worker vocali
+    return OpenAI(api_key=api_key, base_url=base_url, timeout=VOICE_JOB_TIMEOUT_S, max_retries=1)
+
+
+def _secret_or_env(name: str) -> Optional[str]:
+    # senza secrets.toml st.secrets solleva: vale allora la variabile d'ambiente
+    try:
+        value = st.secrets.get(name)
+    except Exception:
+        value = None
+    return value or os.getenv(name) or None
+
+
 def get_openai_client() -> OpenAI:
-    api_key = st.secrets.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
+    api_key = _secret_or_env("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError(
             "Manca OPENAI_API_KEY. Inseriscila in .streamlit/secrets.toml oppure come variabile d'ambiente."
         )
-    return OpenAI(api_key=api_key)
+    # OPENAI_BASE_URL punta a un server compatibile (es. tools/fake_openai_server.py nei test)
+    return _shared_openai_client(api_key, _secret_or_env("OPENAI_BASE_URL"))
 
 
-def transcribe_voice_command_from_bytes(audio_bytes: bytes, suffix: str = ".webm") -> str:
-    client = get_openai_client()
+def transcribe_voice_command_from_bytes(
+    audio_bytes: bytes, suffix: str = ".webm", client: Optional[OpenAI] = None
+) -> str:
+    client = client or get_openai_client()
 
     with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
         tmp.write(audio_bytes)
@@ -109,8 +458,10 @@ def interpret_voice_command_to_filters(
     command_text: str,
     province_list: list[str],
     microarea_list: list[str],
+    microarea_gruppi_list: Optional[list[str]] = None,
+    client: Optional[OpenAI] = None,
 ) -> dict:
-    client = get_openai_client()
+    client = client or get_openai_client()
     now = datetime.datetime.now(timezone)
 
     developer_prompt = f"""
@@ -150,6 +501,7 @@ Regole:
 - Se dice "azzera tutto", "resetta", "reset", usa action="azzera_filtri".
 - Se l'utente cita una provincia inesistente, action="nessuna_azione".
 - Se cita una microarea inesistente, action="nessuna_azione".
+- Se cita un'intera famiglia di microaree (es. "microarea FM") o un codice con tutte le sue varianti, usa microarea_gruppi.
 - Se dice un intervallo tipo "dalle 9 alle 10", usa fascia_oraria="Personalizzato", custom_start="09:00", custom_end="10:00".
 - Se cita una città o testo libero non mappabile a un filtro strutturato, puoi usare search_query.
 - Compila solo i campi rilevanti; gli altri lasciali null.
@@ -189,6 +541,10 @@ Regole:
                             "type": ["array", "null"],
                             "items": {"type": "string", "enum": microarea_list},
                         },
+                        "microarea_gruppi": {
+                            "type": ["array", "null"],
+                            "items": {"type": "string", "enum": microarea_gruppi_list or []},
+                        },
                         "filtro_visto": {
                             "type": ["string", "null"],
                             "enum": ["Tutti", "Visto", "Non Visto", "Visita VIP", None],
@@ -223,6 +579,7 @@ Regole:
                         "custom_end",
                         "provincia_scelta",
                         "microarea_scelta",
+                        "microarea_gruppi",
                         "filtro_visto",
                         "filtro_target",
                         "filtro_spec",
@@ -258,6 +615,191 @@ Regole:
     return args
 
 
+# ---------- CODA COMANDI VOCALI -------------------------------------------------
+# un pool di worker per processo fa trascrizione e interpretazione fuori dal thread
+# della sessione: le sessioni in coda sono servite a turno, una richiesta per giro,
+# e trascrizioni identiche con lo stesso contesto condividono una sola chiamata al parser
+VOICE_STATE_LABELS = {
+    "trascrizione": "Trascrivo il comando...",
+    "interpretazione": "Interpreto il comando...",
+}
+
+
+@cache_resource
+def get_voice_queue() -> dict:
+    q = {
+        "lock": threading.Lock(),
+        "sessions": OrderedDict(),
+        "jobs": {},
+        "inflight": {},
+        "queued": 0,
+        "seq": 0,
+        "done": 0,
+        "failed": 0,
+        "rejected": 0,
+        "coalesced": 0,
+    }
+    q["cond"] = threading.Condition(q["lock"])
+    for i in range(VOICE_WORKERS):
+        threading.Thread(target=_voice_worker, args=(q,), daemon=True, name=f"medici-voice-{i}").start()
+    register_metrics_source("voice_jobs", q)
+    return q
+
+
+def _voice_context_key(context: dict) -> str:
+    raw = json.dumps(context, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _voice_parse_key(transcript: str, context_key: str) -> str:
+    # il prompt risolve "oggi"/"domani" sulla data corrente: la chiave vale per un giorno
+    norm = re.sub(r"\s+", " ", transcript.lower()).strip(" .,;:!?")
+    day = datetime.datetime.now(timezone).strftime("%Y-%m-%d")
+    return f"{context_key}:{day}:{norm}"
+
+
+def _prune_voice_jobs(q: dict, now: float):
+    for job_id in [
+        job_id for job_id, job in q["jobs"].items()
+        if job["event"].is_set() and now - job["finished"] > VOICE_JOB_TTL_S
+    ]:
+        del q["jobs"][job_id]
+
+
+def submit_voice_job(audio_bytes: bytes, suffix: str, context: dict, owner: str) -> str:
+    client = get_openai_client()
+    q = get_voice_queue()
+    now = time.time()
+    with q["cond"]:
+        _prune_voice_jobs(q, now)
+        active = sum(1 for j in q["jobs"].values() if j["owner"] == owner and not j["event"].is_set())
+        if active >= VOICE_SESSION_MAX:
+            q["rejected"] += 1
+            raise RuntimeError("c'è già un comando vocale in corso, attendi l'esito.")
+        if q["queued"] >= VOICE_QUEUE_MAX:
+            q["rejected"] += 1
+            raise RuntimeError("troppi comandi vocali in coda, riprova tra qualche secondo.")
+
+        q["seq"] += 1
+        job_id = f"{owner}-{q['seq']}"
+        q["jobs"][job_id] = {
+            "id": job_id,
+            "seq": q["seq"],
+            "owner": owner,
+            "audio": audio_bytes,
+            "suffix": suffix,
+            "context": context,
+            "context_key": _voice_context_key(context),
+            "client": client,
+            # in coda si aspetta al massimo VOICE_QUEUE_WAIT_S; il tempo di esecuzione parte dal worker
+            "queue_deadline": now + VOICE_QUEUE_WAIT_S,
+            "deadline": None,
+            "state": "in coda",
+            "event": threading.Event(),
+            "transcript": None,
+            "payload": None,
+            "error": None,
+            "finished": 0.0,
+        }
+        q["sessions"].setdefault(owner, deque()).append(q["jobs"][job_id])
+        q["queued"] += 1
+        q["cond"].notify()
+    return job_id
+
+
+def _voice_worker(q: dict):
+    while True:
+        with q["cond"]:
+            while not q["sessions"]:
+                q["cond"].wait()
+            owner, pending = next(iter(q["sessions"].items()))
+            job = pending.popleft()
+            if pending:
+                q["sessions"].move_to_end(owner)
+            else:
+                del q["sessions"][owner]
+            q["queued"] -= 1
+        _run_voice_job(q, job)
+
+
+def _finish_voice_job(q: dict, job: dict, payload: Optional[dict] = None, error: Optional[str] = None):
+    with q["lock"]:
+        job.update(state="errore" if error else "fatto", payload=payload, error=error, finished=time.time())
+        q["failed" if error else "done"] += 1
+    job["event"].set()
+
+
+def _finish_voice_job_from(q: dict, job: dict, fut: Future):
+    err = fut.exception()
+    if err is not None:
+        _finish_voice_job(q, job, error=str(err) or type(err).__name__)
+    else:
+        # copia per job: il payload condiviso non deve essere modificato da una sessione
+        _finish_voice_job(q, job, payload=json.loads(json.dumps(fut.result())))
+
+
+def _voice_job_client(job: dict) -> OpenAI:
+    # una sola scadenza per job: ogni chiamata ha come timeout il tempo che resta, senza retry
+    left = job["deadline"] - time.time()
+    if left <= 0:
+        raise TimeoutError("comando vocale scaduto, riprova.")
+    return job["client"].with_options(timeout=left, max_retries=0)
+
+
+def _run_voice_job(q: dict, job: dict):
+    try:
+        with q["lock"]:
+            now = time.time()
+            if now > job["queue_deadline"]:
+                raise TimeoutError("comando scaduto in coda, riprova.")
+            job.update(state="trascrizione", deadline=now + VOICE_JOB_TIMEOUT_S)
+            audio = job.pop("audio")
+        try:
+            transcript = transcribe_voice_command_from_bytes(audio, suffix=job["suffix"], client=_voice_job_client(job))
+        except Exception:
+            if time.time() >= job["deadline"]:
+                raise TimeoutError("comando vocale scaduto, riprova.")
+            raise
+
+        key = _voice_parse_key(transcript, job["context_key"])
+        with q["lock"]:
+            job["transcript"] = transcript
+            fut = q["inflight"].get(key)
+            owner = fut is None
+            if owner:
+                fut = q["inflight"][key] = Future()
+            else:
+                q["coalesced"] += 1
+            job["state"] = "interpretazione"
+
+        # chi si accoda a un'interpretazione in corso è partito dopo il suo proprietario:
+        # la scadenza di quello arriva prima della propria, quindi l'attesa è limitata
+        if owner:
+            try:
+                fut.set_result(
+                    interpret_voice_command_to_filters(transcript, **job["context"], client=_voice_job_client(job))
+                )
+            except Exception as e:
+                if time.time() >= job["deadline"]:
+                    e = TimeoutError("comando vocale scaduto, riprova.")
+                fut.set_exception(e)
+            finally:
+                with q["lock"]:
+                    q["inflight"].pop(key, None)
+        fut.add_done_callback(lambda f: _finish_voice_job_from(q, job, f))
+    except Exception as e:
+        _finish_voice_job(q, job, error=str(e) or type(e).__name__)
+
+
+def voice_job_label(q: dict, job: dict) -> str:
+    with q["lock"]:
+        state = job["state"]
+        if state == "in coda":
+            ahead = sum(1 for j in q["jobs"].values() if j["state"] == "in coda" and j["seq"] < job["seq"])
+            return f"In coda ({ahead} comandi prima del tuo)..." if ahead else "In coda..."
+    return VOICE_STATE_LABELS.get(state, "")
+
+
 # ---------- PERSISTENZA STATO IN URL --------------------------------------------
 def _get_query_param(key: str) -> Optional[str]:
     v = st.query_params.get(key, None)
@@ -521,17 +1063,325 @@ st.title("📋 Filtro Medici - Ricevimento Settimanale")
 
 
 # ---------- CARICAMENTO FILE ----------------------------------------------------
-file = st.file_uploader("Carica il file Excel", type=["xlsx"], key="file_uploader")
+WATCH_DIR = os.getenv("MEDICI_WATCH_DIR", "")
+WATCH_UPLOAD_OPTION = "📤 File caricato da questo dispositivo"
+
 
-if file is not None:
+def _usa_file_caricato():
+    if st.session_state.get("file_uploader"):
+        st.session_state["watch_file"] = WATCH_UPLOAD_OPTION
+
+
+files = st.file_uploader(
+    "Carica il file Excel (più file per unire i dati di più informatori)",
+    type=["xlsx"],
+    accept_multiple_files=True,
+    key="file_uploader",
+    on_change=_usa_file_caricato,
+)
+
+upload_sig = [(f.file_id, f.size) for f in files or []]
+# i byte passano in sessione (e quindi dall'hash del blob store) solo quando cambia il caricamento
+# o si torna al file caricato dalla cartella condivisa, non a ogni rerun
+torna_al_caricato = (
+    st.session_state.get("watch_file") == WATCH_UPLOAD_OPTION and st.session_state.get("watch_file_attivo")
+)
+if files and (st.session_state.get("uploaded_sig") != upload_sig or torna_al_caricato):
     try:
-        st.session_state["uploaded_file_bytes"] = file.getvalue()
+        if len(files) == 1:
+            st.session_state["uploaded_file_bytes"] = files[0].getvalue()
+            st.session_state.pop("uploaded_workbooks", None)
+        else:
+            st.session_state["uploaded_workbooks"] = [(f.name, f.getvalue()) for f in files]
+            st.session_state.pop("uploaded_file_bytes", None)
+        st.session_state["uploaded_sig"] = upload_sig
     except Exception:
         pass
+elif not files:
+    st.session_state.pop("uploaded_sig", None)
+
+
+# ---------- GOVERNO MEMORIA SESSIONI --------------------------------------------
+# i file caricati non restano in session_state: vanno in uno store condiviso per hash
+# (una copia sola anche se più sessioni caricano lo stesso file), scritto anche su disco.
+# In memoria restano i blob delle sessioni attive, entro un tetto globale con LRU;
+# quelli delle sessioni inattive si rileggono dal disco al rerun successivo
+SESSION_BLOB_DIR = os.path.join(CACHE_DIR, "blobs")
+SESSION_BLOB_MIN_BYTES = 256 * 1024
+SESSION_BLOB_CEILING_BYTES = int(os.getenv("MEDICI_SESSION_BLOB_MB", "512")) * 1024 * 1024
+SESSION_IDLE_SPILL_S = int(os.getenv("MEDICI_SESSION_IDLE_S", "900"))
+SESSION_FORGET_S = 24 * 3600
+SESSION_BLOB_DISK_TTL_S = 7 * 24 * 3600
+
+
+@cache_resource
+def get_blob_store() -> dict:
+    return {
+        "lock": threading.Lock(),
+        "memory": OrderedDict(),
+        "bytes": 0,
+        "sessions": {},
+        "spills": 0,
+        "restores": 0,
+        "last_prune": 0.0,
+    }
+
+
+def _blob_path(digest: str) -> str:
+    return os.path.join(SESSION_BLOB_DIR, f"{digest}.bin")
+
+
+def _is_blob(value) -> bool:
+    return isinstance(value, dict) and set(value) == {"blob", "size"}
+
+
+def blob_put(data: bytes) -> Optional[dict]:
+    digest = hashlib.md5(data).hexdigest()
+    path = _blob_path(digest)
+    try:
+        if not os.path.exists(path):
+            os.makedirs(SESSION_BLOB_DIR, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        else:
+            os.utime(path)
+    except OSError:
+        # senza copia su disco il blob non si può scaricare dalla memoria: resta in sessione
+        return None
+
+    store = get_blob_store()
+    with store["lock"]:
+        if digest not in store["memory"]:
+            store["memory"][digest] = data
+            store["bytes"] += len(data)
+        store["memory"].move_to_end(digest)
+    return {"blob": digest, "size": len(data)}
+
+
+def blob_get(handle: dict) -> bytes:
+    store = get_blob_store()
+    digest = handle["blob"]
+    with store["lock"]:
+        data = store["memory"].get(digest)
+        if data is not None:
+            store["memory"].move_to_end(digest)
+            return data
+
+    with open(_blob_path(digest), "rb") as f:
+        data = f.read()
+
+    with store["lock"]:
+        if digest not in store["memory"]:
+            store["memory"][digest] = data
+            store["bytes"] += len(data)
+            store["restores"] += 1
+        store["memory"].move_to_end(digest)
+    return data
+
+
+def _govern_value(value, refs: set):
+    if isinstance(value, (bytes, bytearray)) and len(value) >= SESSION_BLOB_MIN_BYTES:
+        handle = blob_put(bytes(value))
+        if handle is None:
+            return value
+        refs.add(handle["blob"])
+        return handle
+    if _is_blob(value):
+        refs.add(value["blob"])
+        return value
+    if isinstance(value, list) and value and all(isinstance(v, tuple) and len(v) == 2 for v in value):
+        return [(name, _govern_value(v, refs)) for name, v in value]
+    return value
+
+
+def _prune_blob_disk(now: float):
+    try:
+        for name in os.listdir(SESSION_BLOB_DIR):
+            path = os.path.join(SESSION_BLOB_DIR, name)
+            if now - os.path.getmtime(path) > SESSION_BLOB_DISK_TTL_S:
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def enforce_blob_ceiling(now: float):
+    store = get_blob_store()
+    with store["lock"]:
+        for sid in [sid for sid, v in store["sessions"].items() if now - v["last_seen"] > SESSION_FORGET_S]:
+            del store["sessions"][sid]
+        active = set()
+        for sess in store["sessions"].values():
+            if now - sess["last_seen"] <= SESSION_IDLE_SPILL_S:
+                active |= sess["blobs"]
+
+        for digest in [d for d in store["memory"] if d not in active]:
+            store["bytes"] -= len(store["memory"].pop(digest))
+            store["spills"] += 1
+        # oltre il tetto si scaricano anche i blob attivi usati meno di recente
+        while store["bytes"] > SESSION_BLOB_CEILING_BYTES and len(store["memory"]) > 1:
+            _, data = store["memory"].popitem(last=False)
+            store["bytes"] -= len(data)
+            store["spills"] += 1
+
+        prune = now - store["last_prune"] > 3600
+        if prune:
+            store["last_prune"] = now
+    if prune:
+        _prune_blob_disk(now)
+
+
+def govern_session_blobs():
+    refs = set()
+    for key in list(st.session_state.keys()):
+        if key == "file_uploader":
+            continue
+        try:
+            value = st.session_state[key]
+        except Exception:
+            continue
+        governed = _govern_value(value, refs)
+        if governed is not value:
+            st.session_state[key] = governed
+
+    store = get_blob_store()
+    now = time.time()
+    with store["lock"]:
+        store["sessions"][_session_id()] = {"last_seen": now, "blobs": refs}
+    enforce_blob_ceiling(now)
+
+
+register_metrics_source("session_blobs", get_blob_store())
+govern_session_blobs()
+
+
+# ---------- CARTELLA CONDIVISA (FILE SETTIMANALI) -------------------------------
+# con MEDICI_WATCH_DIR il server tiene d'occhio una cartella locale: i file nuovi si
+# preparano in background e si scelgono da qui, senza upload dal telefono
+WATCH_INTERVAL_S = int(os.getenv("MEDICI_WATCH_INTERVAL_S", "60"))
+WATCH_SETTLE_S = 10
+WATCH_PRELOAD_MAX = 3
+
+
+@cache_resource
+def get_watch_store() -> dict:
+    return {"lock": threading.Lock(), "files": {}, "scans": 0, "stop": threading.Event()}
+
+
+def list_watched_workbooks() -> list[dict]:
+    if not WATCH_DIR:
+        return []
+    now = time.time()
+    found = []
+    try:
+        with os.scandir(WATCH_DIR) as it:
+            for e in it:
+                if not e.is_file() or e.name.startswith((".", "~$")) or not e.name.lower().endswith(".xlsx"):
+                    continue
+                stat = e.stat()
+                # file modificato da poco: probabilmente ancora in copia
+                if now - stat.st_mtime < WATCH_SETTLE_S:
+                    continue
+                found.append({
+                    "name": e.name,
+                    "path": e.path,
+                    "sig": (stat.st_mtime_ns, stat.st_size),
+                    "mtime": stat.st_mtime,
+                })
+    except OSError:
+        return []
+    found.sort(key=lambda f: f["mtime"], reverse=True)
+    return found
+
+
+def _watch_update(f: dict, **fields) -> dict:
+    store = get_watch_store()
+    with store["lock"]:
+        info = store["files"].get(f["path"])
+        if info is None or info["sig"] != f["sig"]:
+            info = {"sig": f["sig"], "status": "in attesa", "error": None, "key": None, "value": None}
+            store["files"][f["path"]] = info
+        info.update(fields)
+        return dict(info)
+
+
+def watched_workbook_value(f: dict):
+    # handle del blob store (o i byte, se il disco non è scrivibile) da mettere in sessione
+    value = _watch_update(f)["value"]
+    if value is None:
+        with open(f["path"], "rb") as fh:
+            data = fh.read()
+        value = blob_put(data) or data
+        _watch_update(f, value=value)
+    return value
+
+
+watch_files = list_watched_workbooks()
+if watch_files:
+    watch_names = [f["name"] for f in watch_files]
+    watch_opts = watch_names + [WATCH_UPLOAD_OPTION]
+    if st.session_state.get("watch_file") not in watch_opts:
+        has_upload = st.session_state.get("uploaded_file_bytes") is not None or st.session_state.get("uploaded_workbooks")
+        st.session_state["watch_file"] = (
+            WATCH_UPLOAD_OPTION if has_upload and not st.session_state.get("watch_file_attivo") else watch_names[0]
+        )
+
+    watch_mtimes = {f["name"]: f["mtime"] for f in watch_files}
+    scelta_watch = st.selectbox(
+        "📂 File settimanale dal server",
+        watch_opts,
+        key="watch_file",
+        format_func=lambda n: n if n == WATCH_UPLOAD_OPTION else (
+            f"{n} · {datetime.datetime.fromtimestamp(watch_mtimes[n], timezone).strftime('%d/%m %H:%M')}"
+        ),
+    )
+
+    if scelta_watch == WATCH_UPLOAD_OPTION:
+        if st.session_state.pop("watch_file_attivo", None) and not files:
+            st.session_state.pop("uploaded_file_bytes", None)
+    else:
+        watch_f = watch_files[watch_names.index(scelta_watch)]
+        try:
+            st.session_state["uploaded_file_bytes"] = watched_workbook_value(watch_f)
+            st.session_state.pop("uploaded_workbooks", None)
+            st.session_state["watch_file_attivo"] = watch_f["path"]
+        except OSError as e:
+            st.warning(f"Impossibile leggere {scelta_watch}: {e}")
+
+        watch_info = _watch_update(watch_f)
+        if watch_info["status"] == "pronto":
+            st.caption("✅ Già preparato sul server: nessun caricamento necessario.")
+        elif watch_info["status"] == "in preparazione":
+            st.caption("⏳ Il server sta preparando questo file: ancora qualche secondo.")
+        elif watch_info["status"] == "errore":
+            st.warning(f"Il file {scelta_watch} non è leggibile: {watch_info['error']}")
+
+
+def current_workbooks() -> list[tuple[str, bytes]]:
+    workbooks = st.session_state.get("uploaded_workbooks")
+    file_bytes = st.session_state.get("uploaded_file_bytes", None)
+    try:
+        if workbooks:
+            return [(name, blob_get(v) if _is_blob(v) else v) for name, v in workbooks]
+        if _is_blob(file_bytes):
+            file_bytes = blob_get(file_bytes)
+    except OSError:
+        st.session_state.pop("uploaded_workbooks", None)
+        st.session_state.pop("uploaded_file_bytes", None)
+        st.warning("Il file caricato non è più disponibile sul server: caricalo di nuovo.")
+        return []
+    return [("file.xlsx", file_bytes)] if file_bytes is not None else []
+
 
-file_bytes = st.session_state.get("uploaded_file_bytes", None)
+def current_workbook_digests() -> list:
+    values = st.session_state.get("uploaded_workbooks") or [("file.xlsx", st.session_state.get("uploaded_file_bytes"))]
+    return [v["blob"] if _is_blob(v) else None for _, v in values]
 
-if file_bytes is None:
+
+workbooks = current_workbooks()
+
+if not workbooks:
     st.stop()
 
 
@@ -543,6 +1393,13 @@ def azzera_filtri():
         pass
 
     preserved_file = st.session_state.get("uploaded_file_bytes", None)
+    preserved_workbooks = st.session_state.get("uploaded_workbooks", None)
+    preserved_batch = st.session_state.get("filtri_in_blocco", False)
+    preserved_keys = {
+        k: st.session_state[k]
+        for k in ("watch_file", "watch_file_attivo", "uploaded_sig", "voice_owner", "voice_job_id")
+        if k in st.session_state
+    }
 
     today_local = datetime.datetime.now(timezone)
     default_cycle_idx_local = 1 + (today_local.month - 1) // 3
@@ -569,6 +1426,7 @@ def azzera_filtri():
         "custom_end": None,
         "provincia_scelta": "Ovunque",
         "microarea_scelta": [],
+        "microarea_gruppi": [],
         "search_query": "",
         "prov_escludi": [],
         "territorio_mode": "Microarea",
@@ -576,6 +1434,10 @@ def azzera_filtri():
         "territorio_top_n_provincia": 15,
         "territorio_min_tot_microarea": 1,
         "territorio_min_tot_provincia": 1,
+        "heatmap_mode": "Microarea",
+        "geo_citta": GEO_NESSUNA,
+        "geo_raggio_km": 0,
+        "geo_ordina": False,
     }
 
     for k in list(st.session_state.keys()):
@@ -586,6 +1448,11 @@ def azzera_filtri():
 
     if preserved_file is not None:
         st.session_state["uploaded_file_bytes"] = preserved_file
+    if preserved_workbooks is not None:
+        st.session_state["uploaded_workbooks"] = preserved_workbooks
+
+    st.session_state["filtri_in_blocco"] = preserved_batch
+    st.session_state.update(preserved_keys)
 
     for k, v in defaults.items():
         st.session_state[k] = v
@@ -614,124 +1481,136 @@ with col2:
 with col3:
     st.button("MMG 🩺", on_click=seleziona_mmg)
 
-
-# ---------- LETTURA EXCEL -------------------------------------------------------
-def _normalize_columns(cols) -> list[str]:
-    return [str(c).strip().lower() for c in cols]
-
-
-def _is_compatible_mmg_sheet(df: pd.DataFrame) -> bool:
-    cols = _normalize_columns(df.columns)
-    if "nome medico" not in cols:
-        return False
-    months_present = sum(1 for m in mesi if m in cols)
-    return months_present >= 6
+filtri_in_blocco = st.toggle(
+    "🧺 Applica i filtri in blocco",
+    key="filtri_in_blocco",
+    help="Le modifiche ai filtri restano in sospeso finché non premi «Applica filtri»: un solo ricalcolo per tutte.",
+)
 
 
+# ---------- LETTURA EXCEL -------------------------------------------------------
 @cache_data
 def load_excel(file_bytes: bytes):
-    bio = io.BytesIO(file_bytes)
+    return parse_workbook(file_bytes)
 
-    try:
-        xls = pd.ExcelFile(bio)
-    except Exception as e:
-        raise ValueError(f"Impossibile aprire il file Excel: {e}")
 
-    preferred_sheets = ["MMG", "MMG_Tabella 1"]
+def build_all_province(df: pd.DataFrame) -> list[str]:
+    vals = (
+        df.get("provincia", pd.Series([], dtype=str))
+        .dropna()
+        .astype(str)
+        .str.strip()
+    )
+    return ["Ovunque"] + sorted([x for x in vals.unique().tolist() if x and x.lower() != "nan"])
 
-    for sheet_name in preferred_sheets:
-        if sheet_name in xls.sheet_names:
-            try:
-                df = pd.read_excel(xls, sheet_name=sheet_name)
-                if _is_compatible_mmg_sheet(df):
-                    return df
-            except Exception:
-                pass
 
-    compatible_candidates = []
-    for sheet_name in xls.sheet_names:
-        try:
-            df = pd.read_excel(xls, sheet_name=sheet_name)
-            if _is_compatible_mmg_sheet(df):
-                compatible_candidates.append((sheet_name, df))
-        except Exception:
-            continue
+# ---------- TASSONOMIA MICROAREE ------------------------------------------------
+# codici tipo "FM02" con varianti "FM02 (Nord)": la tassonomia si calcola una volta per
+# dataset e il filtro per famiglia o codice padre diventa un lookup sui codici interi
+MICROAREA_FAMIGLIE = ["FM", "MC", "SBT", "AP", "MTPR", "TER"]
+_MICROAREA_PATTERN = r"^(?P<famiglia>[A-Z]+)(?P<numero>\d+)?\s*(?P<variante>\()?"
 
-    if len(compatible_candidates) == 1:
-        return compatible_candidates[0][1]
 
-    if len(compatible_candidates) > 1:
-        candidate_names = [name for name, _ in compatible_candidates]
-        raise ValueError(
-            "Trovati più fogli compatibili con la struttura MMG. "
-            f"Fogli compatibili: {candidate_names}."
-        )
+def dataset_lock(dataset: dict, name: str) -> threading.Lock:
+    # le cache pigre del dataset sono condivise da sessioni e thread in background: ognuna
+    # ha il suo lock (come sql_lock) e chi arriva secondo aspetta il primo invece di rifarla
+    return dataset.setdefault(f"{name}_lock", threading.Lock())
 
-    raise ValueError(
-        "Foglio MMG non trovato. "
-        f"Fogli disponibili: {xls.sheet_names}."
-    )
 
+def dataset_codes(dataset: dict, col: str) -> tuple[np.ndarray, pd.Index]:
+    codes_cache = dataset.setdefault("codes", {})
+    if col not in codes_cache:
+        with dataset_lock(dataset, "codes"):
+            if col not in codes_cache:
+                codes, uniques = pd.factorize(dataset["df"][col])
+                codes_cache[col] = (codes, pd.Index(uniques))
+    return codes_cache[col]
 
-try:
-    df_mmg = load_excel(file_bytes)
-except Exception as e:
-    st.error(f"Errore nel caricamento del file Excel: {e}")
-    st.stop()
 
-df_mmg.columns = df_mmg.columns.str.lower()
+def dataset_microarea_taxonomy(dataset: dict) -> dict:
+    tax = dataset.get("microarea_taxonomy")
+    if tax is None:
+        with dataset_lock(dataset, "microarea_taxonomy"):
+            tax = dataset.get("microarea_taxonomy")
+            if tax is None:
+                tax = dataset["microarea_taxonomy"] = _build_microarea_taxonomy(dataset)
+    return tax
 
-if "provincia" in df_mmg.columns:
-    df_mmg["provincia"] = df_mmg["provincia"].astype(str).str.strip()
-if "microarea" in df_mmg.columns:
-    df_mmg["microarea"] = df_mmg["microarea"].astype(str).str.strip()
 
+def _build_microarea_taxonomy(dataset: dict) -> dict:
+    if "microarea" in dataset["df"].columns:
+        codes, uniques = dataset_codes(dataset, "microarea")
+    else:
+        codes, uniques = np.full(len(dataset["df"]), -1), pd.Index([], dtype=object)
+    values = pd.Series(uniques.astype(str))
+    up = values.str.strip().str.upper()
+    valid = (up != "") & (up != "NAN")
+
+    parts = up.str.extract(_MICROAREA_PATTERN)
+    famiglia = parts["famiglia"]
+    padre = (famiglia + parts["numero"]).where(parts["numero"].notna())
+    padri_con_varianti = set(padre[valid & parts["variante"].notna() & padre.notna()])
+
+    priority = {f: i for i, f in enumerate(MICROAREA_FAMIGLIE)}
+
+    def sort_key(fam, label: str):
+        return (priority.get(fam, 999), label.casefold())
+
+    # il codice padre è nascosto se ha varianti: si sceglie tramite i gruppi
+    foglie = np.flatnonzero(valid & ~up.isin(padri_con_varianti))
+    foglie = sorted(foglie, key=lambda i: sort_key(famiglia[i], up[i]))
+
+    groups = OrderedDict()
+    famiglie = sorted(set(famiglia[valid].dropna()), key=lambda f: sort_key(f, f))
+    for fam in famiglie:
+        groups[fam] = np.flatnonzero(valid & (famiglia == fam))
+    for code in sorted(padri_con_varianti, key=lambda c: sort_key(re.split(r"[^A-Z]", c)[0], c)):
+        groups[code] = np.flatnonzero(valid & (padre == code))
+
+    return {
+        "codes": codes,
+        "index": uniques,
+        "values": values.tolist(),
+        "options": [values[i] for i in foglie],
+        "families": famiglie,
+        "groups": groups,
+    }
 
-def build_all_province(df: pd.DataFrame) -> list[str]:
-    vals = (
-        df.get("provincia", pd.Series([], dtype=str))
-        .dropna()
-        .astype(str)
-        .str.strip()
-    )
-    return ["Ovunque"] + sorted([x for x in vals.unique().tolist() if x and x.lower() != "nan"])
 
+def microarea_lut(tax: dict, scelte, gruppi) -> np.ndarray:
+    # un posto in più in fondo, sempre False, per le righe senza microarea (codice -1)
+    lut = np.zeros(len(tax["values"]) + 1, dtype=bool)
+    idx = tax["index"].get_indexer(list(scelte)) if len(scelte) else np.array([], dtype=int)
+    lut[idx[idx >= 0]] = True
+    for g in gruppi:
+        if g in tax["groups"]:
+            lut[tax["groups"][g]] = True
+    return lut
 
-def build_all_microaree(df: pd.DataFrame) -> list[str]:
-    vals = (
-        df.get("microarea", pd.Series([], dtype=str))
-        .dropna()
-        .astype(str)
-        .str.strip()
-    )
-    raw_list = [x for x in vals.unique().tolist() if x and x.lower() != "nan"]
-
-    parent_codes_with_variant = set()
-    for x in raw_list:
-        up = x.strip().upper()
-        m = re.match(r"^([A-Z]{2}\d{2})\s*\(", up)
-        if m:
-            parent_codes_with_variant.add(m.group(1))
-
-    filtered = []
-    for x in raw_list:
-        if x.strip().upper() in parent_codes_with_variant:
-            continue
-        filtered.append(x)
 
-    priority = {"FM": 0, "MC": 1, "SBT": 2, "AP": 3, "MTPR": 4, "TER": 5}
+def microarea_mask(dataset: dict, scelte, gruppi) -> np.ndarray:
+    tax = dataset_microarea_taxonomy(dataset)
+    return microarea_lut(tax, scelte, gruppi)[tax["codes"]]
 
-    def micro_sort_key(s: str):
-        up = s.strip().upper()
-        code = re.split(r"[^A-Z]", up)[0]
-        grp = priority.get(code, 999)
-        return (grp, up.casefold())
 
-    return sorted(filtered, key=micro_sort_key)
+def microarea_values(dataset: dict, scelte, gruppi) -> list[str]:
+    tax = dataset_microarea_taxonomy(dataset)
+    lut = microarea_lut(tax, scelte, gruppi)
+    return [v for v, on in zip(tax["values"], lut[:-1]) if on]
 
 
-all_province = build_all_province(df_mmg)
-all_microaree = build_all_microaree(df_mmg)
+def microarea_group_counts(tax: dict, value_idx: np.ndarray, phys_ids: np.ndarray) -> dict:
+    # medici distinti per gruppo, a partire dalle coppie (valore, medico)
+    counts = {}
+    for token, idx in tax["groups"].items():
+        lut = np.zeros(len(tax["values"]) + 1, dtype=bool)
+        lut[idx] = True
+        counts[token] = int(np.unique(phys_ids[lut[value_idx]]).size)
+    return counts
+
+
+def microarea_group_label(tax: dict, token: str) -> str:
+    return f"Famiglia {token}" if token in tax["families"] else f"{token} + varianti"
 
 
 # ---------- FUNZIONI UTILI ------------------------------------------------------
@@ -745,748 +1624,3606 @@ def _parse_time_flexible(s: str) -> Optional[datetime.time]:
         return None
 
 
-def parse_interval(cell_value):
+def parse_intervals(cell_value) -> list[tuple[datetime.time, datetime.time]]:
     if pd.isna(cell_value):
-        return None, None
-    s = str(cell_value).strip()
-    m = re.match(r"(\d{1,2}(?::\d{2})?)\s*[-–]\s*(\d{1,2}(?::\d{2})?)", s)
-    if not m:
-        return None, None
-    start_str, end_str = m.groups()
-    start_t = _parse_time_flexible(start_str)
-    end_t = _parse_time_flexible(end_str)
-    if start_t is None or end_t is None:
-        return None, None
-    return start_t, end_t
+        return []
+    out = []
+    for start_str, end_str in re.findall(r"(\d{1,2}(?::\d{2})?)\s*[-–]\s*(\d{1,2}(?::\d{2})?)", str(cell_value)):
+        start_t = _parse_time_flexible(start_str)
+        end_t = _parse_time_flexible(end_str)
+        if start_t is not None and end_t is not None:
+            out.append((start_t, end_t))
+    return out
+
+
+def parse_interval(cell_value):
+    intervals = parse_intervals(cell_value)
+    return intervals[0] if intervals else (None, None)
 
 
 def interval_covers(cell_value, custom_start, custom_end):
-    start_t, end_t = parse_interval(cell_value)
-    if start_t is None or end_t is None:
-        return False
-    return start_t <= custom_start and end_t >= custom_end
+    return any(s <= custom_start and e >= custom_end for s, e in parse_intervals(cell_value))
 
 
-def build_territory_coverage(df_source: pd.DataFrame, group_col: str, cycle_cols: list[str]) -> pd.DataFrame:
-    if group_col not in df_source.columns:
-        return pd.DataFrame()
+# tutte le finestre di ogni cella ("9-11 / 15:30-17" sono due intervalli)
+_INTERVAL_PATTERN = r"(\d{1,2})(?::(\d{2}))?\s*[-–]\s*(\d{1,2})(?::(\d{2}))?"
+INTERVAL_ARRAYS = ["iv_row", "iv_slot", "iv_start", "iv_end"]
 
-    work = df_source.copy()
 
-    work["_nome_norm"] = work.get("nome medico", pd.Series("", index=work.index)).astype(str).str.strip().str.lower()
-    work["_territorio"] = work.get(group_col, pd.Series("", index=work.index)).astype(str).str.strip()
+def _interval_table(row, slot, start, end) -> dict:
+    order = np.lexsort((start, slot, row))
+    return {
+        "iv_row": np.asarray(row)[order].astype(np.int32),
+        "iv_slot": np.asarray(slot)[order].astype(np.int8),
+        "iv_start": np.asarray(start)[order].astype(np.int16),
+        "iv_end": np.asarray(end)[order].astype(np.int16),
+    }
 
-    work = work[
-        work["_nome_norm"].ne("") &
-        work["_territorio"].ne("") &
-        work["_territorio"].str.lower().ne("nan")
-    ].copy()
 
-    is_mmg = work.get("spec", pd.Series("", index=work.index)).astype(str).str.strip().str.upper() == "MMG"
-    is_in_target = work.get("in target", pd.Series("", index=work.index)).astype(str).str.strip().str.lower() == "x"
-    work = work[is_mmg & is_in_target].copy()
+def _gather_groups(sorted_keys: np.ndarray, wanted: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # posizioni degli elementi con chiave in wanted (chiavi ordinate) e quanti per chiave
+    lo = np.searchsorted(sorted_keys, wanted, side="left")
+    cnt = np.searchsorted(sorted_keys, wanted, side="right") - lo
+    return np.repeat(lo - np.cumsum(cnt) + cnt, cnt) + np.arange(cnt.sum()), cnt
+
+
+def extract_slot_intervals(df: pd.DataFrame) -> dict:
+    # tabella piatta: una riga per intervallo con riga del dataset, slot (indice in
+    # DAY_SLOT_COLS, giorno = slot // 2), inizio e fine in minuti
+    cols = [(j, c) for j, c in enumerate(DAY_SLOT_COLS) if c in df.columns]
+    n_rows = len(df)
+    if not cols or not n_rows:
+        return _interval_table([], [], [], [])
+
+    cells = pd.concat([df[c] for _, c in cols], ignore_index=True)
+    cells = cells[cells.notna()].astype(str)
+    # gli orari si ripetono molto: un solo extractall sui testi distinti, poi si espande
+    codes, uniques = pd.factorize(cells)
+    parts = pd.Series(uniques, dtype=object).str.extractall(_INTERVAL_PATTERN)
+    if parts.empty:
+        return _interval_table([], [], [], [])
+    parts = parts.apply(pd.to_numeric, errors="coerce")
+
+    h1, m1 = parts[0].to_numpy(dtype=float), parts[1].fillna(0).to_numpy(dtype=float)
+    h2, m2 = parts[2].to_numpy(dtype=float), parts[3].fillna(0).to_numpy(dtype=float)
+    valid = (h1 <= 23) & (h2 <= 23) & (m1 <= 59) & (m2 <= 59)
+
+    take, cnt = _gather_groups(parts.index.get_level_values(0).to_numpy()[valid], codes)
+    cell = np.repeat(cells.index.to_numpy(), cnt)
+    slots = np.array([j for j, _ in cols])
+    return _interval_table(
+        cell % n_rows,
+        slots[cell // n_rows],
+        (h1 * 60 + m1)[valid][take],
+        (h2 * 60 + m2)[valid][take],
+    )
 
-    valid_cycle_cols = [c for c in cycle_cols if c in work.columns]
 
-    if valid_cycle_cols:
-        work["_seen"] = work[valid_cycle_cols].apply(
-            lambda r: any(str(v).strip().lower() in ["x", "v"] for v in r.values),
-            axis=1
-        )
-    else:
-        work["_seen"] = False
+def slot_envelopes(intervals: dict, n_rows: int) -> tuple[np.ndarray, np.ndarray]:
+    # per cella: inizio del primo intervallo e fine dell'ultimo (ordinamento e visualizzazione)
+    slot_start = np.full((n_rows, len(DAY_SLOT_COLS)), np.inf)
+    slot_end = np.full((n_rows, len(DAY_SLOT_COLS)), -np.inf)
+    cell = (intervals["iv_row"], intervals["iv_slot"])
+    np.minimum.at(slot_start, cell, intervals["iv_start"])
+    np.maximum.at(slot_end, cell, intervals["iv_end"])
+    slot_start[np.isinf(slot_start)] = np.nan
+    slot_end[np.isinf(slot_end)] = np.nan
+    return slot_start, slot_end
 
-    dedup = (
-        work.groupby(["_territorio", "_nome_norm"], as_index=False)["_seen"]
-        .max()
-        .copy()
-    )
 
-    summary = (
-        dedup.groupby("_territorio", as_index=False)
-        .agg(
-            medici_totali=("_nome_norm", "nunique"),
-            medici_visti=("_seen", "sum"),
-        )
-        .copy()
+def rows_covering(dataset: dict, slot_idx: list[int], start_min: float, end_min: float) -> np.ndarray:
+    sel = (
+        np.isin(dataset["iv_slot"], slot_idx)
+        & (dataset["iv_start"] <= start_min)
+        & (dataset["iv_end"] >= end_min)
     )
+    covers = np.zeros(len(dataset["df"]), dtype=bool)
+    covers[dataset["iv_row"][sel]] = True
+    return covers
 
-    summary["medici_visti"] = summary["medici_visti"].astype(int)
-    summary["medici_totali"] = summary["medici_totali"].astype(int)
-    summary["medici_non_visti"] = summary["medici_totali"] - summary["medici_visti"]
-    summary["copertura_pct"] = (
-        (summary["medici_visti"] / summary["medici_totali"]) * 100
-    ).round(1)
 
-    summary = summary.rename(columns={"_territorio": group_col})
-    summary = summary.sort_values(
-        by=["copertura_pct", "medici_visti", "medici_totali", group_col],
-        ascending=[False, False, False, True]
-    ).reset_index(drop=True)
+def _fmt_minutes(m: float) -> str:
+    if m is None or not np.isfinite(m):
+        return ""
+    m = int(round(m))
+    return f"{m // 60:02d}:{m % 60:02d}"
 
-    return summary
 
+def slot_bucket_labels() -> list[str]:
+    return [
+        f"{m // 60:02d}:{m % 60:02d}"
+        for m in range(SLOT_DAY_START_MIN, SLOT_DAY_END_MIN, SLOT_BUCKET_MIN)
+    ]
 
-# ---------- CALCOLO ULTIMA VISITA ----------------------------------------------
-def get_ultima_visita(row):
-    ultima = ""
-    for m in mesi:
-        val = str(row.get(m, "")).strip().lower()
-        if val in ["x", "v"]:
-            ultima = m.capitalize()
-    return ultima
 
+def build_occupancy_matrix(intervals: dict, n_rows: int) -> np.ndarray:
+    # medici x giorni, un bit per quarto d'ora (uint64): 1 se un intervallo copre l'intero quarto d'ora
+    n_buckets = OCCUPANCY_BUCKETS
+    occupancy = np.zeros((n_rows, len(giorni_settimana)), dtype=np.uint64)
 
-for m in mesi:
-    if m in df_mmg.columns:
-        df_mmg[m] = df_mmg[m].fillna("").astype(str).str.strip().str.lower()
+    start_min = intervals["iv_start"].astype(float)
+    end_min = intervals["iv_end"].astype(float)
+    b_start = np.clip(np.ceil((start_min - SLOT_DAY_START_MIN) / SLOT_BUCKET_MIN), 0, n_buckets).astype(np.uint64)
+    b_end = np.clip(np.floor((end_min - SLOT_DAY_START_MIN) / SLOT_BUCKET_MIN), 0, n_buckets).astype(np.uint64)
+    keep = (end_min > start_min) & (b_end > b_start)
 
-df_mmg["ultima visita"] = df_mmg.apply(get_ultima_visita, axis=1)
+    one = np.uint64(1)
+    masks = ((one << b_end[keep]) - one) ^ ((one << b_start[keep]) - one)
+    rows = intervals["iv_row"][keep]
+    days = intervals["iv_slot"][keep] // len(fasce_giornata)
+    # più intervalli possono cadere nella stessa cella: serve l'accumulo di bitwise_or.at
+    np.bitwise_or.at(occupancy, (rows, days), masks)
+    return occupancy
 
 
-# ---------- CICLO ---------------------------------------------------------------
-ciclo_opts = [
-    "Tutti",
-    "Ciclo 1 (Gen-Feb-Mar)",
-    "Ciclo 2 (Apr-Mag-Giu)",
-    "Ciclo 3 (Lug-Ago-Set)",
-    "Ciclo 4 (Ott-Nov-Dic)",
-]
-today = datetime.datetime.now(timezone)
-default_cycle_idx = 1 + (today.month - 1) // 3
+def weekly_availability_counts(occupancy: np.ndarray, row_pos: np.ndarray, phys_id: np.ndarray) -> np.ndarray:
+    n_days = occupancy.shape[1]
+    if len(row_pos) == 0:
+        return np.zeros((n_days, OCCUPANCY_BUCKETS), dtype=int)
 
-if "ciclo_scelto" in st.session_state and st.session_state["ciclo_scelto"] not in ciclo_opts:
-    st.session_state.pop("ciclo_scelto", None)
+    # righe senza nome: ognuna conta come un medico a sé
+    codes = np.where(phys_id >= 0, phys_id, -1 - np.arange(len(phys_id)))
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
 
+    per_medico = np.bitwise_or.reduceat(occupancy[row_pos[order]], starts, axis=0)
+    counts = np.empty((n_days, OCCUPANCY_BUCKETS), dtype=int)
+    for b in range(OCCUPANCY_BUCKETS):
+        counts[:, b] = ((per_medico >> np.uint64(b)) & np.uint64(1)).sum(axis=0)
+    return counts
 
-# ---------- APPLY VOICE FILTERS -------------------------------------------------
-def _parse_hhmm_or_none(value):
-    if value is None:
+
+def normalize_nome(values: pd.Series) -> pd.Series:
+    return values.astype(str).str.strip().str.lower()
+
+
+# ---------- IDENTITÀ MEDICI -----------------------------------------------------
+MEDICO_TITLES = {
+    "dott", "dottore", "dottoressa", "dr", "dssa", "ssa", "prof", "professore", "professoressa",
+    "sig", "sigra", "med",
+}
+IDENTITY_USE_ADDRESS = os.getenv("MEDICI_IDENTITY_ADDRESS", "0") == "1"
+
+
+def _ascii_tokens(values: pd.Series) -> pd.Series:
+    return (
+        values.fillna("").astype(str)
+        .str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+        .str.lower()
+        .str.replace("'", "", regex=False)
+        .str.replace(r"[^a-z0-9]+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def _identity_name_key(name: str) -> str:
+    return " ".join(sorted(t for t in name.split() if t not in MEDICO_TITLES))
+
+
+def physician_identity_keys(df: pd.DataFrame, use_address: bool = IDENTITY_USE_ADDRESS) -> pd.Series:
+    # "Dott. Rossi Mario", "ROSSI  MARIO" e "Mario Rossì" danno la stessa chiave
+    nome = _ascii_tokens(df.get("nome medico", pd.Series("", index=df.index)))
+    uniques = pd.unique(nome)
+    keys = nome.map(dict(zip(uniques, (_identity_name_key(u) for u in uniques))))
+    if use_address:
+        indirizzo = _ascii_tokens(df.get("indirizzo ambulatorio", pd.Series("", index=df.index)))
+        keys = keys.where(keys.eq(""), keys + "|" + indirizzo)
+    return keys
+
+
+def physician_identity_index(df: pd.DataFrame) -> np.ndarray:
+    keys = physician_identity_keys(df)
+    ids, _ = pd.factorize(keys.where(keys.ne("")))
+    return ids.astype(np.int32)
+
+
+def count_physicians(phys_id: np.ndarray, mask: Optional[np.ndarray] = None) -> int:
+    ids = phys_id if mask is None else phys_id[mask]
+    return int(np.unique(ids[ids >= 0]).size)
+
+
+# ---------- GEOGRAFIA (GAZETTEER OFFLINE) ---------------------------------------
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "comuni.csv")
+EARTH_RADIUS_KM = 6371.0
+GEO_NESSUNA = "Nessuna"
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+@cache_resource
+def load_gazetteer() -> pd.DataFrame:
+    try:
+        gaz = pd.read_csv(GAZETTEER_PATH, dtype={"comune": str, "provincia": str})
+    except Exception:
+        return pd.DataFrame(columns=["comune", "provincia", "lat", "lon", "_key"])
+    gaz["provincia"] = gaz["provincia"].str.strip().str.upper()
+    gaz["_key"] = _ascii_tokens(gaz["comune"])
+    return gaz.drop_duplicates("_key").reset_index(drop=True)
+
+
+def gazetteer_point(comune: Optional[str]) -> Optional[tuple[float, float]]:
+    if not comune or comune == GEO_NESSUNA:
+        return None
+    gaz = load_gazetteer()
+    hit = gaz[gaz["_key"] == _ascii_tokens(pd.Series([comune])).iloc[0]]
+    if hit.empty:
+        return None
+    return float(hit["lat"].iloc[0]), float(hit["lon"].iloc[0])
+
+
+def _unit_vectors(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    la, lo = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(la) * np.cos(lo), np.cos(la) * np.sin(lo), np.sin(la)])
+
+
+def dataset_geo(dataset: dict) -> dict:
+    geo = dataset.get("geo")
+    if geo is None:
+        with dataset_lock(dataset, "geo"):
+            geo = dataset.get("geo")
+            if geo is None:
+                geo = dataset["geo"] = _build_dataset_geo(dataset)
+    return geo
+
+
+def _build_dataset_geo(dataset: dict) -> dict:
+    # coordinate per riga: comune esatto, altrimenti media dei comuni della provincia
+    df = dataset["df"]
+    gaz = load_gazetteer()
+
+    citta = _ascii_tokens(df.get("città", pd.Series("", index=df.index)))
+    coords = gaz.set_index("_key")[["lat", "lon"]].reindex(citta)
+    lat = coords["lat"].to_numpy(dtype=float)
+    lon = coords["lon"].to_numpy(dtype=float)
+    exact = ~np.isnan(lat)
+
+    if "provincia" in df.columns:
+        by_prov = gaz.groupby("provincia")[["lat", "lon"]].mean()
+        prov = by_prov.reindex(df["provincia"].astype(str).str.strip().str.upper())
+        lat = np.where(exact, lat, prov["lat"].to_numpy(dtype=float))
+        lon = np.where(exact, lon, prov["lon"].to_numpy(dtype=float))
+
+    located = np.flatnonzero(~np.isnan(lat))
+    xyz = _unit_vectors(lat[located], lon[located])
+    return {
+        "lat": lat,
+        "lon": lon,
+        "exact": exact,
+        "located": located,
+        "xyz": xyz,
+        "tree": cKDTree(xyz) if cKDTree is not None and len(xyz) else None,
+        "comuni": sorted(gaz.loc[gaz["_key"].isin(set(citta)), "comune"].tolist()),
+    }
+
+
+def distances_km(geo: dict, lat: float, lon: float) -> np.ndarray:
+    la1, lo1 = np.radians(lat), np.radians(lon)
+    la2, lo2 = np.radians(geo["lat"]), np.radians(geo["lon"])
+    a = np.sin((la2 - la1) / 2) ** 2 + np.cos(la1) * np.cos(la2) * np.sin((lo2 - lo1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def rows_within_km(geo: dict, lat: float, lon: float, km: float) -> np.ndarray:
+    # sulla sfera unitaria la distanza euclidea (corda) è monotona con quella geodetica
+    chord = 2 * np.sin(min(km / EARTH_RADIUS_KM, np.pi) / 2)
+    center = _unit_vectors(np.array([lat]), np.array([lon]))[0]
+    if geo["tree"] is not None:
+        idx = np.asarray(geo["tree"].query_ball_point(center, chord), dtype=int)
+    else:
+        idx = np.flatnonzero(((geo["xyz"] - center) ** 2).sum(axis=1) <= chord ** 2)
+    return geo["located"][idx]
+
+
+def build_territory_coverage(
+    df_source: pd.DataFrame,
+    group_col: str,
+    cycle_cols: list[str],
+    seen_rows: Optional[np.ndarray] = None,
+    phys_id: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
+    if group_col not in df_source.columns:
+        return pd.DataFrame()
+
+    work = df_source.copy()
+
+    work["_medico"] = physician_identity_index(df_source) if phys_id is None else phys_id
+    work["_territorio"] = work.get(group_col, pd.Series("", index=work.index)).astype(str).str.strip()
+
+    work = work[
+        work["_medico"].ge(0) &
+        work["_territorio"].ne("") &
+        work["_territorio"].str.lower().ne("nan")
+    ].copy()
+
+    is_mmg = work.get("spec", pd.Series("", index=work.index)).astype(str).str.strip().str.upper() == "MMG"
+    is_in_target = work.get("in target", pd.Series("", index=work.index)).astype(str).str.strip().str.lower() == "x"
+    work = work[is_mmg & is_in_target].copy()
+
+    valid_cycle_cols = [c for c in cycle_cols if c in work.columns]
+
+    if seen_rows is not None:
+        work["_seen"] = pd.Series(seen_rows, index=df_source.index).loc[work.index].to_numpy()
+    elif valid_cycle_cols:
+        work["_seen"] = (
+            work[valid_cycle_cols].astype(str).apply(lambda c: c.str.strip().str.lower()).isin(["x", "v"]).any(axis=1)
+        )
+    else:
+        work["_seen"] = False
+
+    dedup = (
+        work.groupby(["_territorio", "_medico"], as_index=False)["_seen"]
+        .max()
+        .copy()
+    )
+
+    summary = (
+        dedup.groupby("_territorio", as_index=False)
+        .agg(
+            medici_totali=("_medico", "nunique"),
+            medici_visti=("_seen", "sum"),
+        )
+        .copy()
+    )
+
+    summary["medici_visti"] = summary["medici_visti"].astype(int)
+    summary["medici_totali"] = summary["medici_totali"].astype(int)
+    summary["medici_non_visti"] = summary["medici_totali"] - summary["medici_visti"]
+    summary["copertura_pct"] = (
+        (summary["medici_visti"] / summary["medici_totali"]) * 100
+    ).round(1)
+
+    summary = summary.rename(columns={"_territorio": group_col})
+    summary = summary.sort_values(
+        by=["copertura_pct", "medici_visti", "medici_totali", group_col],
+        ascending=[False, False, False, True]
+    ).reset_index(drop=True)
+
+    return summary
+
+
+COVERAGE_CUBE_LEVELS = ["provincia", "microarea", "città"]
+COVERAGE_NON_INDICATO = "(non indicata)"
+
+
+def build_coverage_cube(df_source: pd.DataFrame, seen_rows: np.ndarray, phys_id: np.ndarray) -> dict:
+    # rollup provincia → microarea → città: un riepilogo per ogni profondità,
+    # così il drill-down filtra tabelle piccole invece di raggruppare il dataset
+    if "provincia" not in df_source.columns:
+        return {}
+
+    is_mmg = df_source.get("spec", pd.Series("", index=df_source.index)).astype(str).str.strip().str.upper() == "MMG"
+    is_in_target = df_source.get("in target", pd.Series("", index=df_source.index)).astype(str).str.strip().str.lower() == "x"
+
+    work = pd.DataFrame({"_medico": phys_id, "_seen": seen_rows})
+    for col in COVERAGE_CUBE_LEVELS:
+        values = df_source.get(col, pd.Series("", index=df_source.index)).astype(str).str.strip()
+        work[col] = values.mask(values.eq("") | values.str.lower().eq("nan"), COVERAGE_NON_INDICATO).to_numpy()
+
+    base = (is_mmg & is_in_target).to_numpy() & (phys_id >= 0) & (work["provincia"] != COVERAGE_NON_INDICATO).to_numpy()
+    work = work[base]
+
+    cube = {}
+    for depth, level in enumerate(COVERAGE_CUBE_LEVELS, start=1):
+        keys = COVERAGE_CUBE_LEVELS[:depth]
+        dedup = work.groupby(keys + ["_medico"], as_index=False, sort=False)["_seen"].max()
+        summary = dedup.groupby(keys, as_index=False).agg(
+            medici_totali=("_medico", "size"),
+            medici_visti=("_seen", "sum"),
+        )
+        summary["medici_visti"] = summary["medici_visti"].astype(int)
+        summary["medici_totali"] = summary["medici_totali"].astype(int)
+        summary["medici_non_visti"] = summary["medici_totali"] - summary["medici_visti"]
+        summary["copertura_pct"] = ((summary["medici_visti"] / summary["medici_totali"]) * 100).round(1)
+        cube[level] = summary.sort_values(
+            by=keys[:-1] + ["copertura_pct", "medici_totali", level],
+            ascending=[True] * (depth - 1) + [False, False, True],
+        ).reset_index(drop=True)
+    return cube
+
+
+# ---------- DATASET PREPARATO (INGEST INCREMENTALE) ----------------------------
+VISIT_CODES = {"x": 1, "v": 2}
+VISIT_CODES_INV = {0: "", 1: "x", 2: "v"}
+MERGE_SOURCE_COL = "file origine"
+ULTIMA_VISITA_LABELS = np.array([""] + [m.capitalize() for m in mesi], dtype=object)
+DERIVED_ROW_ARRAYS = ["visit", "slot_start", "slot_end", "occupancy"]
+
+DATASET_REGISTRY_MAX = 8
+DATASET_SNAPSHOT_MAX = 24
+DATASET_SNAPSHOT_DIR = CACHE_DIR
+# da cambiare quando cambia il modo di derivare le righe: snapshot e store condiviso vecchi non si riusano
+DATASET_DERIVE_VERSION = 3
+DATASET_BASELINE_MIN_OVERLAP = 0.5
+DATASET_CHANGES_MAX = 32
+
+
+def normalize_dataset(df_raw: pd.DataFrame) -> pd.DataFrame:
+    df = df_raw.copy()
+    df.columns = df.columns.str.lower()
+
+    if "provincia" in df.columns:
+        df["provincia"] = df["provincia"].astype(str).str.strip()
+    if "microarea" in df.columns:
+        df["microarea"] = df["microarea"].astype(str).str.strip()
+
+    for m in mesi:
+        if m in df.columns:
+            df[m] = df[m].fillna("").astype(str).str.strip().str.lower()
+
+    return df
+
+
+def merge_workbooks(frames: list[tuple[str, pd.DataFrame]]) -> tuple[pd.DataFrame, int]:
+    parts, sources = [], []
+    for i, (name, df_raw) in enumerate(frames):
+        df = normalize_dataset(df_raw)
+        df[MERGE_SOURCE_COL] = name
+        parts.append(df)
+        sources.append(np.full(len(df), i))
+    merged = pd.concat(parts, ignore_index=True, sort=False)
+    source = pd.Series(np.concatenate(sources), index=merged.index)
+
+    nome = physician_identity_keys(merged, use_address=False)
+    indirizzo = normalize_nome(merged.get("indirizzo ambulatorio", pd.Series("", index=merged.index)).fillna(""))
+    key = nome + "|" + indirizzo
+    # righe ripetute nello stesso file restano distinte: si abbinano per occorrenza solo tra file diversi
+    key = key + "|" + key.groupby([source, key]).cumcount().astype(str)
+
+    # senza nome non c'è un'identità da confrontare: quelle righe non si uniscono mai
+    dup = key.duplicated(keep=False) & nome.ne("")
+    if not dup.any():
+        return merged, 0
+
+    dups, dup_key = merged[dup], key[dup]
+    agg = dups.groupby(dup_key, sort=False).first()
+
+    month_cols = [m for m in mesi if m in dups.columns]
+    if month_cols:
+        codes = dups[month_cols].apply(lambda c: c.map(VISIT_CODES)).fillna(0).astype(int)
+        best = codes.groupby(dup_key, sort=False).max()
+        agg[month_cols] = best.apply(lambda c: c.map(VISIT_CODES_INV))
+    agg[MERGE_SOURCE_COL] = (
+        dups.groupby(dup_key, sort=False)[MERGE_SOURCE_COL].agg(lambda v: ", ".join(dict.fromkeys(v)))
+    )
+
+    out = merged[~(key.duplicated() & dup)].copy()
+    out_key = key[out.index]
+    sel = out_key.isin(agg.index).to_numpy()
+    for col in agg.columns:
+        out[col] = out[col].astype(object)
+        out.loc[sel, col] = agg[col].reindex(out_key[sel]).to_numpy()
+
+    return out.reset_index(drop=True), int(dup.sum() - len(agg))
+
+
+def physician_row_keys(df: pd.DataFrame) -> np.ndarray:
+    nome = normalize_nome(df.get("nome medico", pd.Series("", index=df.index)))
+    indirizzo = normalize_nome(df.get("indirizzo ambulatorio", pd.Series("", index=df.index)))
+    base = nome + "|" + indirizzo
+    occorrenza = base.groupby(base).cumcount().astype(str)
+    return pd.util.hash_array((base + "|" + occorrenza).to_numpy(dtype=object))
+
+
+def row_fingerprints(df: pd.DataFrame) -> np.ndarray:
+    return pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+
+
+def derive_rows(df: pd.DataFrame) -> dict:
+    n_rows = len(df)
+
+    visit = np.zeros((n_rows, len(mesi)), dtype=np.int8)
+    for j, m in enumerate(mesi):
+        if m in df.columns:
+            visit[:, j] = df[m].map(VISIT_CODES).fillna(0).to_numpy(dtype=np.int8)
+
+    intervals = extract_slot_intervals(df)
+    slot_start, slot_end = slot_envelopes(intervals, n_rows)
+
+    return {
+        "visit": visit,
+        "slot_start": slot_start,
+        "slot_end": slot_end,
+        "occupancy": build_occupancy_matrix(intervals, n_rows),
+        **intervals,
+    }
+
+
+def merge_interval_tables(fresh: dict, fresh_rows: np.ndarray, previous: Optional[dict], prev_pos: np.ndarray, unchanged: np.ndarray) -> dict:
+    # righe ricalcolate: dalla tabella nuova; righe invariate: i loro intervalli dalla precedente
+    rows = [fresh_rows[fresh["iv_row"]]]
+    src = {name: [fresh[name]] for name in INTERVAL_ARRAYS[1:]}
+
+    if previous is not None and unchanged.any():
+        take, cnt = _gather_groups(previous["iv_row"], prev_pos[unchanged])
+        rows.append(np.repeat(np.flatnonzero(unchanged), cnt))
+        for name in INTERVAL_ARRAYS[1:]:
+            src[name].append(previous[name][take])
+
+    return _interval_table(
+        np.concatenate(rows),
+        np.concatenate(src["iv_slot"]),
+        np.concatenate(src["iv_start"]),
+        np.concatenate(src["iv_end"]),
+    )
+
+
+def visit_seen_mask(visit: np.ndarray, cycle_cols: list[str]) -> np.ndarray:
+    idx = [mesi.index(c) for c in cycle_cols if c in mesi]
+    if not idx:
+        return np.zeros(visit.shape[0], dtype=bool)
+    return (visit[:, idx] > 0).any(axis=1)
+
+
+def summarize_dataset_changes(df, row_keys, visit, previous, prev_pos, unchanged) -> dict:
+    matched = prev_pos >= 0
+    changed = matched & ~unchanged
+
+    new_marks = np.zeros(visit.shape, dtype=bool)
+    new_marks[matched] = (visit[matched] > 0) & (previous["visit"][prev_pos[matched]] == 0)
+
+    marked_rows = np.flatnonzero(new_marks.any(axis=1))
+    mesi_arr = np.array([m.capitalize() for m in mesi], dtype=object)
+    medici_nuove_visite = pd.DataFrame({
+        "nome medico": df["nome medico"].to_numpy()[marked_rows] if "nome medico" in df.columns else "",
+        "microarea": df["microarea"].to_numpy()[marked_rows] if "microarea" in df.columns else "",
+        "nuove visite": [", ".join(mesi_arr[new_marks[r]]) for r in marked_rows],
+    })
+
+    return {
+        "previous_key": previous["key"],
+        "righe_nuove": int((~matched).sum()),
+        "righe_rimosse": int(np.isin(previous["row_keys"], row_keys, invert=True).sum()),
+        "righe_modificate": int(changed.sum()),
+        "righe_invariate": int(unchanged.sum()),
+        "nuove_visite_per_mese": {m.capitalize(): int(new_marks[:, j].sum()) for j, m in enumerate(mesi)},
+        "medici_nuove_visite": medici_nuove_visite,
+    }
+
+
+def match_previous_rows(row_keys: np.ndarray, fingerprints: np.ndarray, previous: dict):
+    # posizione di ogni riga nel file precedente (-1 se nuova) e righe identiche a allora
+    prev_index = pd.Index(previous["row_keys"])
+    if not prev_index.is_unique:
         return None
+    prev_pos = prev_index.get_indexer(row_keys)
+    unchanged = prev_pos >= 0
+    unchanged[unchanged] = previous["fingerprints"][prev_pos[unchanged]] == fingerprints[unchanged]
+    return prev_pos, unchanged
+
+
+def prepare_dataset(
+    df_raw: pd.DataFrame,
+    dataset_key: str,
+    previous: Optional[dict] = None,
+    find_previous: Optional[Callable[[np.ndarray], Optional[dict]]] = None,
+) -> dict:
+    df = normalize_dataset(df_raw)
+    row_keys = physician_row_keys(df)
+    fingerprints = row_fingerprints(df)
+    if previous is None and find_previous is not None:
+        previous = find_previous(row_keys)
+
+    match = match_previous_rows(row_keys, fingerprints, previous) if previous is not None else None
+    if match is None:
+        previous = None
+        prev_pos, unchanged = np.full(len(df), -1), np.zeros(len(df), dtype=bool)
+    else:
+        prev_pos, unchanged = match
+
+    fresh = derive_rows(df[~unchanged])
+    derived = {}
+    for name in DERIVED_ROW_ARRAYS:
+        arr = np.empty((len(df),) + fresh[name].shape[1:], dtype=fresh[name].dtype)
+        arr[~unchanged] = fresh[name]
+        if unchanged.any():
+            arr[unchanged] = previous[name][prev_pos[unchanged]]
+        derived[name] = arr
+
+    derived.update(merge_interval_tables(fresh, np.flatnonzero(~unchanged), previous, prev_pos, unchanged))
+
+    ultima = np.where(derived["visit"] > 0, np.arange(1, len(mesi) + 1), 0).max(axis=1)
+    df["ultima visita"] = ULTIMA_VISITA_LABELS[ultima]
+
+    phys_id = physician_identity_index(df)
+
+    entry = {
+        "key": dataset_key,
+        "df": df,
+        "ultima_num": ultima.astype(np.int8),
+        "phys_id": phys_id,
+        "n_phys": int(phys_id.max()) + 1 if len(phys_id) else 0,
+        "row_keys": row_keys,
+        "fingerprints": fingerprints,
+        "rows_rederived": int((~unchanged).sum()),
+        **derived,
+    }
+    return entry
+
+
+def _snapshot_path(dataset_key: str) -> str:
+    return os.path.join(DATASET_SNAPSHOT_DIR, f"{dataset_key}.v{DATASET_DERIVE_VERSION}.npz")
+
+
+def save_dataset_snapshot(entry: dict) -> None:
     try:
-        return datetime.datetime.strptime(str(value), "%H:%M").time()
+        os.makedirs(DATASET_SNAPSHOT_DIR, exist_ok=True)
+        tmp_path = _snapshot_path(entry["key"]) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                row_keys=entry["row_keys"],
+                fingerprints=entry["fingerprints"],
+                visit=entry["visit"],
+                slot_start=entry["slot_start"],
+                slot_end=entry["slot_end"],
+                occupancy=entry["occupancy"],
+                **{name: entry[name] for name in INTERVAL_ARRAYS},
+            )
+        os.replace(tmp_path, _snapshot_path(entry["key"]))
+
+        snapshots = sorted(
+            (os.path.join(DATASET_SNAPSHOT_DIR, f) for f in os.listdir(DATASET_SNAPSHOT_DIR) if f.endswith(".npz")),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for old in snapshots[DATASET_SNAPSHOT_MAX:]:
+            os.remove(old)
+    except Exception:
+        pass
+
+
+def load_dataset_snapshot(dataset_key: str) -> Optional[dict]:
+    try:
+        with np.load(_snapshot_path(dataset_key)) as z:
+            snap = {"key": dataset_key, **{k: z[k] for k in z.files}}
     except Exception:
         return None
+    return snap
 
 
-def apply_voice_filters(payload: dict):
-    action = payload.get("action")
+def _list_snapshot_keys() -> list[str]:
+    suffix = f".v{DATASET_DERIVE_VERSION}.npz"
+    try:
+        files = [f for f in os.listdir(DATASET_SNAPSHOT_DIR) if f.endswith(suffix)]
+    except Exception:
+        return []
+    files.sort(key=lambda f: os.path.getmtime(os.path.join(DATASET_SNAPSHOT_DIR, f)), reverse=True)
+    return [f[: -len(suffix)] for f in files]
 
-    if action == "azzera_filtri":
-        azzera_filtri()
-        return "Filtri azzerati."
 
-    if action == "nessuna_azione":
-        return payload.get("message") or "Comando non applicato."
+# ---------- STORE CONDIVISO TRA PROCESSI ----------------------------------------
+# con più processi Streamlit dietro un bilanciatore (stesso MEDICI_CACHE_DIR) il primo che
+# vede un file lo prepara e lo pubblica: array e colonne della tabella in .npy (le colonne di
+# testo come codici + categorie), il resto in un JSON. Gli altri processi mappano i .npy in
+# sola lettura invece di rileggere l'Excel; nessun pickle, la cartella di default sta in /tmp
+SHARED_DATASET_DIR = os.path.join(CACHE_DIR, "shared")
+SHARED_DATASET_MAX = 8
+SHARED_DATASET_TMP_TTL_S = 3600
+SHARED_DATASET_LOCK_WAIT_S = 300
 
-    if action != "apply_filters":
-        return "Nessuna modifica applicata."
 
-    today_local = datetime.datetime.now(timezone)
-    default_cycle_idx_local = 1 + (today_local.month - 1) // 3
-    ciclo_opts_local = [
-        "Tutti",
-        "Ciclo 1 (Gen-Feb-Mar)",
-        "Ciclo 2 (Apr-Mag-Giu)",
-        "Ciclo 3 (Lug-Ago-Set)",
-        "Ciclo 4 (Ott-Nov-Dic)",
-    ]
-    ciclo_default = ciclo_opts_local[default_cycle_idx_local]
-    giorno_default = giorni_settimana[today_local.weekday()] if today_local.weekday() < 5 else "sempre"
+def _shared_dataset_path(dataset_key: str) -> str:
+    return os.path.join(SHARED_DATASET_DIR, f"{dataset_key}.v{DATASET_DERIVE_VERSION}")
 
-    st.session_state["ciclo_scelto"] = ciclo_default
-    st.session_state["filtro_ultima_visita"] = "Nessuno"
-    st.session_state["mese_limite_visita"] = "Nessuno"
-    st.session_state["filtro_spec"] = DEFAULT_SPEC.copy()
-    st.session_state["filtro_target"] = "In target"
-    st.session_state["filtro_visto"] = "Non Visto"
-    st.session_state["giorno_scelto"] = giorno_default
-    st.session_state["fascia_oraria"] = "Personalizzato"
-    st.session_state["custom_start"] = None
-    st.session_state["custom_end"] = None
-    st.session_state["provincia_scelta"] = "Ovunque"
-    st.session_state["microarea_scelta"] = []
-    st.session_state["search_query"] = ""
-    st.session_state["prov_escludi"] = []
 
-    for m in all_microaree:
-        mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
-        st.session_state[mk] = False
+def shared_dir_ok() -> bool:
+    # si usa solo se CACHE_DIR e la cartella condivisa sono dell'utente del processo e nessun
+    # altro ci può scrivere: in /tmp chiunque potrebbe averle create prima di noi
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        os.makedirs(SHARED_DATASET_DIR, mode=0o700, exist_ok=True)
+        for path in (CACHE_DIR, SHARED_DATASET_DIR):
+            info = os.lstat(path)
+            if not os.path.isdir(path) or os.path.islink(path) or info.st_mode & 0o022:
+                return False
+            if hasattr(os, "getuid") and info.st_uid != os.getuid():
+                return False
+    except OSError:
+        return False
+    return True
 
-    for key in ["giorno_scelto", "provincia_scelta", "filtro_visto", "filtro_target", "ciclo_scelto", "search_query"]:
-        value = payload.get(key)
-        if value is not None:
-            st.session_state[key] = value
 
-    filtro_spec = payload.get("filtro_spec")
-    if isinstance(filtro_spec, list) and filtro_spec:
-        valid_specs = [x for x in filtro_spec if x in (DEFAULT_SPEC + SPEC_EXTRA)]
-        if valid_specs:
-            st.session_state["filtro_spec"] = valid_specs
+@contextmanager
+def shared_dataset_lock(name: str):
+    if fcntl is None or not shared_dir_ok():
+        yield
+        return
+    # mai sotto registry["lock"]: l'attesa qui può durare quanto una preparazione in un altro processo.
+    # Oltre SHARED_DATASET_LOCK_WAIT_S si prosegue senza: la pubblicazione è comunque atomica
+    with open(os.path.join(SHARED_DATASET_DIR, f".{name}.lock"), "a") as f:
+        deadline = time.monotonic() + SHARED_DATASET_LOCK_WAIT_S
+        locked = False
+        while not locked:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    break
+                time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if locked:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _save_shared_frame(df: pd.DataFrame, path: str) -> list[dict]:
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        raise TypeError("indice non posizionale")
+    columns = []
+    for i, name in enumerate(df.columns):
+        values = df[name].to_numpy()
+        if values.dtype != object:
+            np.save(os.path.join(path, f"col{i}.npy"), values)
+            columns.append({"name": name})
+            continue
+        codes, categories = pd.factorize(values, use_na_sentinel=True)
+        categories = categories.tolist()
+        if not all(isinstance(c, (str, int, float, bool)) for c in categories):
+            raise TypeError(f"colonna {name}: valori non serializzabili")
+        np.save(os.path.join(path, f"col{i}.npy"), codes.astype(np.int32))
+        columns.append({"name": name, "categories": categories})
+    return columns
+
+
+def _load_shared_frame(columns: list[dict], path: str) -> pd.DataFrame:
+    data = {}
+    for i, col in enumerate(columns):
+        values = np.load(os.path.join(path, f"col{i}.npy"), mmap_mode="r")
+        if "categories" in col:
+            # le stringhe distinte una volta per processo, le righe sono solo riferimenti
+            categories = np.array(col["categories"] + [np.nan], dtype=object)
+            values = categories[values]
+        data[col["name"]] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def publish_shared_dataset(entry: dict) -> None:
+    final_path = _shared_dataset_path(entry["key"])
+    if not shared_dir_ok() or os.path.isdir(final_path):
+        return
+    tmp_path = None
+    try:
+        tmp_path = tempfile.mkdtemp(prefix=f".{entry['key']}.", suffix=".tmp", dir=SHARED_DATASET_DIR)
+        meta = {"arrays": [], "values": {}}
+        for name, value in entry.items():
+            if name == "df":
+                meta["columns"] = _save_shared_frame(value, tmp_path)
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(os.path.join(tmp_path, f"{name}.npy"), value)
+                meta["arrays"].append(name)
+            elif isinstance(value, (str, int, float, bool, list, type(None))):
+                meta["values"][name] = value
+            else:
+                raise TypeError(f"{name}: tipo non pubblicabile")
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        # rename di una directory: gli altri processi la vedono completa o non la vedono
+        os.rename(tmp_path, final_path)
+    except (OSError, TypeError, ValueError):
+        if tmp_path is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    _prune_shared_datasets()
 
-    micro_sel = payload.get("microarea_scelta")
-    if isinstance(micro_sel, list):
-        st.session_state["microarea_scelta"] = micro_sel
-        for m in all_microaree:
-            mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
-            st.session_state[mk] = m in micro_sel
 
-    fascia = payload.get("fascia_oraria")
-    if fascia is not None:
-        st.session_state["fascia_oraria"] = fascia
+def load_shared_dataset(dataset_key: str) -> Optional[dict]:
+    path = _shared_dataset_path(dataset_key)
+    if not shared_dir_ok():
+        return None
+    try:
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        entry = dict(meta["values"])
+        entry["df"] = _load_shared_frame(meta["columns"], path)
+        for name in meta["arrays"]:
+            entry[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        os.utime(path)
+    except Exception:
+        return None
+    entry["shared"] = True
+    return entry
 
-    if fascia == "Personalizzato":
-        t1 = _parse_hhmm_or_none(payload.get("custom_start"))
-        t2 = _parse_hhmm_or_none(payload.get("custom_end"))
-        if t1 and t2 and t2 > t1:
-            st.session_state["custom_start"] = t1
-            st.session_state["custom_end"] = t2
+
+def _prune_shared_datasets() -> None:
+    try:
+        names = os.listdir(SHARED_DATASET_DIR)
+        now = time.time()
+        published = []
+        for name in names:
+            path = os.path.join(SHARED_DATASET_DIR, name)
+            if not os.path.isdir(path):
+                continue
+            if name.startswith("."):
+                # pubblicazioni interrotte di processi terminati a metà
+                if now - os.path.getmtime(path) > SHARED_DATASET_TMP_TTL_S:
+                    shutil.rmtree(path, ignore_errors=True)
+            else:
+                published.append(path)
+        published.sort(key=os.path.getmtime, reverse=True)
+        # i processi che hanno già mappato i file continuano a leggerli anche dopo la rimozione
+        for old in published[SHARED_DATASET_MAX:]:
+            shutil.rmtree(old, ignore_errors=True)
+    except OSError:
+        pass
+
+
+@cache_resource
+def get_dataset_registry() -> dict:
+    # "pending": dataset_key -> Future della preparazione in corso (chi chiede lo stesso file aspetta quella)
+    return {"lock": threading.RLock(), "datasets": OrderedDict(), "pending": {}}
+
+
+register_metrics_source("datasets", get_dataset_registry())
+
+
+def _find_previous_dataset(registry: dict, row_keys: np.ndarray, dataset_key: str, hint_key: Optional[str]):
+    with registry["lock"]:
+        loaded = dict(registry["datasets"])
+
+    if hint_key and hint_key != dataset_key:
+        prev = loaded.get(hint_key) or load_dataset_snapshot(hint_key)
+        if prev is not None:
+            return prev
+
+    best, best_overlap = None, DATASET_BASELINE_MIN_OVERLAP
+    candidates = list(loaded.keys())[::-1]
+    candidates += [k for k in _list_snapshot_keys() if k not in loaded]
+    for key in candidates:
+        if key == dataset_key:
+            continue
+        if key in loaded:
+            cand_keys = loaded[key]["row_keys"]
         else:
-            st.session_state["custom_start"] = None
-            st.session_state["custom_end"] = None
+            try:
+                with np.load(_snapshot_path(key)) as z:
+                    cand_keys = z["row_keys"]
+            except Exception:
+                continue
+        overlap = np.isin(row_keys, cand_keys).mean() if len(row_keys) else 0.0
+        if overlap > best_overlap:
+            best, best_overlap = key, overlap
 
-    return payload.get("message") or "Filtri aggiornati da comando vocale."
+    if best is None:
+        return None
+    return loaded.get(best) or load_dataset_snapshot(best)
 
 
-# ---------- COMANDO VOCALE AI ---------------------------------------------------
-st.markdown("""
-<div class="voice-wrap">
-  <div class="voice-title">🎙️ Comando vocale AI</div>
-  <div class="voice-sub">
-    Premi il pulsante, parla, poi ripremilo per fermare.<br>
-    Appena fermi la registrazione, il comando parte da solo.
-  </div>
-</div>
-""", unsafe_allow_html=True)
+@cache_resource
+def get_dataset_changes_cache() -> dict:
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+
+def dataset_changes(dataset: dict, previous_key: Optional[str]) -> Optional[dict]:
+    # il file precedente è di ciascuna sessione: il riepilogo resta fuori dalla voce condivisa
+    # del registro e si calcola per coppia (dataset, precedente) da row_keys e fingerprints
+    cache = get_dataset_changes_cache()
+    key = (dataset["key"], previous_key)
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["entries"].move_to_end(key)
+            return cache["entries"][key]
+
+    changes = None
+    previous = _find_previous_dataset(get_dataset_registry(), dataset["row_keys"], dataset["key"], previous_key)
+    match = match_previous_rows(dataset["row_keys"], dataset["fingerprints"], previous) if previous is not None else None
+    if match is not None:
+        prev_pos, unchanged = match
+        changes = summarize_dataset_changes(dataset["df"], dataset["row_keys"], dataset["visit"], previous, prev_pos, unchanged)
+
+    with cache["lock"]:
+        cache["entries"][key] = changes
+        while len(cache["entries"]) > DATASET_CHANGES_MAX:
+            cache["entries"].popitem(last=False)
+    return changes
+
+
+def workbooks_key(workbooks: list[tuple[str, bytes]], digests: Optional[list] = None) -> str:
+    # digests: MD5 già noti (handle del blob store), None dove vanno calcolati
+    digests = digests or [None] * len(workbooks)
+    hashes = [d or hashlib.md5(file_bytes).hexdigest() for (_, file_bytes), d in zip(workbooks, digests)]
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.md5("|".join(sorted(hashes)).encode("utf-8")).hexdigest()
+
+
+def load_workbooks(workbooks: list[tuple[str, bytes]]) -> tuple[pd.DataFrame, dict]:
+    if len(workbooks) == 1:
+        name, file_bytes = workbooks[0]
+        return load_excel(file_bytes), {"sources": [name], "merged_duplicates": 0}
+
+    parsed = parse_workbooks([file_bytes for _, file_bytes in workbooks])
+    for (name, _), res in zip(workbooks, parsed):
+        if isinstance(res, Exception):
+            raise ValueError(f"{name}: {res}")
+
+    merged, n_dup = merge_workbooks([(name, df) for (name, _), df in zip(workbooks, parsed)])
+    return merged, {"sources": [name for name, _ in workbooks], "merged_duplicates": n_dup}
+
+
+def get_prepared_dataset(
+    workbooks: list[tuple[str, bytes]],
+    dataset_key: str,
+    previous_key: Optional[str] = None,
+) -> dict:
+    registry = get_dataset_registry()
+    # il lock del registro copre solo lookup e inserimento: la preparazione gira fuori,
+    # così le altre sessioni (e gli altri file) non restano ferme ad aspettarla
+    while True:
+        with registry["lock"]:
+            entry = registry["datasets"].get(dataset_key)
+            if entry is not None:
+                registry["datasets"].move_to_end(dataset_key)
+                return entry
+            pending = registry["pending"].get(dataset_key)
+            if pending is None:
+                pending = registry["pending"][dataset_key] = Future()
+                break
+        entry = pending.result()
+        if entry is not None:
+            return entry
+
+    prepared = False
+    try:
+        entry = load_shared_dataset(dataset_key)
+        if entry is None:
+            # un solo processo alla volta prepara lo stesso file, gli altri aspettano e lo mappano
+            with shared_dataset_lock(dataset_key):
+                entry = load_shared_dataset(dataset_key)
+                if entry is None:
+                    df_raw, merge_info = load_workbooks(workbooks)
+                    entry = prepare_dataset(
+                        df_raw,
+                        dataset_key,
+                        find_previous=lambda row_keys: _find_previous_dataset(registry, row_keys, dataset_key, previous_key),
+                    )
+                    entry.update(merge_info)
+                    publish_shared_dataset(entry)
+                    prepared = True
+    except BaseException as e:
+        with registry["lock"]:
+            registry["pending"].pop(dataset_key, None)
+        # un rerun che interrompe chi prepara non deve arrivare alle altre sessioni: riprovano loro
+        if isinstance(e, Exception):
+            pending.set_exception(e)
+        else:
+            pending.set_result(None)
+        raise
+
+    with registry["lock"]:
+        registry["datasets"][dataset_key] = entry
+        registry["pending"].pop(dataset_key, None)
+        while len(registry["datasets"]) > DATASET_REGISTRY_MAX:
+            registry["datasets"].popitem(last=False)
+    pending.set_result(entry)
+
+    if prepared:
+        save_dataset_snapshot(entry)
+    return entry
+
+
+# ---------- PRECARICAMENTO CARTELLA CONDIVISA -----------------------------------
+def _watch_scan():
+    # prima i più recenti: il file della settimana è pronto il prima possibile
+    for f in list_watched_workbooks()[:WATCH_PRELOAD_MAX]:
+        if _watch_update(f)["status"] in ("pronto", "errore"):
+            continue
+        try:
+            value = watched_workbook_value(f)
+            data = blob_get(value) if _is_blob(value) else value
+            key = workbooks_key([(f["name"], data)])
+            _watch_update(f, status="in preparazione", key=key)
+            # senza registry["lock"]: le sessioni in primo piano restano libere, e se una sta già
+            # preparando lo stesso file qui si aspetta il suo risultato invece di rifarlo
+            get_prepared_dataset([(f["name"], data)], key)
+            _watch_update(f, status="pronto")
+        except Exception as e:
+            _watch_update(f, status="errore", error=str(e))
+
+
+def _watch_loop(store: dict):
+    while True:
+        try:
+            _watch_scan()
+        except Exception:
+            pass
+        store["scans"] += 1
+        if store["stop"].wait(WATCH_INTERVAL_S):
+            return
+
+
+@cache_resource
+def start_folder_watcher() -> threading.Thread:
+    thread = threading.Thread(target=_watch_loop, args=(get_watch_store(),), name="medici-watch", daemon=True)
+    thread.start()
+    return thread
+
+
+if WATCH_DIR:
+    start_folder_watcher()
+
+
+dataset_key = workbooks_key(workbooks, current_workbook_digests())
+
+if st.session_state.get("dataset_key") not in (None, dataset_key):
+    st.session_state["previous_dataset_key"] = st.session_state["dataset_key"]
+st.session_state["dataset_key"] = dataset_key
+
+try:
+    dataset = get_prepared_dataset(workbooks, dataset_key, st.session_state.get("previous_dataset_key"))
+except Exception as e:
+    st.error(f"Errore nel caricamento del file Excel: {e}")
+    st.stop()
+
+df_mmg = dataset["df"]
+
+all_province = build_all_province(df_mmg)
+microarea_tax = dataset_microarea_taxonomy(dataset)
+all_microaree = microarea_tax["options"]
+
+if len(dataset["sources"]) > 1:
+    st.caption(
+        f"Dataset unito da {len(dataset['sources'])} file ({', '.join(dataset['sources'])}): "
+        f"{len(df_mmg)} righe, {dataset['merged_duplicates']} righe duplicate unite per nominativo e indirizzo."
+    )
+
+changes = dataset_changes(dataset, st.session_state.get("previous_dataset_key"))
+if changes is not None:
+    with st.expander("🆕 Novità rispetto al file precedente", expanded=False):
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Righe nuove", changes["righe_nuove"])
+        c2.metric("Righe modificate", changes["righe_modificate"])
+        c3.metric("Righe rimosse", changes["righe_rimosse"])
+        c4.metric("Righe invariate", changes["righe_invariate"])
+
+        nuove_per_mese = {m: n for m, n in changes["nuove_visite_per_mese"].items() if n > 0}
+        if nuove_per_mese:
+            st.write("**Nuove visite (X/V) per mese:** " + " · ".join(f"{m}: {n}" for m, n in nuove_per_mese.items()))
+            st.dataframe(changes["medici_nuove_visite"], use_container_width=True, hide_index=True)
+        else:
+            st.caption("Nessuna nuova X/V nei mesi rispetto al file precedente.")
+
+        st.caption(
+            f"Ricalcolate {dataset['rows_rederived']} righe su {len(df_mmg)}; "
+            "le altre sono state riprese da un file già preparato."
+        )
+
+
+# ---------- CICLO ---------------------------------------------------------------
+ciclo_opts = [
+    "Tutti",
+    "Ciclo 1 (Gen-Feb-Mar)",
+    "Ciclo 2 (Apr-Mag-Giu)",
+    "Ciclo 3 (Lug-Ago-Set)",
+    "Ciclo 4 (Ott-Nov-Dic)",
+]
+today = datetime.datetime.now(timezone)
+default_cycle_idx = 1 + (today.month - 1) // 3
+
+month_cycles = {
+    "Ciclo 1 (Gen-Feb-Mar)": ["gennaio", "febbraio", "marzo"],
+    "Ciclo 2 (Apr-Mag-Giu)": ["aprile", "maggio", "giugno"],
+    "Ciclo 3 (Lug-Ago-Set)": ["luglio", "agosto", "settembre"],
+    "Ciclo 4 (Ott-Nov-Dic)": ["ottobre", "novembre", "dicembre"],
+}
+
+if "ciclo_scelto" in st.session_state and st.session_state["ciclo_scelto"] not in ciclo_opts:
+    st.session_state.pop("ciclo_scelto", None)
+
+
+def cycle_visit_cols(ciclo: str, columns) -> list[str]:
+    return [m for m in (mesi if ciclo == "Tutti" else month_cycles[ciclo]) if m in columns]
+
+
+# ---------- PRE-CALCOLO AGGREGATI PER CICLO -------------------------------------
+CYCLE_PREWARM_WORKERS = int(os.getenv("MEDICI_PREWARM_WORKERS", "2"))
+
+
+@cache_resource
+def get_prewarm_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=max(1, CYCLE_PREWARM_WORKERS), thread_name_prefix="medici-prewarm")
+
+
+def compute_cycle_aggregates(dataset: dict, ciclo: str) -> dict:
+    df = dataset["df"]
+    cycle_cols = cycle_visit_cols(ciclo, df.columns)
+    seen = visit_seen_mask(dataset["visit"], cycle_cols)
+    vip = (dataset["visit"][:, [mesi.index(c) for c in cycle_cols]] == 2).any(axis=1)
+
+    kpi = kpi_base = None
+    if cycle_cols and "nome medico" in df.columns:
+        is_mmg = df.get("spec", pd.Series("", index=df.index)).astype(str).str.strip().str.upper() == "MMG"
+        is_in_target = df.get("in target", pd.Series("", index=df.index)).astype(str).str.strip().str.lower() == "x"
+        base_mask = kpi_base = (is_mmg & is_in_target).to_numpy()
+
+        total = count_physicians(dataset["phys_id"], base_mask)
+        seen_count = count_physicians(dataset["phys_id"], base_mask & seen)
+        kpi = {
+            "total": total,
+            "seen": seen_count,
+            "pct": int(round((seen_count / total) * 100)) if total > 0 else 0,
+        }
+
+    coverage = {
+        col: build_territory_coverage(df, col, cycle_cols, seen_rows=seen, phys_id=dataset["phys_id"])
+        for col in ["microarea", "provincia"]
+    }
+    cube = build_coverage_cube(df, seen, dataset["phys_id"])
+    aggregates = {
+        "cycle_cols": cycle_cols,
+        "seen": seen,
+        "vip": vip,
+        "kpi": kpi,
+        "kpi_base": kpi_base,
+        "coverage": coverage,
+        "cube": cube,
+    }
+    dataset["cycle_aggregates"][ciclo] = aggregates
+    return aggregates
+
+
+def start_cycle_prewarm(dataset: dict, first: Optional[str] = None):
+    registry = get_dataset_registry()
+    with registry["lock"]:
+        if "cycle_futures" in dataset:
+            return
+        dataset["cycle_aggregates"] = {}
+        order = sorted(ciclo_opts, key=lambda c: c != first)
+        executor = get_prewarm_executor()
+        dataset["cycle_futures"] = {c: executor.submit(compute_cycle_aggregates, dataset, c) for c in order}
+
+
+def get_cycle_aggregates(dataset: dict, ciclo: str) -> dict:
+    start_cycle_prewarm(dataset, ciclo)
+    aggregates = dataset["cycle_aggregates"].get(ciclo)
+    if aggregates is not None:
+        return aggregates
+    fut = dataset["cycle_futures"][ciclo]
+    # ancora in coda: meglio calcolarlo subito che aspettare gli altri cicli
+    if fut.cancel():
+        return compute_cycle_aggregates(dataset, ciclo)
+    try:
+        return fut.result()
+    except Exception:
+        # il precalcolo in background non deve rompere la pagina: si rifà qui, in primo piano
+        logging.getLogger(__name__).warning("Precalcolo del ciclo %s fallito", ciclo, exc_info=True)
+        return compute_cycle_aggregates(dataset, ciclo)
+
+
+start_cycle_prewarm(dataset, st.session_state.get("ciclo_scelto", ciclo_opts[default_cycle_idx]))
+
+
+# ---------- APPLY VOICE FILTERS -------------------------------------------------
+def _parse_hhmm_or_none(value):
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(str(value), "%H:%M").time()
+    except Exception:
+        return None
+
+
+def apply_voice_filters(payload: dict):
+    action = payload.get("action")
+
+    if action == "azzera_filtri":
+        azzera_filtri()
+        return "Filtri azzerati."
+
+    if action == "nessuna_azione":
+        return payload.get("message") or "Comando non applicato."
+
+    if action != "apply_filters":
+        return "Nessuna modifica applicata."
+
+    today_local = datetime.datetime.now(timezone)
+    default_cycle_idx_local = 1 + (today_local.month - 1) // 3
+    ciclo_opts_local = [
+        "Tutti",
+        "Ciclo 1 (Gen-Feb-Mar)",
+        "Ciclo 2 (Apr-Mag-Giu)",
+        "Ciclo 3 (Lug-Ago-Set)",
+        "Ciclo 4 (Ott-Nov-Dic)",
+    ]
+    ciclo_default = ciclo_opts_local[default_cycle_idx_local]
+    giorno_default = giorni_settimana[today_local.weekday()] if today_local.weekday() < 5 else "sempre"
+
+    st.session_state["ciclo_scelto"] = ciclo_default
+    st.session_state["filtro_ultima_visita"] = "Nessuno"
+    st.session_state["mese_limite_visita"] = "Nessuno"
+    st.session_state["filtro_spec"] = DEFAULT_SPEC.copy()
+    st.session_state["filtro_target"] = "In target"
+    st.session_state["filtro_visto"] = "Non Visto"
+    st.session_state["giorno_scelto"] = giorno_default
+    st.session_state["fascia_oraria"] = "Personalizzato"
+    st.session_state["custom_start"] = None
+    st.session_state["custom_end"] = None
+    st.session_state["provincia_scelta"] = "Ovunque"
+    st.session_state["microarea_scelta"] = []
+    st.session_state["microarea_gruppi"] = []
+    st.session_state["search_query"] = ""
+    st.session_state["prov_escludi"] = []
+
+    for m in all_microaree:
+        mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
+        st.session_state[mk] = False
+
+    for key in ["giorno_scelto", "provincia_scelta", "filtro_visto", "filtro_target", "ciclo_scelto", "search_query"]:
+        value = payload.get(key)
+        if value is not None:
+            st.session_state[key] = value
+
+    filtro_spec = payload.get("filtro_spec")
+    if isinstance(filtro_spec, list) and filtro_spec:
+        valid_specs = [x for x in filtro_spec if x in (DEFAULT_SPEC + SPEC_EXTRA)]
+        if valid_specs:
+            st.session_state["filtro_spec"] = valid_specs
+
+    micro_sel = payload.get("microarea_scelta")
+    if isinstance(micro_sel, list):
+        st.session_state["microarea_scelta"] = micro_sel
+        for m in all_microaree:
+            mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
+            st.session_state[mk] = m in micro_sel
+
+    micro_gruppi = payload.get("microarea_gruppi")
+    if isinstance(micro_gruppi, list):
+        st.session_state["microarea_gruppi"] = [g for g in micro_gruppi if g in microarea_tax["groups"]]
+
+    fascia = payload.get("fascia_oraria")
+    if fascia is not None:
+        st.session_state["fascia_oraria"] = fascia
+
+    if fascia == "Personalizzato":
+        t1 = _parse_hhmm_or_none(payload.get("custom_start"))
+        t2 = _parse_hhmm_or_none(payload.get("custom_end"))
+        if t1 and t2 and t2 > t1:
+            st.session_state["custom_start"] = t1
+            st.session_state["custom_end"] = t2
+        else:
+            st.session_state["custom_start"] = None
+            st.session_state["custom_end"] = None
+
+    return payload.get("message") or "Filtri aggiornati da comando vocale."
+
+
+# ---------- PRESET FILTRI -------------------------------------------------------
+# combinazioni di filtri con un nome, in un file SQLite locale: "oggi" come giorno
+# si risolve alla data di apertura. I risultati di oggi li prepara lo scheduler
+# (MATERIALIZZAZIONE PRESET) appena arriva un dataset
+PRESET_DB_PATH = os.getenv("MEDICI_PRESET_DB") or os.path.join(CACHE_DIR, "preset_filtri.sqlite")
+PRESET_GIORNO_OGGI = "oggi"
+PRESET_DEFAULTS = {
+    "ciclo_scelto": "Tutti",
+    "filtro_ultima_visita": "Nessuno",
+    "filtro_spec": DEFAULT_SPEC,
+    "filtro_target": "In target",
+    "filtro_visto": "Non Visto",
+    "giorno_scelto": PRESET_GIORNO_OGGI,
+    "fascia_oraria": "Mattina e Pomeriggio",
+    "custom_start": None,
+    "custom_end": None,
+    "microarea_scelta": [],
+    "microarea_gruppi": [],
+    "provincia_scelta": "Ovunque",
+    "prov_escludi": [],
+    "mese_limite_visita": "Nessuno",
+    "search_query": "",
+    "geo_citta": GEO_NESSUNA,
+    "geo_raggio_km": 0,
+    "geo_ordina": False,
+}
+
+
+def _open_preset_db() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(PRESET_DB_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(PRESET_DB_PATH, timeout=10, check_same_thread=False)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS preset (
+            nome TEXT PRIMARY KEY, stato TEXT NOT NULL, firma TEXT NOT NULL, aggiornato REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS preset_export (
+            nome TEXT, dataset_key TEXT, giorno TEXT, firma TEXT,
+            n_medici INTEGER, n_righe INTEGER, csv BLOB, creato REAL,
+            PRIMARY KEY (nome, dataset_key, giorno)
+        );
+    """)
+    return conn
+
+
+@cache_resource
+def get_preset_scheduler() -> dict:
+    # una connessione per processo, schema creato una volta: sessioni e scheduler la usano a turno
+    return {
+        "lock": threading.Lock(),
+        "db": _open_preset_db(),
+        "db_lock": threading.Lock(),
+        "wake": threading.Event(),
+        "seen": set(),
+        "runs": 0,
+        "materialized": 0,
+        "error": None,
+        "errors": {},
+    }
+
+
+@contextmanager
+def _preset_db():
+    store = get_preset_scheduler()
+    with store["db_lock"]:
+        yield store["db"]
+
+
+def list_filter_presets() -> list[dict]:
+    with _preset_db() as conn:
+        rows = conn.execute("SELECT nome, stato, firma FROM preset ORDER BY nome COLLATE NOCASE").fetchall()
+    return [{"nome": nome, "stato": json.loads(stato), "firma": firma} for nome, stato, firma in rows]
+
+
+def save_filter_preset(nome: str, stato: dict):
+    raw = json.dumps({k: _serialize_value(v) for k, v in stato.items()}, sort_keys=True, ensure_ascii=False)
+    with _preset_db() as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO preset (nome, stato, firma, aggiornato) VALUES (?, ?, ?, ?)",
+            (nome, raw, hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16], time.time()),
+        )
+
+
+def delete_filter_preset(nome: str):
+    with _preset_db() as conn, conn:
+        conn.execute("DELETE FROM preset WHERE nome = ?", (nome,))
+        conn.execute("DELETE FROM preset_export WHERE nome = ?", (nome,))
+
+
+def load_preset_export(nome: str, dataset_key: str, giorno: str) -> Optional[dict]:
+    with _preset_db() as conn:
+        row = conn.execute(
+            "SELECT e.n_medici, e.n_righe, e.csv, e.creato FROM preset_export e "
+            "JOIN preset p ON p.nome = e.nome AND p.firma = e.firma "
+            "WHERE e.nome = ? AND e.dataset_key = ? AND e.giorno = ?",
+            (nome, dataset_key, giorno),
+        ).fetchone()
+    if row is None:
+        return None
+    return {"n_medici": row[0], "n_righe": row[1], "csv": row[2], "creato": row[3]}
+
+
+def wake_preset_scheduler():
+    get_preset_scheduler()["wake"].set()
+
+
+def preset_from_session(giorno_corrente: bool) -> dict:
+    stato = {k: st.session_state.get(k, v) for k, v in PRESET_DEFAULTS.items()}
+    if giorno_corrente:
+        stato["giorno_scelto"] = PRESET_GIORNO_OGGI
+    if stato["fascia_oraria"] != "Personalizzato":
+        stato["custom_start"] = stato["custom_end"] = None
+    return stato
+
+
+def preset_filter_state(stato: dict, now: datetime.datetime) -> dict:
+    # stato completo per la pipeline filtri, con "oggi" e gli orari già risolti
+    state = {k: stato.get(k, v) for k, v in PRESET_DEFAULTS.items()}
+    if state["giorno_scelto"] == PRESET_GIORNO_OGGI:
+        state["giorno_scelto"] = giorni_settimana[now.weekday()] if now.weekday() < 5 else "sempre"
+    for k in ("custom_start", "custom_end"):
+        if isinstance(state[k], str):
+            state[k] = _deserialize_time(state[k])
+    state["search_query"] = str(state["search_query"] or "").strip()
+    state["geo_raggio_km"] = int(state["geo_raggio_km"] or 0)
+    state["geo_ordina"] = bool(state["geo_ordina"])
+    state["pagina_risultati"] = 1
+    return state
+
+
+def apply_filter_preset(nome: str):
+    preset = next((p for p in list_filter_presets() if p["nome"] == nome), None)
+    if preset is None:
+        st.session_state["preset_feedback"] = f"Preset '{nome}' non trovato."
+        return
+
+    state = preset_filter_state(preset["stato"], datetime.datetime.now(timezone))
+    state.pop("pagina_risultati")
+    for k, v in state.items():
+        st.session_state[k] = list(v) if isinstance(v, list) else v
+    if state["fascia_oraria"] != "Personalizzato":
+        st.session_state.pop("custom_start", None)
+        st.session_state.pop("custom_end", None)
+
+    micro_sel = set(state["microarea_scelta"])
+    for m in all_microaree:
+        mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
+        st.session_state[mk] = m in micro_sel
+    st.session_state["preset_feedback"] = f"Preset '{nome}' applicato."
+
+
+with st.expander("⭐ Preset filtri", expanded=bool(st.session_state.get("preset_feedback"))):
+    presets = list_filter_presets()
+    oggi_iso = datetime.datetime.now(timezone).date().isoformat()
+
+    if presets:
+        p1, p2, p3 = st.columns([3, 1, 1])
+        with p1:
+            preset_scelto = st.selectbox("Preset salvati", [p["nome"] for p in presets], key="preset_scelto")
+        with p2:
+            st.button("📂 Apri", on_click=apply_filter_preset, args=(preset_scelto,), key="preset_apri")
+        with p3:
+            st.button("🗑️ Elimina", on_click=delete_filter_preset, args=(preset_scelto,), key="preset_elimina")
+
+        preset_export = load_preset_export(preset_scelto, dataset_key, oggi_iso)
+        if preset_export is not None:
+            pronto = datetime.datetime.fromtimestamp(preset_export["creato"], timezone).strftime("%H:%M")
+            st.download_button(
+                f"📥 Risultati di oggi: {preset_export['n_medici']} medici (pronti dalle {pronto})",
+                preset_export["csv"],
+                f"preset_{re.sub(r'[^A-Za-z0-9]+', '_', preset_scelto).strip('_').lower()}.csv",
+                "text/csv",
+                key="preset_csv",
+            )
+        elif get_preset_scheduler()["errors"].get(preset_scelto):
+            st.caption(f"⚠️ Risultati di oggi non disponibili: {get_preset_scheduler()['errors'][preset_scelto]}")
+        else:
+            st.caption("Risultati di oggi in preparazione per questo file.")
+    else:
+        st.caption("Nessun preset salvato.")
+
+    s1, s2 = st.columns([3, 1])
+    with s1:
+        preset_nome = st.text_input(
+            "Salva i filtri correnti come", placeholder="es. MMG non visti FM oggi", key="preset_nome"
+        )
+    with s2:
+        preset_salva = st.button("💾 Salva", key="preset_salva")
+    preset_oggi = st.checkbox("Giorno: sempre quello corrente", value=True, key="preset_oggi")
+
+    if preset_salva:
+        if preset_nome.strip():
+            save_filter_preset(preset_nome.strip(), preset_from_session(preset_oggi))
+            st.session_state["preset_feedback"] = f"Preset '{preset_nome.strip()}' salvato."
+            wake_preset_scheduler()
+            st.rerun()
+        else:
+            st.warning("Dai un nome al preset.")
+
+    if st.session_state.get("preset_feedback"):
+        st.caption(st.session_state.pop("preset_feedback"))
+
+
+# ---------- COMANDO VOCALE AI ---------------------------------------------------
+st.markdown("""
+<div class="voice-wrap">
+  <div class="voice-title">🎙️ Comando vocale AI</div>
+  <div class="voice-sub">
+    Premi il pulsante, parla, poi ripremilo per fermare.<br>
+    Appena fermi la registrazione, il comando parte da solo.
+  </div>
+</div>
+""", unsafe_allow_html=True)
+
+audio = mic_recorder(
+    start_prompt="🎙️ Avvia comando vocale",
+    stop_prompt="⏹️ Ferma e invia",
+    just_once=True,
+    format="webm",
+    key="voice_recorder_v2",
+)
+
+
+def _get_audio_id(audio_dict: Any):
+    if not isinstance(audio_dict, dict):
+        return None
+    return audio_dict.get("id")
+
+
+audio_id = _get_audio_id(audio)
+
+if "last_processed_audio_id" not in st.session_state:
+    st.session_state["last_processed_audio_id"] = None
+
+if audio and audio_id and audio_id != st.session_state["last_processed_audio_id"]:
+    st.session_state["last_processed_audio_id"] = audio_id
+    try:
+        st.session_state["voice_job_id"] = submit_voice_job(
+            audio["bytes"],
+            ".webm",
+            {
+                "province_list": all_province,
+                "microarea_list": all_microaree,
+                "microarea_gruppi_list": list(microarea_tax["groups"]),
+            },
+            owner=st.session_state.setdefault("voice_owner", os.urandom(4).hex()),
+        )
+    except Exception as e:
+        st.session_state["voice_feedback"] = f"Errore comando vocale: {e}"
+
+
+@st.fragment(run_every=VOICE_POLL_S)
+def voice_job_poller(job_id: str):
+    # solo questo frammento si riesegue mentre il job è in corso; a esito pronto riparte la pagina
+    voice_queue = get_voice_queue()
+    voice_job = voice_queue["jobs"].get(job_id)
+    if voice_job is None or voice_job["event"].is_set():
+        st.rerun()
+    st.caption(f"⏳ {voice_job_label(voice_queue, voice_job)}")
+
+
+# il job sopravvive ai rerun: l'esito si raccoglie al primo giro dopo la fine, anche se tardi
+voice_job_id = st.session_state.get("voice_job_id")
+if voice_job_id:
+    voice_queue = get_voice_queue()
+    voice_job = voice_queue["jobs"].get(voice_job_id)
+    if voice_job is None:
+        st.session_state.pop("voice_job_id", None)
+    elif not voice_job["event"].is_set():
+        voice_job_poller(voice_job_id)
+    else:
+        st.session_state.pop("voice_job_id", None)
+
+        if voice_job["error"]:
+            st.session_state["voice_feedback"] = f"Errore comando vocale: {voice_job['error']}"
+        else:
+            st.session_state["last_voice_transcript"] = voice_job["transcript"]
+            st.session_state["last_voice_payload"] = voice_job["payload"]
+            st.session_state["voice_feedback"] = apply_voice_filters(voice_job["payload"])
+            st.rerun()
+
+if st.session_state.get("last_voice_transcript") or st.session_state.get("voice_feedback"):
+    st.markdown('<div class="voice-result">', unsafe_allow_html=True)
+
+    if st.session_state.get("last_voice_transcript"):
+        st.markdown(
+            f"<div><span class='voice-label'>Hai detto:</span> {st.session_state['last_voice_transcript']}</div>",
+            unsafe_allow_html=True,
+        )
+
+    if st.session_state.get("voice_feedback"):
+        st.markdown(
+            f"<div style='margin-top:6px;'><span class='voice-label'>Esito:</span> {st.session_state['voice_feedback']}</div>",
+            unsafe_allow_html=True,
+        )
+
+    st.markdown("</div>", unsafe_allow_html=True)
+
+st.caption("Esempi: “chi riceve domattina in microarea FM” · “solo MMG oggi pomeriggio” · “azzera tutto”")
+
+
+# ---------- WIDGET FILTRI -------------------------------------------------------
+ciclo_label = f"💠 SELEZIONA CICLO ({today.strftime('%B').capitalize()} {today.year})"
+
+if filtri_in_blocco:
+    # in modalità blocco il ciclo si sceglie nel modulo filtri: qui vale l'ultimo applicato
+    ciclo_scelto = st.session_state.setdefault("ciclo_scelto", ciclo_opts[default_cycle_idx])
+    st.markdown(f"**💠 Ciclo:** {ciclo_scelto}")
+else:
+    ciclo_scelto = st.selectbox(
+        ciclo_label,
+        ciclo_opts,
+        index=default_cycle_idx,
+        key="ciclo_scelto",
+    )
+
+
+# ---------- % MMG VISTI ---------------------------------------------------------
+cycle_aggregates = get_cycle_aggregates(dataset, ciclo_scelto)
+
+try:
+    kpi = cycle_aggregates["kpi"]
+    if kpi is not None:
+        pct, seen_count, total_mmg_target = kpi["pct"], kpi["seen"], kpi["total"]
+
+        st.markdown(f"""
+        <div class="kpi-card">
+          <div class="kpi-top">
+            <div class="kpi-title">% MMG visti (ciclo)</div>
+            <div class="kpi-pct">{pct}%</div>
+          </div>
+          <div class="kpi-bar-outer">
+            <div class="kpi-bar-inner" style="width:{pct}%;"></div>
+          </div>
+          <div class="kpi-sub">{seen_count} / {total_mmg_target}</div>
+        </div>
+        """, unsafe_allow_html=True)
+except Exception:
+    pass
+
+
+# ---------- COPERTURA TERRITORIALE ----------------------------------------------
+CHART_SPEC_CACHE_MAX = 64
+
+
+def coverage_chart_spec(dataset: dict, ciclo: str, territorio_mode: str, top_n: int, min_tot: int):
+    # spec Vega-Lite già serializzata, per (dataset, ciclo, modalità, top_n, min_tot)
+    key = (ciclo, territorio_mode, int(top_n), int(min_tot))
+    specs = dataset.setdefault("chart_specs", OrderedDict())
+    with dataset_lock(dataset, "chart_specs"):
+        cached = specs.get(key)
+        if cached is not None:
+            specs.move_to_end(key)
+            return cached
+
+    label_col = "microarea" if territorio_mode == "Microarea" else "provincia"
+    coverage_df = get_cycle_aggregates(dataset, ciclo)["coverage"][label_col]
+    view_df = coverage_df[coverage_df["medici_totali"] >= int(min_tot)].head(int(top_n)).copy()
+
+    spec = None
+    if not view_df.empty:
+        view_df["copertura_label"] = view_df["copertura_pct"].map(lambda x: f"{x:.1f}%")
+
+        chart = alt.Chart(view_df).mark_bar(cornerRadiusEnd=4).encode(
+            x=alt.X(
+                "copertura_pct:Q",
+                title="Copertura %",
+                scale=alt.Scale(domain=[0, 100]),
+            ),
+            y=alt.Y(
+                f"{label_col}:N",
+                sort="-x",
+                title=None,
+            ),
+            tooltip=[
+                alt.Tooltip(f"{label_col}:N", title=territorio_mode),
+                alt.Tooltip("copertura_pct:Q", title="Copertura %", format=".1f"),
+                alt.Tooltip("medici_visti:Q", title="Visti"),
+                alt.Tooltip("medici_non_visti:Q", title="Non visti"),
+                alt.Tooltip("medici_totali:Q", title="Totali"),
+            ],
+        ).properties(
+            height=max(280, min(900, len(view_df) * 32))
+        )
+
+        text = alt.Chart(view_df).mark_text(
+            align="left",
+            baseline="middle",
+            dx=5,
+        ).encode(
+            x=alt.X("copertura_pct:Q"),
+            y=alt.Y(f"{label_col}:N", sort="-x"),
+            text="copertura_label:N",
+        )
+
+        spec = (chart + text).to_dict()
+
+    with dataset_lock(dataset, "chart_specs"):
+        specs[key] = (spec, view_df)
+        while len(specs) > CHART_SPEC_CACHE_MAX:
+            specs.popitem(last=False)
+    return spec, view_df
+
+
+def coverage_table(view_df: pd.DataFrame, labels: dict):
+    st.dataframe(
+        view_df.rename(columns={
+            **labels,
+            "medici_totali": "MMG totali",
+            "medici_visti": "MMG visti",
+            "medici_non_visti": "MMG non visti",
+            "copertura_pct": "Copertura %",
+        }),
+        use_container_width=True,
+        hide_index=True,
+    )
+
+
+with st.expander("📊 Copertura territoriale (MMG visti per microarea o provincia)", expanded=False):
+    territorio_mode = st.radio(
+        "Raggruppa per",
+        ["Microarea", "Provincia"],
+        horizontal=True,
+        key="territorio_mode",
+    )
+
+    territory_col = "microarea" if territorio_mode == "Microarea" else "provincia"
+    top_key = "territorio_top_n_microarea" if territorio_mode == "Microarea" else "territorio_top_n_provincia"
+    min_tot_key = "territorio_min_tot_microarea" if territorio_mode == "Microarea" else "territorio_min_tot_provincia"
+
+    coverage_df = cycle_aggregates["coverage"][territory_col]
+
+    if coverage_df.empty:
+        st.info(f"Nessun dato disponibile per la vista per {territorio_mode.lower()}.")
+    else:
+        n_territori = len(coverage_df)
+        max_rows = min(50, n_territori)
+        top_n_default = min(15, max_rows)
+
+        if max_rows <= 5:
+            top_n = max_rows
+            st.caption(f"Territori disponibili: {max_rows}")
+        else:
+            if top_key not in st.session_state:
+                st.session_state[top_key] = top_n_default
+
+            st.session_state[top_key] = max(
+                5,
+                min(int(st.session_state[top_key]), max_rows)
+            )
+
+            top_n = st.slider(
+                f"Quanti {territorio_mode.lower()} mostrare",
+                min_value=5,
+                max_value=max_rows,
+                value=int(st.session_state[top_key]),
+                key=top_key,
+            )
+
+        max_medici_tot = int(max(1, coverage_df["medici_totali"].max()))
+
+        if min_tot_key not in st.session_state:
+            st.session_state[min_tot_key] = 1
+
+        st.session_state[min_tot_key] = max(
+            1,
+            min(int(st.session_state[min_tot_key]), max_medici_tot)
+        )
+
+        min_tot = st.number_input(
+            "Mostra solo territori con almeno questo numero di MMG",
+            min_value=1,
+            max_value=max_medici_tot,
+            value=int(st.session_state[min_tot_key]),
+            step=1,
+            key=min_tot_key,
+        )
+
+        spec, view_df = coverage_chart_spec(dataset, ciclo_scelto, territorio_mode, top_n, min_tot)
+
+        if spec is None:
+            st.warning("Nessun territorio rispetta i criteri selezionati.")
+        else:
+            st.vega_lite_chart(spec, use_container_width=True)
+
+            st.caption(
+                "Base di calcolo: solo MMG in target, deduplicati per nominativo "
+                "all'interno del territorio selezionato. "
+                "Un medico è considerato visto se ha almeno una X o una V nel ciclo selezionato."
+            )
+
+            coverage_table(view_df, {territory_col: territorio_mode})
+
+    cube = cycle_aggregates["cube"]
+    if cube:
+        st.markdown("**Dettaglio provincia → microarea → città**")
+
+        prov_opts = ["Tutte"] + sorted(cube["provincia"]["provincia"].tolist())
+        if st.session_state.get("drill_provincia") not in prov_opts:
+            st.session_state["drill_provincia"] = "Tutte"
+        drill_prov = st.selectbox("Provincia", prov_opts, key="drill_provincia")
+
+        if drill_prov == "Tutte":
+            coverage_table(cube["provincia"], {"provincia": "Provincia"})
+        else:
+            micro_df = cube["microarea"][cube["microarea"]["provincia"] == drill_prov]
+            micro_opts = ["Tutte"] + sorted(micro_df["microarea"].tolist())
+            if st.session_state.get("drill_microarea") not in micro_opts:
+                st.session_state["drill_microarea"] = "Tutte"
+            drill_micro = st.selectbox("Microarea", micro_opts, key="drill_microarea")
+
+            if drill_micro == "Tutte":
+                coverage_table(micro_df.drop(columns="provincia"), {"microarea": "Microarea"})
+            else:
+                citta_df = cube["città"]
+                citta_df = citta_df[(citta_df["provincia"] == drill_prov) & (citta_df["microarea"] == drill_micro)]
+                coverage_table(citta_df.drop(columns=["provincia", "microarea"]), {"città": "Città"})
+
+
+# ---------- ANDAMENTO COPERTURA NELL'ANNO ----------------------------------------
+TREND_LEVELS = {"Totale": None, "Microarea": "microarea", "Provincia": "provincia"}
+TREND_DEFAULT_TERRITORI = 5
+
+
+def coverage_trend(dataset: dict, level: str) -> pd.DataFrame:
+    # copertura cumulata mese per mese: OR cumulativo sulle 12 colonne di visita
+    # degli MMG in target, poi primo mese di visita per (territorio, medico)
+    trend_cache = dataset.setdefault("coverage_trend", {})
+    if level not in trend_cache:
+        with dataset_lock(dataset, "coverage_trend"):
+            if level not in trend_cache:
+                trend_cache[level] = _build_coverage_trend(dataset, level)
+    return trend_cache[level]
+
+
+def _build_coverage_trend(dataset: dict, level: str) -> pd.DataFrame:
+    df = dataset["df"]
+    phys_id = dataset["phys_id"]
+    is_mmg = df.get("spec", pd.Series("", index=df.index)).astype(str).str.strip().str.upper() == "MMG"
+    is_in_target = df.get("in target", pd.Series("", index=df.index)).astype(str).str.strip().str.lower() == "x"
+    base = (is_mmg & is_in_target).to_numpy() & (phys_id >= 0)
+
+    col = TREND_LEVELS[level]
+    if col is None:
+        terr_codes, labels = np.zeros(len(df), dtype=np.int64), pd.Index(["Totale"])
+    else:
+        values = df.get(col, pd.Series("", index=df.index)).astype(str).str.strip()
+        base &= (values.ne("") & values.str.lower().ne("nan")).to_numpy()
+        terr_codes, labels = pd.factorize(values)
+        labels = pd.Index(labels)
+
+    if not base.any():
+        return pd.DataFrame()
+
+    n_months = len(mesi)
+    cum_seen = np.logical_or.accumulate(dataset["visit"][base] > 0, axis=1)
+    first_month = n_months - cum_seen.sum(axis=1)
+
+    pair = terr_codes[base].astype(np.int64) * (int(phys_id.max()) + 1) + phys_id[base]
+    pairs, inv = np.unique(pair, return_inverse=True)
+    pair_first = np.full(len(pairs), n_months, dtype=np.int64)
+    np.minimum.at(pair_first, inv, first_month)
+    pair_terr = pairs // (int(phys_id.max()) + 1)
+
+    n_terr = len(labels)
+    new_visits = np.bincount(pair_terr * (n_months + 1) + pair_first, minlength=n_terr * (n_months + 1))
+    new_visits = new_visits.reshape(n_terr, n_months + 1)[:, :n_months]
+    totals = np.bincount(pair_terr, minlength=n_terr)
+    cumulative = new_visits.cumsum(axis=1)
+
+    keep = totals > 0
+    trend = pd.DataFrame({
+        "territorio": np.repeat(labels.to_numpy()[keep], n_months),
+        "mese": np.tile([m.capitalize() for m in mesi], int(keep.sum())),
+        "medici_totali": np.repeat(totals[keep], n_months),
+        "nuovi_visti": new_visits[keep].ravel(),
+        "visti_cumulati": cumulative[keep].ravel(),
+    })
+    trend["copertura_pct"] = (trend["visti_cumulati"] / trend["medici_totali"] * 100).round(1)
+    return trend
+
+
+with st.expander("📈 Andamento copertura nell'anno (MMG in target)", expanded=False):
+    trend_mode = st.radio(
+        "Raggruppa per",
+        list(TREND_LEVELS.keys()),
+        horizontal=True,
+        key="trend_mode",
+    )
+    trend_df = coverage_trend(dataset, trend_mode)
+
+    if trend_df.empty:
+        st.info("Nessun dato disponibile per l'andamento della copertura.")
+    else:
+        if trend_mode != "Totale":
+            territori = (
+                trend_df.drop_duplicates("territorio")
+                .sort_values(["medici_totali", "territorio"], ascending=[False, True])["territorio"]
+                .tolist()
+            )
+            sel_key = f"trend_territori_{TREND_LEVELS[trend_mode]}"
+            current = [t for t in st.session_state.get(sel_key, territori[:TREND_DEFAULT_TERRITORI]) if t in territori]
+            st.session_state[sel_key] = current
+            scelti = st.multiselect(f"{trend_mode} da confrontare", territori, key=sel_key)
+            trend_df = trend_df[trend_df["territorio"].isin(scelti)]
+
+        if trend_df.empty:
+            st.warning("Seleziona almeno un territorio.")
+        else:
+            mesi_label = [m.capitalize() for m in mesi]
+            line = alt.Chart(trend_df).mark_line(point=True).encode(
+                x=alt.X("mese:N", sort=mesi_label, title=None),
+                y=alt.Y("copertura_pct:Q", title="Copertura cumulata %", scale=alt.Scale(domain=[0, 100])),
+                color=alt.Color("territorio:N", title=trend_mode),
+                tooltip=[
+                    alt.Tooltip("territorio:N", title=trend_mode),
+                    alt.Tooltip("mese:N", title="Mese"),
+                    alt.Tooltip("copertura_pct:Q", title="Copertura %", format=".1f"),
+                    alt.Tooltip("visti_cumulati:Q", title="Visti da inizio anno"),
+                    alt.Tooltip("medici_totali:Q", title="Totali"),
+                ],
+            ).properties(height=320)
+            st.altair_chart(line, use_container_width=True)
+
+            bars = alt.Chart(trend_df).mark_bar().encode(
+                x=alt.X("mese:N", sort=mesi_label, title=None),
+                y=alt.Y("nuovi_visti:Q", title="Nuovi MMG visti nel mese"),
+                color=alt.Color("territorio:N", title=trend_mode),
+                tooltip=[
+                    alt.Tooltip("territorio:N", title=trend_mode),
+                    alt.Tooltip("mese:N", title="Mese"),
+                    alt.Tooltip("nuovi_visti:Q", title="Nuovi visti"),
+                ],
+            ).properties(height=220)
+            st.altair_chart(bars, use_container_width=True)
+
+            st.caption(
+                "Un medico conta come visto dal primo mese dell'anno con una X o una V; "
+                "i nuovi visti sono i medici visti per la prima volta in quel mese."
+            )
+
+
+# ---------- CONFRONTO TRA CICLI --------------------------------------------------
+# un byte per (territorio, medico): bit c = visto nel ciclo c+1, bit 4+c = VIP nel ciclo c+1,
+# in OR sulle righe del medico. Ogni domanda è una maschera: (bit & (richiesti | esclusi)) == richiesti
+CONFRONTO_CICLI = list(month_cycles)
+CONFRONTO_OPS = ["In A ma non in B", "In entrambi", "In B ma non in A", "In tutti i cicli"]
+CONFRONTO_STATI = {"Visto": 0, "Visita VIP": 4}
+
+
+def cycle_status_bits(visit: np.ndarray) -> np.ndarray:
+    month_idx = np.array([[mesi.index(m) for m in month_cycles[c]] for c in CONFRONTO_CICLI])
+    by_cycle = visit[:, month_idx]
+    flags = np.concatenate([(by_cycle > 0).any(axis=2), (by_cycle == 2).any(axis=2)], axis=1)
+    return np.packbits(flags, axis=1, bitorder="little")[:, 0]
+
+
+def cycle_bitset_groups(dataset: dict, level: str, solo_target: bool) -> dict:
+    cache = dataset.setdefault("cycle_bitsets", {})
+    if (level, solo_target) not in cache:
+        with dataset_lock(dataset, "cycle_bitsets"):
+            if (level, solo_target) not in cache:
+                cache[(level, solo_target)] = _build_cycle_bitset_groups(dataset, level, solo_target)
+    return cache[(level, solo_target)]
+
+
+def _build_cycle_bitset_groups(dataset: dict, level: str, solo_target: bool) -> dict:
+    df = dataset["df"]
+    phys_id = dataset["phys_id"]
+    base = phys_id >= 0
+    if solo_target:
+        is_mmg = df.get("spec", pd.Series("", index=df.index)).astype(str).str.strip().str.upper() == "MMG"
+        is_in_target = df.get("in target", pd.Series("", index=df.index)).astype(str).str.strip().str.lower() == "x"
+        base &= (is_mmg & is_in_target).to_numpy()
+
+    col = TREND_LEVELS[level]
+    if col is None:
+        terr_codes, labels = np.zeros(len(df), dtype=np.int64), pd.Index(["Totale"])
+    else:
+        values = df.get(col, pd.Series("", index=df.index)).astype(str).str.strip()
+        base &= (values.ne("") & values.str.lower().ne("nan")).to_numpy()
+        terr_codes, labels = pd.factorize(values)
+        labels = pd.Index(labels)
+
+    if "cycle_bits" not in dataset:
+        dataset["cycle_bits"] = cycle_status_bits(dataset["visit"])
+
+    rows = np.flatnonzero(base)
+    stride = int(phys_id.max()) + 1 if len(phys_id) else 1
+    pairs, first, inv = np.unique(
+        terr_codes[rows].astype(np.int64) * stride + phys_id[rows], return_index=True, return_inverse=True
+    )
+    bits = np.zeros(len(pairs), dtype=np.uint8)
+    np.bitwise_or.at(bits, inv, dataset["cycle_bits"][rows])
+
+    return {"bits": bits, "terr": pairs // stride, "row": rows[first], "labels": labels}
+
+
+def cycle_query_masks(ciclo_a: str, ciclo_b: str, stato: str, op: str) -> tuple[int, int]:
+    shift = CONFRONTO_STATI[stato]
+    bit_a = 1 << (CONFRONTO_CICLI.index(ciclo_a) + shift)
+    bit_b = 1 << (CONFRONTO_CICLI.index(ciclo_b) + shift)
+    if op == "In A ma non in B":
+        return bit_a, bit_b
+    if op == "In B ma non in A":
+        return bit_b, bit_a
+    if op == "In entrambi":
+        return bit_a | bit_b, 0
+    return 0b1111 << shift, 0
+
+
+def compare_cycles(groups: dict, ciclo_a: str, ciclo_b: str, stato: str, op: str) -> tuple[np.ndarray, pd.DataFrame]:
+    required, excluded = cycle_query_masks(ciclo_a, ciclo_b, stato, op)
+    bits = groups["bits"]
+    # con A == B "in A ma non in B" deve restare vuoto: required ed excluded si controllano a parte
+    match = ((bits & required) == required) & ((bits & excluded) == 0)
+
+    shift = CONFRONTO_STATI[stato]
+    in_a = (bits >> (CONFRONTO_CICLI.index(ciclo_a) + shift)) & 1
+    in_b = (bits >> (CONFRONTO_CICLI.index(ciclo_b) + shift)) & 1
+    n_terr = len(groups["labels"])
+    counts = pd.DataFrame({
+        "territorio": groups["labels"],
+        "medici_totali": np.bincount(groups["terr"], minlength=n_terr),
+        "in_a": np.bincount(groups["terr"], weights=in_a, minlength=n_terr).astype(int),
+        "in_b": np.bincount(groups["terr"], weights=in_b, minlength=n_terr).astype(int),
+        "risultato": np.bincount(groups["terr"], weights=match, minlength=n_terr).astype(int),
+    })
+    counts = counts[counts["medici_totali"] > 0]
+    counts["risultato_pct"] = (counts["risultato"] / counts["medici_totali"] * 100).round(1)
+    counts = counts.sort_values(["risultato", "territorio"], ascending=[False, True]).reset_index(drop=True)
+    return match, counts
+
+
+with st.expander("🔀 Confronto tra cicli (chi è stato visto in un ciclo e non in un altro)", expanded=False):
+    cc1, cc2 = st.columns(2)
+    with cc1:
+        confronto_a = st.selectbox("Ciclo A", CONFRONTO_CICLI, index=0, key="confronto_a")
+    with cc2:
+        confronto_b = st.selectbox("Ciclo B", CONFRONTO_CICLI, index=1, key="confronto_b")
+    cc3, cc4 = st.columns(2)
+    with cc3:
+        confronto_stato = st.radio("Stato", list(CONFRONTO_STATI), horizontal=True, key="confronto_stato")
+    with cc4:
+        confronto_livello = st.radio("Conta per", list(TREND_LEVELS), horizontal=True, key="confronto_livello")
+    confronto_op = st.radio("Medici", CONFRONTO_OPS, horizontal=True, key="confronto_op")
+    confronto_target = st.checkbox("Solo MMG in target", value=True, key="confronto_target")
+
+    if confronto_a == confronto_b and confronto_op != "In tutti i cicli":
+        st.info("Stesso ciclo in A e B: scegli due cicli diversi per confrontarli.")
+
+    mancanti = [c for c in CONFRONTO_CICLI if not cycle_visit_cols(c, df_mmg.columns)]
+    if mancanti:
+        st.caption(f"Mesi assenti nel file per: {', '.join(mancanti)} (contano come non visti).")
+
+    medici_groups = cycle_bitset_groups(dataset, "Totale", confronto_target)
+    medici_match, _ = compare_cycles(medici_groups, confronto_a, confronto_b, confronto_stato, confronto_op)
+    _, confronto_counts = compare_cycles(
+        cycle_bitset_groups(dataset, confronto_livello, confronto_target),
+        confronto_a, confronto_b, confronto_stato, confronto_op,
+    )
+
+    etichetta_a = confronto_a.split(" (")[0]
+    etichetta_b = confronto_b.split(" (")[0]
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Medici considerati", len(medici_groups["bits"]))
+    m2.metric("Risultato", int(medici_match.sum()))
+    m3.metric(
+        "Sul totale",
+        f"{(medici_match.mean() * 100) if len(medici_match) else 0:.1f}%",
+    )
+
+    if confronto_livello != "Totale":
+        st.dataframe(
+            confronto_counts.rename(columns={
+                "territorio": confronto_livello,
+                "medici_totali": "medici",
+                "in_a": f"{confronto_stato} {etichetta_a}",
+                "in_b": f"{confronto_stato} {etichetta_b}",
+                "risultato": "risultato",
+                "risultato_pct": "risultato %",
+            }),
+            use_container_width=True,
+            hide_index=True,
+        )
+
+    if medici_match.any():
+        righe = medici_groups["row"][medici_match]
+        cols_elenco = [c for c in ["nome medico", "città", "microarea", "provincia", "spec"] if c in df_mmg.columns]
+        df_confronto = df_mmg.iloc[righe][cols_elenco]
+        with st.expander(f"Elenco medici ({len(righe)})"):
+            st.dataframe(df_confronto, use_container_width=True, hide_index=True)
+        st.download_button(
+            "📥 Scarica elenco CSV",
+            df_confronto.to_csv(index=False).encode("utf-8"),
+            "confronto_cicli.csv",
+            "text/csv",
+            key="confronto_csv",
+        )
+    st.caption(
+        "Ogni medico è contato una volta per territorio: visto (X o V) o VIP (V) in un ciclo "
+        "se lo è in almeno un mese del ciclo, su una qualsiasi delle sue righe."
+    )
+
+
+# ---------- PIPELINE FILTRI ----------------------------------------------------
+FILTER_STATE_KEYS = [
+    "ciclo_scelto",
+    "filtro_ultima_visita",
+    "filtro_spec",
+    "filtro_target",
+    "filtro_visto",
+    "giorno_scelto",
+    "fascia_oraria",
+    "custom_start",
+    "custom_end",
+    "microarea_scelta",
+    "microarea_gruppi",
+    "provincia_scelta",
+    "prov_escludi",
+    "mese_limite_visita",
+    "search_query",
+    "geo_citta",
+    "geo_raggio_km",
+    "geo_ordina",
+    "pagina_risultati",
+]
+
+FILTER_CACHE_MAX_BYTES = int(os.getenv("MEDICI_FILTER_CACHE_MB", "256")) * 1024 * 1024
+FILTER_CACHE_MAX_ENTRIES = 512
+
+
+def canonical_filter_state(state: dict) -> str:
+    canon = {}
+    for k in FILTER_STATE_KEYS:
+        v = state.get(k)
+        if isinstance(v, (list, tuple, set)):
+            v = sorted(str(x) for x in v)
+        canon[k] = _serialize_value(v)
+
+    if canon["fascia_oraria"] != "Personalizzato":
+        canon["custom_start"] = canon["custom_end"] = None
+    canon["search_query"] = str(canon["search_query"] or "").strip().lower()
+    if canon["provincia_scelta"] is not None:
+        canon["provincia_scelta"] = str(canon["provincia_scelta"]).lower()
+    if canon["geo_citta"] in (None, GEO_NESSUNA):
+        canon["geo_citta"], canon["geo_raggio_km"], canon["geo_ordina"] = None, 0, False
+
+    return json.dumps(canon, sort_keys=True, ensure_ascii=False)
+
+
+def _time_to_min(t: datetime.time) -> float:
+    return t.hour * 60 + t.minute + t.second / 60
+
+
+def dataset_search_text(dataset: dict) -> pd.Series:
+    text = dataset.get("search_text")
+    if text is None:
+        with dataset_lock(dataset, "search_text"):
+            text = dataset.get("search_text")
+            if text is None:
+                df = dataset["df"].drop(columns=["provincia"], errors="ignore")
+                text = pd.Series("", index=df.index)
+                for j, col in enumerate(df.columns):
+                    text = text + ("" if j == 0 else " ") + df[col].astype(str)
+                text = text.str.lower()
+                dataset["search_text"] = text
+    return text
+
+
+def day_slot_cols(columns, giorno_scelto: str, fascia_oraria: str) -> list[str]:
+    giorni = giorni_settimana if giorno_scelto == "sempre" else [giorno_scelto]
+    cols = []
+    for g in giorni:
+        if fascia_oraria in ["Mattina", "Mattina e Pomeriggio"]:
+            cols.append(f"{g} mattina")
+        if fascia_oraria in ["Pomeriggio", "Mattina e Pomeriggio"]:
+            cols.append(f"{g} pomeriggio")
+        if fascia_oraria == "Personalizzato":
+            for suf in ["mattina", "pomeriggio"]:
+                col = f"{g} {suf}"
+                if col in columns:
+                    cols.append(col)
+
+    return [c.lower() for c in cols if c.lower() in columns]
+
+
+def filtra_giorno_fascia(dataset: dict, giorno_scelto: str, fascia_oraria: str, custom_start, custom_end):
+    df_base = dataset["df"]
+    cols = day_slot_cols(df_base.columns, giorno_scelto, fascia_oraria)
+    if not cols:
+        return None, []
+
+    if fascia_oraria == "Personalizzato":
+        idx = [DAY_SLOT_COLS.index(c) for c in cols]
+        start_min, end_min = _time_to_min(custom_start), _time_to_min(custom_end)
+        return rows_covering(dataset, idx, start_min, end_min), cols
+
+    return df_base[cols].notna().any(axis=1).to_numpy(), cols
+
+
+def base_filter_masks(dataset: dict, state: dict) -> dict:
+    df = dataset["df"]
+    masks = {}
+
+    if state["filtro_ultima_visita"] != "Nessuno":
+        masks["ultima_visita"] = dataset["ultima_num"] <= month_order[state["filtro_ultima_visita"].lower()]
+
+    masks["spec"] = df["spec"].isin(state["filtro_spec"]).to_numpy()
+
+    is_in = (df["in target"].astype(str).str.strip().str.lower() == "x").to_numpy()
+    if state["filtro_target"] == "In target":
+        masks["target"] = is_in
+    elif state["filtro_target"] == "Non in target":
+        masks["target"] = ~is_in
+
+    aggregates = get_cycle_aggregates(dataset, state["ciclo_scelto"])
+    if state["filtro_visto"] == "Visto":
+        masks["visto"] = aggregates["seen"]
+    elif state["filtro_visto"] == "Non Visto":
+        masks["visto"] = ~aggregates["seen"]
+    elif state["filtro_visto"] == "Visita VIP":
+        masks["visto"] = aggregates["vip"]
+
+    return masks
+
+
+def build_filter_masks(dataset: dict, state: dict):
+    df = dataset["df"]
+    n_rows = len(df)
+    masks = base_filter_masks(dataset, state)
+
+    giorno_mask, slot_cols = filtra_giorno_fascia(
+        dataset,
+        state["giorno_scelto"],
+        state["fascia_oraria"],
+        state.get("custom_start"),
+        state.get("custom_end"),
+    )
+    if giorno_mask is None:
+        return None, []
+    masks["giorno_fascia"] = giorno_mask
+
+    micro_gruppi = state.get("microarea_gruppi") or []
+    if (state["microarea_scelta"] or micro_gruppi) and "microarea" in df.columns:
+        masks["microarea"] = microarea_mask(dataset, state["microarea_scelta"], micro_gruppi)
+
+    prov_sel = state["provincia_scelta"]
+    if prov_sel.lower() != "ovunque" and "provincia" in df.columns:
+        masks["provincia"] = (df["provincia"].str.lower() == prov_sel.lower()).to_numpy()
+
+    if state["prov_escludi"] and "provincia" in df.columns:
+        excl_set = {str(p).strip().lower() for p in state["prov_escludi"]}
+        masks["prov_escludi"] = ~df["provincia"].astype(str).str.strip().str.lower().isin(excl_set).to_numpy()
+
+    if state["mese_limite_visita"] != "Nessuno":
+        masks["mese_limite"] = dataset["ultima_num"] <= month_order[state["mese_limite_visita"].lower()]
+
+    if state["search_query"]:
+        q = state["search_query"].lower()
+        masks["ricerca"] = dataset_search_text(dataset).str.contains(q, regex=False).to_numpy()
+
+    centro = gazetteer_point(state.get("geo_citta"))
+    if centro is not None and state.get("geo_raggio_km"):
+        vicini = np.zeros(n_rows, dtype=bool)
+        vicini[rows_within_km(dataset_geo(dataset), *centro, state["geo_raggio_km"])] = True
+        masks["distanza"] = vicini
+
+    for name, m in masks.items():
+        if m.shape != (n_rows,):
+            raise ValueError(f"Maschera '{name}' non allineata al dataset.")
+
+    return masks, slot_cols
+
+
+FACET_COLUMNS = {
+    "spec": "spec",
+    "microarea": "microarea",
+    "provincia": "provincia",
+    "prov_escludi": "provincia",
+}
+
+
+def leave_one_out_masks(masks: dict, n_rows: int) -> dict:
+    names = list(masks.keys())
+    prefix = [np.ones(n_rows, dtype=bool)]
+    for name in names:
+        prefix.append(prefix[-1] & masks[name])
+    suffix = [np.ones(n_rows, dtype=bool)]
+    for name in reversed(names):
+        suffix.append(suffix[-1] & masks[name])
+    suffix = suffix[::-1]
+
+    out = {name: prefix[i] & suffix[i + 1] for i, name in enumerate(names)}
+    out["__all__"] = prefix[-1]
+    return out
+
+
+def facet_counts(dataset: dict, masks: dict) -> dict:
+    # medici distinti per opzione, dati tutti gli altri filtri attivi
+    df = dataset["df"]
+    loo = leave_one_out_masks(masks, len(df))
+    phys_codes = dataset["phys_id"]
+    n_phys = max(1, dataset["n_phys"])
+
+    facets = {}
+    for facet, col in FACET_COLUMNS.items():
+        if col not in df.columns:
+            facets[facet] = {}
+            continue
+        opt_codes, opt_uniques = dataset_codes(dataset, col)
+        sel = loo.get(facet, loo["__all__"]) & (opt_codes >= 0) & (phys_codes >= 0)
+        pairs = np.unique(opt_codes[sel].astype(np.int64) * n_phys + phys_codes[sel])
+        counts = np.bincount(pairs // n_phys, minlength=len(opt_uniques))
+        facets[facet] = dict(zip(opt_uniques.astype(str), counts.tolist()))
+        if facet == "microarea":
+            facets["microarea_gruppi"] = microarea_group_counts(
+                dataset_microarea_taxonomy(dataset), pairs // n_phys, pairs % n_phys
+            )
+    facets.setdefault("microarea_gruppi", {})
+    return facets
+
+
+def combine_masks(masks: dict, n_rows: int, exclude: tuple = ()) -> np.ndarray:
+    out = np.ones(n_rows, dtype=bool)
+    for name, m in masks.items():
+        if name not in exclude:
+            out &= m
+    return out
+
+
+def display_slot_cols(df: pd.DataFrame, slot_cols: list[str], state: dict) -> list[str]:
+    colonne = list(slot_cols)
+    custom_start = state.get("custom_start")
+    if state["fascia_oraria"] == "Personalizzato" and custom_start is not None:
+        if custom_start.hour < 13:
+            colonne = [c for c in colonne if "mattina" in c.lower()]
+        else:
+            colonne = [c for c in colonne if "pomeriggio" in c.lower()]
+
+    if not colonne:
+        colonne = [c for c in df.columns if any(x in c for x in ["mattina", "pomeriggio"])]
+    return colonne
+
+
+def shape_filter_result(dataset: dict, state: dict, pos: np.ndarray, colonne: list[str], distanza=None):
+    df = dataset["df"]
+    visto_idx = [mesi.index(c) for c in cycle_visit_cols(state["ciclo_scelto"], df.columns)]
+    visit = dataset["visit"][pos][:, visto_idx]
+
+    result = df.iloc[pos].copy()
+    result["Visite ciclo"] = (visit > 0).sum(axis=1)
+    vip = (visit == 2).any(axis=1)
+    result["nome medico"] = np.where(vip, result["nome medico"].astype(str) + " (VIP)", result["nome medico"])
+    if distanza is not None:
+        result["distanza km"] = np.round(distanza, 1)
+
+    colonne_da_mostrare = ["nome medico", "città", "distanza km"] + colonne + [
+        "indirizzo ambulatorio", "microarea", "provincia", "ultima visita", MERGE_SOURCE_COL
+    ]
+    return result, [c for c in colonne_da_mostrare if c in result.columns]
+
+
+def run_filter_pipeline(dataset: dict, state: dict) -> dict:
+    if use_sql_backend(dataset):
+        return run_filter_query_sql(dataset, state)
+
+    df = dataset["df"]
+    masks, slot_cols = build_filter_masks(dataset, state)
+    if masks is None:
+        return {"error": "Le colonne per il filtro giorno/fascia non esistono nel file."}
+
+    mask = combine_masks(masks, len(df))
+    pos = np.flatnonzero(mask)
+    pos_senza_orario = np.flatnonzero(combine_masks(masks, len(df), exclude=("giorno_fascia",)))
+
+    colonne = display_slot_cols(df, slot_cols, state)
+
+    # ordinamento: prima chi non è visto da più tempo, poi per inizio ricevimento
+    start_idx = [DAY_SLOT_COLS.index(c) for c in colonne if c in DAY_SLOT_COLS]
+    if start_idx:
+        starts = dataset["slot_start"][pos][:, start_idx]
+        has_start = ~np.isnan(starts).all(axis=1)
+        first_start = np.full(len(pos), 23 * 60 + 59, dtype=float)
+        first_start[has_start] = np.nanmin(starts[has_start], axis=1)
+    else:
+        first_start = np.full(len(pos), 23 * 60 + 59, dtype=float)
+
+    centro = gazetteer_point(state.get("geo_citta"))
+    distanza = None
+    if centro is not None:
+        distanza = distances_km(dataset_geo(dataset), *centro)
+
+    if distanza is not None and state.get("geo_ordina"):
+        order = np.lexsort((first_start, dataset["ultima_num"][pos], np.nan_to_num(distanza[pos], nan=np.inf)))
+    else:
+        order = np.lexsort((first_start, dataset["ultima_num"][pos]))
+    pos = pos[order]
+
+    result, colonne_da_mostrare = shape_filter_result(
+        dataset, state, pos, colonne, None if distanza is None else distanza[pos]
+    )
+
+    return {
+        "df": result,
+        "facets": facet_counts(dataset, masks),
+        "pos": pos,
+        "pos_senza_orario": pos_senza_orario,
+        "colonne": colonne_da_mostrare,
+        "n_medici": count_physicians(dataset["phys_id"][pos]),
+        "n_righe": len(pos),
+    }
 
-audio = mic_recorder(
-    start_prompt="🎙️ Avvia comando vocale",
-    stop_prompt="⏹️ Ferma e invia",
-    just_once=True,
-    format="webm",
-    key="voice_recorder_v2",
-)
 
+@cache_resource
+def get_filter_result_cache() -> dict:
+    return {
+        "lock": threading.Lock(),
+        "entries": OrderedDict(),
+        "bytes": 0,
+        "hits": 0,
+        "misses": 0,
+        "evictions": 0,
+    }
 
-def _get_audio_id(audio_dict: Any):
-    if not isinstance(audio_dict, dict):
-        return None
-    return audio_dict.get("id")
 
+register_metrics_source("filter_results", get_filter_result_cache())
 
-audio_id = _get_audio_id(audio)
 
-if "last_processed_audio_id" not in st.session_state:
-    st.session_state["last_processed_audio_id"] = None
+def _filter_result_nbytes(result: dict) -> int:
+    if "df" not in result:
+        return 1024
+    return (
+        int(result["df"].memory_usage(deep=True).sum())
+        + result["pos"].nbytes
+        + result["pos_senza_orario"].nbytes
+    )
 
-if audio and audio_id and audio_id != st.session_state["last_processed_audio_id"]:
+
+def _filter_cache_key(dataset: dict, state: dict) -> tuple:
+    sql_backend = use_sql_backend(dataset)
+    # con pandas il risultato è l'intera selezione: la pagina non deve moltiplicare le voci in cache
+    if not sql_backend:
+        state = {**state, "pagina_risultati": None}
+    return (dataset["key"], sql_backend, canonical_filter_state(state))
+
+
+def store_filter_result(dataset: dict, state: dict, result: dict):
+    cache = get_filter_result_cache()
+    key = _filter_cache_key(dataset, state)
+    size = _filter_result_nbytes(result)
+
+    with cache["lock"]:
+        if key not in cache["entries"] and size <= FILTER_CACHE_MAX_BYTES:
+            cache["entries"][key] = (result, size)
+            cache["bytes"] += size
+            while cache["bytes"] > FILTER_CACHE_MAX_BYTES or len(cache["entries"]) > FILTER_CACHE_MAX_ENTRIES:
+                _, (_, old_size) = cache["entries"].popitem(last=False)
+                cache["bytes"] -= old_size
+                cache["evictions"] += 1
+
+
+def cached_filter_results(dataset: dict, state: dict) -> tuple[dict, bool]:
+    cache = get_filter_result_cache()
+    key = _filter_cache_key(dataset, state)
+
+    with cache["lock"]:
+        hit = cache["entries"].get(key)
+        if hit is not None:
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+            return hit[0], True
+        cache["misses"] += 1
+
+    result = run_filter_pipeline(dataset, state)
+    store_filter_result(dataset, state, result)
+    return result, False
+
+
+# ---------- BACKEND SQL (DATASET MOLTO GRANDI) ---------------------------------
+# oltre SQL_BACKEND_MIN_ROWS righe (o con MEDICI_SQL_BACKEND=1) i filtri diventano una
+# query SQLite: in Python tornano solo la pagina visibile e gli aggregati
+SQL_BACKEND = os.getenv("MEDICI_SQL_BACKEND", "auto").strip().lower()
+SQL_BACKEND_MIN_ROWS = int(os.getenv("MEDICI_SQL_MIN_ROWS", "200000"))
+SQL_SCHEMA_VERSION = 2
+SQL_PAGE_ROWS = 500
+SQL_NO_START_MIN = 23 * 60 + 59
+
+
+def use_sql_backend(dataset: dict) -> bool:
+    if SQL_BACKEND in ("1", "on", "sqlite"):
+        return True
+    if SQL_BACKEND in ("0", "off", "pandas"):
+        return False
+    return len(dataset["df"]) >= SQL_BACKEND_MIN_ROWS
+
+
+def _sql_path(key: str) -> str:
+    return os.path.join(DATASET_SNAPSHOT_DIR, f"{key}.v{SQL_SCHEMA_VERSION}.sqlite")
+
+
+def _build_sql_table(dataset: dict, path: str):
+    df = dataset["df"]
+    n = len(df)
+    geo = dataset_geo(dataset)
+    xyz = np.full((n, 3), np.nan)
+    xyz[geo["located"]] = geo["xyz"]
+
+    def col(name):
+        return df[name] if name in df.columns else pd.Series(np.nan, index=df.index)
+
+    provincia = col("provincia")
+    table = pd.DataFrame({
+        "pos": np.arange(n),
+        "phys_id": dataset["phys_id"],
+        "spec": col("spec").to_numpy(),
+        "in_target": (col("in target").astype(str).str.strip().str.lower() == "x").astype(int).to_numpy(),
+        "microarea": col("microarea").to_numpy(),
+        "provincia": provincia.to_numpy(),
+        "prov_l": provincia.str.lower().to_numpy() if provincia.dtype == object else None,
+        "prov_sl": provincia.astype(str).str.strip().str.lower().to_numpy(),
+        "ultima_num": dataset["ultima_num"].astype(int),
+        "search": dataset_search_text(dataset).to_numpy(),
+        "x": xyz[:, 0],
+        "y": xyz[:, 1],
+        "z": xyz[:, 2],
+    })
+    for m in range(len(mesi)):
+        table[f"v{m}"] = dataset["visit"][:, m].astype(int)
+    for i, c in enumerate(DAY_SLOT_COLS):
+        table[f"n{i}"] = col(c).notna().astype(int).to_numpy()
+        table[f"s{i}"] = dataset["slot_start"][:, i]
+        table[f"e{i}"] = dataset["slot_end"][:, i]
+
+    columns = ", ".join(
+        f"{c} INTEGER PRIMARY KEY" if c == "pos" else c for c in table.columns
+    )
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
     try:
-        with st.spinner("Trascrivo e applico i filtri..."):
-            transcript = transcribe_voice_command_from_bytes(audio_bytes=audio["bytes"], suffix=".webm")
-            payload = interpret_voice_command_to_filters(
-                command_text=transcript,
-                province_list=all_province,
-                microarea_list=all_microaree,
-            )
-            msg = apply_voice_filters(payload)
+        conn.execute(f"CREATE TABLE medici ({columns})")
+        table.to_sql("medici", conn, if_exists="append", index=False, chunksize=50_000)
+        for name in ["spec", "in_target", "prov_l", "microarea"]:
+            conn.execute(f"CREATE INDEX idx_{name} ON medici ({name})")
+        conn.execute("CREATE TABLE intervalli (pos INTEGER, slot INTEGER, s INTEGER, e INTEGER)")
+        pd.DataFrame({
+            "pos": dataset["iv_row"],
+            "slot": dataset["iv_slot"],
+            "s": dataset["iv_start"],
+            "e": dataset["iv_end"],
+        }).to_sql("intervalli", conn, if_exists="append", index=False, chunksize=50_000)
+        conn.execute("CREATE INDEX idx_intervalli ON intervalli (slot, s, e)")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+def dataset_sql(dataset: dict) -> dict:
+    sql = dataset.get("sql")
+    if sql is None:
+        with dataset_lock(dataset, "sql"):
+            sql = dataset.get("sql")
+            if sql is None:
+                path = _sql_path(dataset["key"])
+                if not os.path.exists(path):
+                    with shared_dataset_lock(f"{dataset['key']}.sql"):
+                        if not os.path.exists(path):
+                            os.makedirs(DATASET_SNAPSHOT_DIR, exist_ok=True)
+                            _build_sql_table(dataset, path)
+                conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+                sql = {"conn": conn, "lock": threading.Lock(), "path": path}
+                dataset["sql"] = sql
+    return sql
+
+
+def _sql_in(column: str, values) -> tuple[str, list]:
+    values = list(values)
+    if not values:
+        return "0", []
+    return f"{column} IN ({', '.join('?' * len(values))})", values
+
+
+def compile_filter_clauses(dataset: dict, state: dict):
+    # stesse condizioni di build_filter_masks, una clausola WHERE per filtro
+    df = dataset["df"]
+    clauses = {}
+
+    if state["filtro_ultima_visita"] != "Nessuno":
+        clauses["ultima_visita"] = ("ultima_num <= ?", [month_order[state["filtro_ultima_visita"].lower()]])
+
+    clauses["spec"] = _sql_in("spec", state["filtro_spec"])
+
+    if state["filtro_target"] == "In target":
+        clauses["target"] = ("in_target = 1", [])
+    elif state["filtro_target"] == "Non in target":
+        clauses["target"] = ("in_target = 0", [])
+
+    cycle_idx = [mesi.index(c) for c in cycle_visit_cols(state["ciclo_scelto"], df.columns)]
+    seen = " OR ".join(f"v{m} > 0" for m in cycle_idx) or "0"
+    if state["filtro_visto"] == "Visto":
+        clauses["visto"] = (f"({seen})", [])
+    elif state["filtro_visto"] == "Non Visto":
+        clauses["visto"] = (f"NOT ({seen})", [])
+    elif state["filtro_visto"] == "Visita VIP":
+        clauses["visto"] = ("(" + (" OR ".join(f"v{m} = 2" for m in cycle_idx) or "0") + ")", [])
+
+    slot_cols = day_slot_cols(df.columns, state["giorno_scelto"], state["fascia_oraria"])
+    if not slot_cols:
+        return None, []
+
+    idx = [DAY_SLOT_COLS.index(c) for c in slot_cols]
+    if state["fascia_oraria"] == "Personalizzato":
+        start_min, end_min = _time_to_min(state["custom_start"]), _time_to_min(state["custom_end"])
+        clauses["giorno_fascia"] = (
+            f"pos IN (SELECT pos FROM intervalli WHERE slot IN ({', '.join('?' * len(idx))}) AND s <= ? AND e >= ?)",
+            idx + [start_min, end_min],
+        )
+    else:
+        clauses["giorno_fascia"] = ("(" + " OR ".join(f"n{i} = 1" for i in idx) + ")", [])
 
-            st.session_state["last_voice_transcript"] = transcript
-            st.session_state["last_voice_payload"] = payload
-            st.session_state["voice_feedback"] = msg
-            st.session_state["last_processed_audio_id"] = audio_id
+    micro_gruppi = state.get("microarea_gruppi") or []
+    if (state["microarea_scelta"] or micro_gruppi) and "microarea" in df.columns:
+        clauses["microarea"] = _sql_in("microarea", microarea_values(dataset, state["microarea_scelta"], micro_gruppi))
 
-        st.rerun()
+    prov_sel = state["provincia_scelta"]
+    if prov_sel.lower() != "ovunque" and "provincia" in df.columns:
+        clauses["provincia"] = ("prov_l = ?", [prov_sel.lower()])
 
-    except Exception as e:
-        st.session_state["voice_feedback"] = f"Errore comando vocale: {e}"
-        st.session_state["last_processed_audio_id"] = audio_id
+    if state["prov_escludi"] and "provincia" in df.columns:
+        sql, params = _sql_in("prov_sl", {str(p).strip().lower() for p in state["prov_escludi"]})
+        clauses["prov_escludi"] = (f"NOT {sql}", params)
 
-if st.session_state.get("last_voice_transcript") or st.session_state.get("voice_feedback"):
-    st.markdown('<div class="voice-result">', unsafe_allow_html=True)
+    if state["mese_limite_visita"] != "Nessuno":
+        clauses["mese_limite"] = ("ultima_num <= ?", [month_order[state["mese_limite_visita"].lower()]])
 
-    if st.session_state.get("last_voice_transcript"):
-        st.markdown(
-            f"<div><span class='voice-label'>Hai detto:</span> {st.session_state['last_voice_transcript']}</div>",
-            unsafe_allow_html=True,
-        )
+    if state["search_query"]:
+        clauses["ricerca"] = ("instr(search, ?) > 0", [state["search_query"].lower()])
 
-    if st.session_state.get("voice_feedback"):
-        st.markdown(
-            f"<div style='margin-top:6px;'><span class='voice-label'>Esito:</span> {st.session_state['voice_feedback']}</div>",
-            unsafe_allow_html=True,
+    centro = gazetteer_point(state.get("geo_citta"))
+    if centro is not None and state.get("geo_raggio_km"):
+        cx, cy, cz = _unit_vectors(np.array([centro[0]]), np.array([centro[1]]))[0]
+        chord = 2 * np.sin(min(state["geo_raggio_km"] / EARTH_RADIUS_KM, np.pi) / 2)
+        clauses["distanza"] = (
+            "((x - ?) * (x - ?) + (y - ?) * (y - ?) + (z - ?) * (z - ?)) <= ?",
+            [cx, cx, cy, cy, cz, cz, chord ** 2],
         )
 
-    st.markdown("</div>", unsafe_allow_html=True)
+    return clauses, slot_cols
+
+
+def _sql_where(clauses: dict, exclude: tuple = ()) -> tuple[str, list]:
+    parts, params = [], []
+    for name, (sql, p) in clauses.items():
+        if name not in exclude:
+            parts.append(sql)
+            params.extend(p)
+    return (" AND ".join(parts) or "1"), params
+
+
+def run_filter_query_sql(dataset: dict, state: dict, all_rows: bool = False) -> dict:
+    df = dataset["df"]
+    clauses, slot_cols = compile_filter_clauses(dataset, state)
+    if clauses is None:
+        return {"error": "Le colonne per il filtro giorno/fascia non esistono nel file."}
+
+    colonne = display_slot_cols(df, slot_cols, state)
+    start_idx = [DAY_SLOT_COLS.index(c) for c in colonne if c in DAY_SLOT_COLS]
+    first_start = "min(" + ", ".join([f"coalesce(s{i}, {SQL_NO_START_MIN})" for i in start_idx] + [str(SQL_NO_START_MIN)]) + ")"
+
+    order_by = f"ultima_num, {first_start}, pos"
+    order_params = []
+    centro = gazetteer_point(state.get("geo_citta"))
+    if centro is not None and state.get("geo_ordina"):
+        cx, cy, cz = _unit_vectors(np.array([centro[0]]), np.array([centro[1]]))[0]
+        order_by = "x IS NULL, (x - ?) * (x - ?) + (y - ?) * (y - ?) + (z - ?) * (z - ?), " + order_by
+        order_params = [cx, cx, cy, cy, cz, cz]
+
+    where, params = _sql_where(clauses)
+    sql = dataset_sql(dataset)
+    with sql["lock"]:
+        conn = sql["conn"]
+        n_righe, n_medici = conn.execute(
+            f"SELECT COUNT(*), COUNT(DISTINCT CASE WHEN phys_id >= 0 THEN phys_id END) FROM medici WHERE {where}",
+            params,
+        ).fetchone()
+
+        n_pagine = max(1, -(-n_righe // SQL_PAGE_ROWS))
+        pagina = min(max(1, int(state.get("pagina_risultati") or 1)), n_pagine)
+        # all_rows: l'intera selezione nello stesso ordine (export), non solo la pagina
+        limit = "" if all_rows else " LIMIT ? OFFSET ?"
+        page_params = [] if all_rows else [SQL_PAGE_ROWS, (pagina - 1) * SQL_PAGE_ROWS]
+        pos = np.array([r[0] for r in conn.execute(
+            f"SELECT pos FROM medici WHERE {where} ORDER BY {order_by}{limit}",
+            params + order_params + page_params,
+        )], dtype=np.int64)
+
+        where_no_time, params_no_time = _sql_where(clauses, exclude=("giorno_fascia",))
+        pos_senza_orario = np.array([r[0] for r in conn.execute(
+            f"SELECT pos FROM medici WHERE {where_no_time} ORDER BY pos", params_no_time
+        )], dtype=np.int64)
+
+        facets = {}
+        for facet, col in FACET_COLUMNS.items():
+            if col not in df.columns:
+                facets[facet] = {}
+                continue
+            w, p = _sql_where(clauses, exclude=(facet,))
+            rows = conn.execute(
+                f"SELECT {col}, COUNT(DISTINCT phys_id) FROM medici "
+                f"WHERE {w} AND {col} IS NOT NULL AND phys_id >= 0 GROUP BY {col}",
+                p,
+            ).fetchall()
+            facets[facet] = {str(k): int(v) for k, v in rows}
+
+        facets["microarea_gruppi"] = {}
+        if "microarea" in df.columns:
+            w, p = _sql_where(clauses, exclude=("microarea",))
+            pairs = conn.execute(
+                f"SELECT DISTINCT microarea, phys_id FROM medici WHERE {w} AND microarea IS NOT NULL AND phys_id >= 0",
+                p,
+            ).fetchall()
+            tax = dataset_microarea_taxonomy(dataset)
+            value_idx = tax["index"].get_indexer([r[0] for r in pairs]) if pairs else np.array([], dtype=int)
+            facets["microarea_gruppi"] = microarea_group_counts(
+                tax, value_idx, np.array([r[1] for r in pairs], dtype=np.int64)
+            )
 
-st.caption("Esempi: “chi riceve domattina in microarea FM” · “solo MMG oggi pomeriggio” · “azzera tutto”")
+    distanza = None
+    if centro is not None:
+        geo = dataset_geo(dataset)
+        distanza = distances_km({"lat": geo["lat"][pos], "lon": geo["lon"][pos]}, *centro)
+
+    result, colonne_da_mostrare = shape_filter_result(dataset, state, pos, colonne, distanza)
+
+    return {
+        "df": result,
+        "facets": facets,
+        "pos": pos,
+        "pos_senza_orario": pos_senza_orario,
+        "colonne": colonne_da_mostrare,
+        "n_medici": int(n_medici),
+        "n_righe": int(n_righe),
+        "pagina": pagina,
+        "n_pagine": n_pagine,
+    }
 
 
-# ---------- WIDGET FILTRI -------------------------------------------------------
-ciclo_scelto = st.selectbox(
-    f"💠 SELEZIONA CICLO ({today.strftime('%B').capitalize()} {today.year})",
-    ciclo_opts,
-    index=default_cycle_idx,
-    key="ciclo_scelto",
-)
+def sql_results_csv(dataset: dict, state: dict) -> bytes:
+    # tutta la selezione nell'ordine della vista, non solo la pagina caricata
+    result = run_filter_query_sql(dataset, state, all_rows=True)
+    return result["df"][result["colonne"]].to_csv(index=False).encode("utf-8")
 
-month_cycles = {
-    "Ciclo 1 (Gen-Feb-Mar)": ["gennaio", "febbraio", "marzo"],
-    "Ciclo 2 (Apr-Mag-Giu)": ["aprile", "maggio", "giugno"],
-    "Ciclo 3 (Lug-Ago-Set)": ["luglio", "agosto", "settembre"],
-    "Ciclo 4 (Ott-Nov-Dic)": ["ottobre", "novembre", "dicembre"],
-}
-visto_cols = [m for m in (mesi if ciclo_scelto == "Tutti" else month_cycles[ciclo_scelto]) if m in df_mmg.columns]
 
+def sql_first_page(full: dict) -> dict:
+    # la prima pagina della vista ricavata da un risultato con all_rows=True
+    return {**full, "df": full["df"].iloc[:SQL_PAGE_ROWS], "pos": full["pos"][:SQL_PAGE_ROWS], "pagina": 1}
 
-# ---------- % MMG VISTI ---------------------------------------------------------
-try:
-    ciclo_cols = [c for c in visto_cols if c in df_mmg.columns]
-    if ciclo_cols and "nome medico" in df_mmg.columns:
-        df_tmp = df_mmg.copy()
-        df_tmp["_nome_norm"] = df_tmp["nome medico"].astype(str).str.strip().str.lower()
 
-        is_mmg = df_tmp.get("spec", pd.Series("", index=df_tmp.index)).astype(str).str.strip().str.upper() == "MMG"
-        is_in_target = df_tmp.get("in target", pd.Series("", index=df_tmp.index)).astype(str).str.strip().str.lower() == "x"
-        base_mask = is_mmg & is_in_target
+# ---------- MATERIALIZZAZIONE PRESET --------------------------------------------
+# per i dataset più recenti e per ogni preset: risultati di oggi nella cache filtri
+# condivisa e CSV nel file dei preset. Il thread si sveglia a ogni dataset nuovo o
+# preset salvato, e comunque ogni PRESET_SCAN_S (file precaricati, cambio di giorno)
+PRESET_SCAN_S = 60
+PRESET_DATASETS_MAX = 2
 
-        total_mmg_target = int(df_tmp[base_mask]["_nome_norm"].nunique())
 
-        def _row_has_visit_vals(vals):
-            return any(str(v).strip().lower() in ["x", "v"] for v in vals)
+def materialize_presets(store: dict):
+    presets = list_filter_presets()
+    now = datetime.datetime.now(timezone)
+    giorno = now.date().isoformat()
+
+    registry = get_dataset_registry()
+    with registry["lock"]:
+        datasets = list(registry["datasets"].values())[-PRESET_DATASETS_MAX:]
+
+    with _preset_db() as conn, conn:
+        conn.execute("DELETE FROM preset_export WHERE giorno < ?", (giorno,))
+
+    # prima il dataset usato più di recente
+    for dataset in reversed(datasets):
+        with _preset_db() as conn:
+            done = dict(conn.execute(
+                "SELECT nome, firma FROM preset_export WHERE dataset_key = ? AND giorno = ?",
+                (dataset["key"], giorno),
+            ).fetchall())
+        tax = dataset_microarea_taxonomy(dataset)
+        options = set(tax["options"])
+
+        for preset in presets:
+            if done.get(preset["nome"]) == preset["firma"]:
+                continue
+            # un preset che fallisce non ferma gli altri: l'errore resta sul preset
+            try:
+                # come nel modulo filtri: contano solo microaree e gruppi presenti nel file
+                state = preset_filter_state(preset["stato"], now)
+                state["microarea_scelta"] = [m for m in state["microarea_scelta"] if m in options]
+                state["microarea_gruppi"] = [g for g in state["microarea_gruppi"] if g in tax["groups"]]
+
+                if use_sql_backend(dataset):
+                    # una query sola su tutta la selezione: il CSV la usa intera, la cache
+                    # filtri ne riceve la prima pagina, quella che si vede aprendo il preset
+                    result = run_filter_query_sql(dataset, state, all_rows=True)
+                    if "error" not in result:
+                        store_filter_result(dataset, state, sql_first_page(result))
+                else:
+                    result, _ = cached_filter_results(dataset, state)
+                if "error" in result:
+                    raise ValueError(result["error"])
+                csv = result["df"][result["colonne"]].to_csv(index=False).encode("utf-8")
+                with _preset_db() as conn, conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO preset_export VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (preset["nome"], dataset["key"], giorno, preset["firma"],
+                         int(result["n_medici"]), int(result["n_righe"]), csv, time.time()),
+                    )
+            except Exception as e:
+                with store["lock"]:
+                    store["errors"][preset["nome"]] = str(e) or type(e).__name__
+                continue
+            with store["lock"]:
+                store["errors"].pop(preset["nome"], None)
+                store["materialized"] += 1
+
+
+def _preset_loop(store: dict):
+    while True:
+        store["wake"].wait(PRESET_SCAN_S)
+        store["wake"].clear()
+        try:
+            materialize_presets(store)
+            store["error"] = None
+        except Exception as e:
+            store["error"] = str(e)
+        store["runs"] += 1
 
-        seen_rows = df_tmp[ciclo_cols].apply(lambda r: _row_has_visit_vals(r.values), axis=1)
-        seen_count = int(df_tmp[base_mask & seen_rows]["_nome_norm"].nunique())
-        pct = int(round((seen_count / total_mmg_target) * 100)) if total_mmg_target > 0 else 0
 
-        st.markdown(f"""
-        <div class="kpi-card">
-          <div class="kpi-top">
-            <div class="kpi-title">% MMG visti (ciclo)</div>
-            <div class="kpi-pct">{pct}%</div>
-          </div>
-          <div class="kpi-bar-outer">
-            <div class="kpi-bar-inner" style="width:{pct}%;"></div>
-          </div>
-          <div class="kpi-sub">{seen_count} / {total_mmg_target}</div>
-        </div>
-        """, unsafe_allow_html=True)
-except Exception:
-    pass
+@cache_resource
+def start_preset_scheduler() -> threading.Thread:
+    thread = threading.Thread(target=_preset_loop, args=(get_preset_scheduler(),), name="medici-preset", daemon=True)
+    thread.start()
+    return thread
 
 
-# ---------- COPERTURA TERRITORIALE ----------------------------------------------
-with st.expander("📊 Copertura territoriale (MMG visti per microarea o provincia)", expanded=False):
-    territorio_mode = st.radio(
-        "Raggruppa per",
-        ["Microarea", "Provincia"],
-        horizontal=True,
-        key="territorio_mode",
-    )
+def schedule_preset_materialization(dataset: dict):
+    store = get_preset_scheduler()
+    tag = (dataset["key"], datetime.datetime.now(timezone).date())
+    with store["lock"]:
+        if tag in store["seen"]:
+            return
+        store["seen"].add(tag)
+    store["wake"].set()
+
+
+start_preset_scheduler()
+schedule_preset_materialization(dataset)
 
-    territory_col = "microarea" if territorio_mode == "Microarea" else "provincia"
-    top_key = "territorio_top_n_microarea" if territorio_mode == "Microarea" else "territorio_top_n_provincia"
-    min_tot_key = "territorio_min_tot_microarea" if territorio_mode == "Microarea" else "territorio_min_tot_provincia"
 
-    coverage_df = build_territory_coverage(
-        df_source=df_mmg,
-        group_col=territory_col,
-        cycle_cols=visto_cols,
+# ---------- MODULO FILTRI -------------------------------------------------------
+# in modalità blocco i widget dei filtri stanno in un form: le modifiche non
+# rilanciano lo script finché non si preme «Applica filtri»
+filtri_form = st.form("filtri_form", border=False) if filtri_in_blocco else st.container()
+
+with filtri_form:
+    if filtri_in_blocco:
+        ciclo_scelto = st.selectbox(ciclo_label, ciclo_opts, key="ciclo_scelto")
+
+
+# ---------- FILTRO MESE ULTIMA VISITA ------------------------------------------
+with filtri_form:
+    lista_mesi_cap = [m.capitalize() for m in mesi]
+    filtro_ultima = st.selectbox(
+        "Seleziona mese ultima visita",
+        ["Nessuno"] + lista_mesi_cap,
+        index=0,
+        key="filtro_ultima_visita",
     )
 
-    if coverage_df.empty:
-        st.info(f"Nessun dato disponibile per la vista per {territorio_mode.lower()}.")
-    else:
-        n_territori = len(coverage_df)
-        max_rows = min(50, n_territori)
-        top_n_default = min(15, max_rows)
 
-        if max_rows <= 5:
-            top_n = max_rows
-            st.caption(f"Territori disponibili: {max_rows}")
-        else:
-            if top_key not in st.session_state:
-                st.session_state[top_key] = top_n_default
+# ---------- FILTRI PRINCIPALI ---------------------------------------------------
+with filtri_form:
+    # i widget con conteggi (spec, microaree, province) vengono disegnati in questi
+    # contenitori dopo il calcolo dei filtri, così le etichette mostrano i conteggi aggiornati
+    spec_box = st.container()
 
-            st.session_state[top_key] = max(
-                5,
-                min(int(st.session_state[top_key]), max_rows)
-            )
+    if "spec" not in df_mmg.columns:
+        st.error("Nel file manca la colonna 'spec'.")
+        st.stop()
 
-            top_n = st.slider(
-                f"Quanti {territorio_mode.lower()} mostrare",
-                min_value=5,
-                max_value=max_rows,
-                value=int(st.session_state[top_key]),
-                key=top_key,
-            )
+    filtro_target = st.selectbox(
+        "🎯 Scegli il tipo di medici",
+        ["In target", "Non in target", "Tutti"],
+        index=["In target", "Non in target", "Tutti"].index(st.session_state.get("filtro_target", "In target")),
+        key="filtro_target",
+    )
+    filtro_visto = st.selectbox(
+        "👀 Filtra per medici 'VISTO'",
+        ["Tutti", "Visto", "Non Visto", "Visita VIP"],
+        index=["Tutti", "Visto", "Non Visto", "Visita VIP"].index(st.session_state.get("filtro_visto", "Non Visto")),
+        key="filtro_visto",
+    )
 
-        max_medici_tot = int(max(1, coverage_df["medici_totali"].max()))
 
-        if min_tot_key not in st.session_state:
-            st.session_state[min_tot_key] = 1
+# ---------- FILTRO GIORNO / FASCIA ----------------------------------------------
+with filtri_form:
+    oggi = datetime.datetime.now(timezone)
+    giorni_opz = ["sempre"] + giorni_settimana
+    giorno_default = giorni_settimana[oggi.weekday()] if oggi.weekday() < 5 else "sempre"
+
+    giorno_scelto = st.selectbox(
+        "📅 Scegli un giorno della settimana",
+        giorni_opz,
+        index=giorni_opz.index(st.session_state.get("giorno_scelto", giorno_default)),
+        key="giorno_scelto",
+    )
 
-        st.session_state[min_tot_key] = max(
-            1,
-            min(int(st.session_state[min_tot_key]), max_medici_tot)
-        )
+    fascia_opts = ["Mattina", "Pomeriggio", "Mattina e Pomeriggio", "Personalizzato"]
+    fascia_oraria = st.radio(
+        "🌞 Scegli la fascia oraria",
+        fascia_opts,
+        index=fascia_opts.index(st.session_state.get("fascia_oraria", "Personalizzato")),
+        key="fascia_oraria",
+    )
 
-        min_tot = st.number_input(
-            "Mostra solo territori con almeno questo numero di MMG",
-            min_value=1,
-            max_value=max_medici_tot,
-            value=int(st.session_state[min_tot_key]),
-            step=1,
-            key=min_tot_key,
+    if fascia_oraria == "Personalizzato":
+        start_dt, end_dt, default_min, default_max = _normalize_custom_times_for_slider(
+            timezone,
+            st.session_state.get("custom_start"),
+            st.session_state.get("custom_end"),
+        )
+        st.session_state["custom_start"] = start_dt.time()
+        st.session_state["custom_end"] = end_dt.time()
+
+        t_start, t_end = st.slider(
+            "Seleziona l'intervallo orario",
+            min_value=default_min,
+            max_value=default_max,
+            value=(start_dt, end_dt),
+            format="HH:mm",
         )
+        custom_start, custom_end = t_start.time(), t_end.time()
+        st.session_state["custom_start"] = custom_start
+        st.session_state["custom_end"] = custom_end
+
+        if custom_end <= custom_start:
+            st.error("L'orario di fine deve essere successivo all'orario di inizio.")
+            if not filtri_in_blocco:
+                st.stop()
+    else:
+        custom_start = custom_end = None
+        st.session_state.pop("custom_start", None)
+        st.session_state.pop("custom_end", None)
 
-        view_df = coverage_df[coverage_df["medici_totali"] >= int(min_tot)].head(int(top_n)).copy()
 
-        if view_df.empty:
-            st.warning("Nessun territorio rispetta i criteri selezionati.")
-        else:
-            label_col = territory_col
-            view_df["copertura_label"] = view_df["copertura_pct"].map(lambda x: f"{x:.1f}%")
-
-            chart = alt.Chart(view_df).mark_bar(cornerRadiusEnd=4).encode(
-                x=alt.X(
-                    "copertura_pct:Q",
-                    title="Copertura %",
-                    scale=alt.Scale(domain=[0, 100]),
-                ),
-                y=alt.Y(
-                    f"{label_col}:N",
-                    sort="-x",
-                    title=None,
-                ),
-                tooltip=[
-                    alt.Tooltip(f"{label_col}:N", title=territorio_mode),
-                    alt.Tooltip("copertura_pct:Q", title="Copertura %", format=".1f"),
-                    alt.Tooltip("medici_visti:Q", title="Visti"),
-                    alt.Tooltip("medici_non_visti:Q", title="Non visti"),
-                    alt.Tooltip("medici_totali:Q", title="Totali"),
-                ],
-            ).properties(
-                height=max(280, min(900, len(view_df) * 32))
-            )
+# ---------- MICROAREE -----------------------------------------------------------
+with filtri_form:
+    st.write("### Microaree")
 
-            text = alt.Chart(view_df).mark_text(
-                align="left",
-                baseline="middle",
-                dx=5,
-            ).encode(
-                x=alt.X("copertura_pct:Q"),
-                y=alt.Y(f"{label_col}:N", sort="-x"),
-                text="copertura_label:N",
-            )
+    microarea_lista = all_microaree.copy()
 
-            st.altair_chart(chart + text, use_container_width=True)
+    # dentro un form sono ammessi solo pulsanti di invio
+    micro_button = st.form_submit_button if filtri_in_blocco else st.button
 
-            st.caption(
-                "Base di calcolo: solo MMG in target, deduplicati per nominativo "
-                "all'interno del territorio selezionato. "
-                "Un medico è considerato visto se ha almeno una X o una V nel ciclo selezionato."
-            )
+    b1, b2, b3 = st.columns([1, 1, 2])
+    with b1:
+        if micro_button("✅ Tutte", key="micro_all"):
+            st.session_state["microarea_scelta"] = microarea_lista.copy()
+            for m in microarea_lista:
+                mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
+                st.session_state[mk] = True
+            st.rerun()
 
-            st.dataframe(
-                view_df.rename(columns={
-                    label_col: territorio_mode,
-                    "medici_totali": "MMG totali",
-                    "medici_visti": "MMG visti",
-                    "medici_non_visti": "MMG non visti",
-                    "copertura_pct": "Copertura %",
-                }),
-                use_container_width=True,
-                hide_index=True,
-            )
+    with b2:
+        if micro_button("🚫 Nessuna", key="micro_none"):
+            st.session_state["microarea_scelta"] = []
+            st.session_state["microarea_gruppi"] = []
+            for m in microarea_lista:
+                mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
+                st.session_state[mk] = False
+            st.rerun()
 
+    with b3:
+        st.caption(f"Selezionate: {len(st.session_state.get('microarea_scelta', []))}")
 
-# ---------- FUNZIONI VISITA ----------------------------------------------------
-def is_visited(row):
-    return sum(1 for c in visto_cols if row.get(c, "") in ["x", "v"]) >= 1
+    micro_box = st.container()
 
 
-def is_vip(row):
-    return any(row.get(c, "") == "v" for c in visto_cols)
+# ---------- PROVINCIA -----------------------------------------------------------
+with filtri_form:
+    prov_box = st.container()
+
 
+# ---------- ESCLUDI PROVINCE ----------------------------------------------------
+with filtri_form:
+    excl_box = st.container()
 
-def count_visits(row):
-    return sum(1 for c in visto_cols if row.get(c, "") in ["x", "v"])
 
+# ---------- MESE LIMITE ---------------------------------------------------------
+with filtri_form:
+    mesi_cap = [m.capitalize() for m in mesi]
+    mese_limite = st.selectbox(
+        "🕰️ Mostra solo medici visti prima di (incluso)",
+        ["Nessuno"] + mesi_cap,
+        index=0,
+        key="mese_limite_visita",
+    )
 
-def annotate_name(row):
-    name = row["nome medico"]
-    if any(row.get(c, "") == "v" for c in visto_cols):
-        name = f"{name} (VIP)"
-    return name
 
+# ---------- RICERCA -------------------------------------------------------------
+with filtri_form:
+    query = st.text_input(
+        "🔎 Cerca nei risultati",
+        placeholder="Inserisci nome, città, microarea, ecc.",
+        key="search_query",
+    ).strip()
+
+
+# ---------- VICINO A ------------------------------------------------------------
+with filtri_form:
+    geo = dataset_geo(dataset)
+    geo_opts = [GEO_NESSUNA] + (geo["comuni"] or load_gazetteer()["comune"].sort_values().tolist())
+    if st.session_state.get("geo_citta") not in geo_opts:
+        st.session_state["geo_citta"] = GEO_NESSUNA
+
+    col_geo1, col_geo2 = st.columns([2, 1])
+    with col_geo1:
+        geo_citta = st.selectbox("🧭 Vicino a", geo_opts, key="geo_citta")
+    with col_geo2:
+        geo_raggio_km = st.number_input("Entro km (0 = tutti)", min_value=0, max_value=300, step=5, key="geo_raggio_km")
+    geo_ordina = st.checkbox("Ordina per distanza", key="geo_ordina", disabled=geo_citta == GEO_NESSUNA)
+
+    if geo_citta != GEO_NESSUNA:
+        st.caption(
+            f"Coordinate dal comune per {int(geo['exact'].sum())} righe su {len(geo['exact'])}, "
+            f"dalla provincia per {len(geo['located']) - int(geo['exact'].sum())}; "
+            f"{len(geo['exact']) - len(geo['located'])} senza posizione."
+        )
 
-# ---------- FILTRO MESE ULTIMA VISITA ------------------------------------------
-lista_mesi_cap = [m.capitalize() for m in mesi]
-filtro_ultima = st.selectbox(
-    "Seleziona mese ultima visita",
-    ["Nessuno"] + lista_mesi_cap,
-    index=0,
-    key="filtro_ultima_visita",
-)
+if filtri_in_blocco:
+    with filtri_form:
+        st.form_submit_button("✅ Applica filtri", type="primary", use_container_width=True)
+    if fascia_oraria == "Personalizzato" and custom_end <= custom_start:
+        st.stop()
 
-df_work = df_mmg.copy()
 
-if filtro_ultima != "Nessuno":
-    sel_num = month_order[filtro_ultima.lower()]
-    df_work = df_work[
-        df_work["ultima visita"].str.lower().map(lambda m: month_order.get(m, 0)).le(sel_num)
-    ].copy()
+# ---------- APPLICA FILTRI ------------------------------------------------------
+# valori correnti dei widget con conteggi, letti dallo stato prima di disegnarli
+filtro_spec = [s for s in st.session_state.get("filtro_spec", DEFAULT_SPEC) if s in DEFAULT_SPEC + SPEC_EXTRA]
 
+base_state = {
+    "ciclo_scelto": ciclo_scelto,
+    "filtro_ultima_visita": filtro_ultima,
+    "filtro_spec": filtro_spec,
+    "filtro_target": filtro_target,
+    "filtro_visto": filtro_visto,
+}
+base_mask = combine_masks(base_filter_masks(dataset, base_state), len(df_mmg))
+prov_base = df_mmg.loc[base_mask, "provincia"] if "provincia" in df_mmg.columns else pd.Series([], dtype=str)
 
-# ---------- FILTRI PRINCIPALI ---------------------------------------------------
-filtro_spec = st.multiselect(
-    "🩺 Filtra per tipo di specialista (spec)",
-    DEFAULT_SPEC + SPEC_EXTRA,
-    default=st.session_state.get("filtro_spec", DEFAULT_SPEC),
-    key="filtro_spec",
-)
+prov_raw = prov_base.dropna().unique().tolist()
+prov_lista = ["Ovunque"] + sorted([p for p in prov_raw if str(p).lower() != "nan"])
+prov_excl_opts = sorted([str(p).strip() for p in prov_raw if str(p).strip() and str(p).lower() != "nan"])
 
-if "spec" not in df_work.columns:
-    st.error("Nel file manca la colonna 'spec'.")
-    st.stop()
+selected_set = set(st.session_state.get("microarea_scelta", []))
+micro_keys = {m: "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10] for m in microarea_lista}
+for m, mk in micro_keys.items():
+    if mk not in st.session_state:
+        st.session_state[mk] = (m in selected_set)
+micro_sel = [m for m, mk in micro_keys.items() if st.session_state[mk]]
+micro_gruppi = [g for g in st.session_state.get("microarea_gruppi", []) if g in microarea_tax["groups"]]
 
-df_work = df_work[df_work["spec"].isin(filtro_spec)].copy()
+prov_sel = st.session_state.get("provincia_scelta", "Ovunque")
+if prov_sel not in prov_lista:
+    prov_sel = "Ovunque"
+prov_escludi = [p for p in st.session_state.get("prov_escludi", []) if p in prov_excl_opts]
 
-filtro_target = st.selectbox(
-    "🎯 Scegli il tipo di medici",
-    ["In target", "Non in target", "Tutti"],
-    index=["In target", "Non in target", "Tutti"].index(st.session_state.get("filtro_target", "In target")),
-    key="filtro_target",
-)
-filtro_visto = st.selectbox(
-    "👀 Filtra per medici 'VISTO'",
-    ["Tutti", "Visto", "Non Visto", "Visita VIP"],
-    index=["Tutti", "Visto", "Non Visto", "Visita VIP"].index(st.session_state.get("filtro_visto", "Non Visto")),
-    key="filtro_visto",
-)
 
-is_in = df_work["in target"].astype(str).str.strip().str.lower() == "x"
-df_in_target = df_work[is_in].copy()
-df_non_target = df_work[~is_in].copy()
-df_filtered_target = {
-    "In target": df_in_target,
-    "Non in target": df_non_target,
-    "Tutti": pd.concat([df_in_target, df_non_target], ignore_index=True),
-}[filtro_target]
-
-if filtro_visto == "Visto":
-    df_work = df_filtered_target[df_filtered_target.apply(is_visited, axis=1)].copy()
-elif filtro_visto == "Non Visto":
-    df_work = df_filtered_target[~df_filtered_target.apply(is_visited, axis=1)].copy()
-elif filtro_visto == "Visita VIP":
-    df_work = df_filtered_target[df_filtered_target.apply(is_vip, axis=1)].copy()
-else:
-    df_work = df_filtered_target.copy()
+def pin_faceted_values(**values):
+    # widget con conteggi nelle etichette: il frontend rimanda l'etichetta formattata, che
+    # cambia con i conteggi. Il valore va fissato nello stato prima di ridisegnarli (senza
+    # default/index), altrimenti al rerun successivo non combacia più con le opzioni
+    for key, value in values.items():
+        st.session_state[key] = value
 
 
-# ---------- FILTRO GIORNO / FASCIA ----------------------------------------------
-oggi = datetime.datetime.now(timezone)
-giorni_opz = ["sempre"] + giorni_settimana
-giorno_default = giorni_settimana[oggi.weekday()] if oggi.weekday() < 5 else "sempre"
-
-giorno_scelto = st.selectbox(
-    "📅 Scegli un giorno della settimana",
-    giorni_opz,
-    index=giorni_opz.index(st.session_state.get("giorno_scelto", giorno_default)),
-    key="giorno_scelto",
+pin_faceted_values(
+    filtro_spec=filtro_spec,
+    provincia_scelta=prov_sel,
+    prov_escludi=prov_escludi,
+    microarea_gruppi=micro_gruppi,
 )
 
-fascia_opts = ["Mattina", "Pomeriggio", "Mattina e Pomeriggio", "Personalizzato"]
-fascia_oraria = st.radio(
-    "🌞 Scegli la fascia oraria",
-    fascia_opts,
-    index=fascia_opts.index(st.session_state.get("fascia_oraria", "Personalizzato")),
-    key="fascia_oraria",
-)
+filter_state = {
+    **base_state,
+    "giorno_scelto": giorno_scelto,
+    "fascia_oraria": fascia_oraria,
+    "custom_start": custom_start,
+    "custom_end": custom_end,
+    "microarea_scelta": micro_sel,
+    "microarea_gruppi": micro_gruppi,
+    "provincia_scelta": prov_sel,
+    "prov_escludi": prov_escludi,
+    "mese_limite_visita": mese_limite,
+    "search_query": query,
+    "geo_citta": geo_citta,
+    "geo_raggio_km": int(geo_raggio_km),
+    "geo_ordina": bool(geo_ordina),
+    "pagina_risultati": 1,
+}
 
-if fascia_oraria == "Personalizzato":
-    start_dt, end_dt, default_min, default_max = _normalize_custom_times_for_slider(
-        timezone,
-        st.session_state.get("custom_start"),
-        st.session_state.get("custom_end"),
-    )
-    st.session_state["custom_start"] = start_dt.time()
-    st.session_state["custom_end"] = end_dt.time()
-
-    t_start, t_end = st.slider(
-        "Seleziona l'intervallo orario",
-        min_value=default_min,
-        max_value=default_max,
-        value=(start_dt, end_dt),
-        format="HH:mm",
+sql_backend = use_sql_backend(dataset)
+if sql_backend:
+    # nuova combinazione di filtri: si riparte dalla prima pagina
+    filtri_sig = canonical_filter_state(filter_state)
+    if st.session_state.get("_filtri_sig") != filtri_sig:
+        st.session_state["_filtri_sig"] = filtri_sig
+        st.session_state["pagina_risultati"] = 1
+    filter_state["pagina_risultati"] = int(st.session_state.get("pagina_risultati", 1))
+
+filter_result, filter_cache_hit = cached_filter_results(dataset, filter_state)
+
+if "error" in filter_result:
+    st.error(filter_result["error"])
+    st.stop()
+
+facets = filter_result["facets"]
+if sql_backend:
+    st.session_state["pagina_risultati"] = filter_result["pagina"]
+
+with spec_box:
+    filtro_spec = st.multiselect(
+        "🩺 Filtra per tipo di specialista (spec)",
+        DEFAULT_SPEC + SPEC_EXTRA,
+        format_func=lambda s: f"{s} ({facets['spec'].get(s, 0)})",
+        key="filtro_spec",
     )
-    custom_start, custom_end = t_start.time(), t_end.time()
-    st.session_state["custom_start"] = custom_start
-    st.session_state["custom_end"] = custom_end
 
-    if custom_end <= custom_start:
-        st.error("L'orario di fine deve essere successivo all'orario di inizio.")
-        st.stop()
-else:
-    custom_start = custom_end = None
-    st.session_state.pop("custom_start", None)
-    st.session_state.pop("custom_end", None)
+with micro_box:
+    if microarea_tax["groups"]:
+        st.multiselect(
+            "🗂️ Intere famiglie o codici con tutte le varianti",
+            list(microarea_tax["groups"]),
+            format_func=lambda g: (
+                f"{microarea_group_label(microarea_tax, g)} ({facets['microarea_gruppi'].get(g, 0)})"
+            ),
+            key="microarea_gruppi",
+        )
+    st.markdown('<div id="microarea-box">', unsafe_allow_html=True)
+    for m, mk in micro_keys.items():
+        st.checkbox(f"{m} ({facets['microarea'].get(m, 0)})", key=mk)
+    st.markdown('</div>', unsafe_allow_html=True)
 
+st.session_state["microarea_scelta"] = micro_sel
 
-def filtra_giorno_fascia(df_base: pd.DataFrame):
-    giorni = giorni_settimana if giorno_scelto == "sempre" else [giorno_scelto]
-    cols = []
-    for g in giorni:
-        if fascia_oraria in ["Mattina", "Mattina e Pomeriggio"]:
-            cols.append(f"{g} mattina")
-        if fascia_oraria in ["Pomeriggio", "Mattina e Pomeriggio"]:
-            cols.append(f"{g} pomeriggio")
-        if fascia_oraria == "Personalizzato":
-            for suf in ["mattina", "pomeriggio"]:
-                col = f"{g} {suf}"
-                if col in df_base.columns:
-                    cols.append(col)
+with prov_box:
+    prov_sel = st.selectbox(
+        "📍 Scegli la Provincia",
+        prov_lista,
+        format_func=lambda p: p if p == "Ovunque" else f"{p} ({facets['provincia'].get(p, 0)})",
+        key="provincia_scelta",
+    )
 
-    cols = [c.lower() for c in cols if c.lower() in df_base.columns]
-    if not cols:
-        st.error("Le colonne per il filtro giorno/fascia non esistono nel file.")
-        st.stop()
+with excl_box:
+    prov_escludi = st.multiselect(
+        "🚫 Escludi province",
+        prov_excl_opts,
+        format_func=lambda p: f"{p} ({facets['prov_escludi'].get(p, 0)})",
+        key="prov_escludi",
+    )
 
-    if fascia_oraria == "Personalizzato":
-        df_f = df_base[df_base[cols].apply(
-            lambda r: any(interval_covers(r.get(c), custom_start, custom_end) for c in cols),
-            axis=1
-        )].copy()
-        return df_f, cols
+df_filtrato = filter_result["df"]
+colonne_da_mostrare = filter_result["colonne"]
 
-    df_f = df_base[df_base[cols].notna().any(axis=1)].copy()
-    return df_f, cols
 
+# ---------- HEATMAP DISPONIBILITÀ SETTIMANALE -----------------------------------
+with st.expander("🗓️ Disponibilità settimanale (medici che ricevono per quarto d'ora)", expanded=False):
+    heatmap_mode = st.radio(
+        "Raggruppa per",
+        ["Microarea", "Provincia"],
+        horizontal=True,
+        key="heatmap_mode",
+    )
+    heatmap_col = "microarea" if heatmap_mode == "Microarea" else "provincia"
 
-df_filtrato, colonne_da_mostrare = filtra_giorno_fascia(df_work)
+    row_pos = filter_result["pos_senza_orario"]
+    df_settimana = df_mmg.iloc[row_pos]
 
-if fascia_oraria == "Personalizzato" and custom_start is not None:
-    ora_rif = custom_start.hour
-    if ora_rif < 13:
-        colonne_da_mostrare = [c for c in colonne_da_mostrare if "mattina" in c.lower()]
+    if heatmap_col in df_settimana.columns:
+        heat_territori = sorted(
+            t for t in df_settimana[heatmap_col].dropna().astype(str).str.strip().unique().tolist()
+            if t and t.lower() != "nan"
+        )
     else:
-        colonne_da_mostrare = [c for c in colonne_da_mostrare if "pomeriggio" in c.lower()]
+        heat_territori = []
 
-if not colonne_da_mostrare:
-    colonne_da_mostrare = [c for c in df_work.columns if any(x in c for x in ["mattina", "pomeriggio"])]
+    heat_terr = st.selectbox(
+        f"{heatmap_mode} da visualizzare",
+        ["Tutte"] + heat_territori,
+        key="heatmap_territorio",
+    )
 
-colonne_da_mostrare = ["nome medico", "città"] + colonne_da_mostrare + [
-    "indirizzo ambulatorio", "microarea", "provincia", "ultima visita"
-]
-colonne_da_mostrare = [c for c in colonne_da_mostrare if c in df_filtrato.columns]
+    if heat_terr != "Tutte":
+        keep = (df_settimana[heatmap_col].astype(str).str.strip() == heat_terr).to_numpy()
+        row_pos, df_settimana = row_pos[keep], df_settimana[keep]
 
+    if df_settimana.empty:
+        st.info("Nessun medico corrisponde ai filtri attuali.")
+    else:
+        counts = weekly_availability_counts(dataset["occupancy"], row_pos, dataset["phys_id"][row_pos])
+
+        heat_df = pd.DataFrame({
+            "giorno": np.repeat(giorni_settimana, counts.shape[1]),
+            "ora": slot_bucket_labels() * len(giorni_settimana),
+            "medici": counts.ravel(),
+        })
+
+        heatmap = alt.Chart(heat_df).mark_rect().encode(
+            x=alt.X("ora:O", title="Ora", axis=alt.Axis(labelAngle=-90)),
+            y=alt.Y("giorno:N", sort=giorni_settimana, title=None),
+            color=alt.Color("medici:Q", title="Medici", scale=alt.Scale(scheme="blues")),
+            tooltip=[
+                alt.Tooltip("giorno:N", title="Giorno"),
+                alt.Tooltip("ora:O", title="Dalle"),
+                alt.Tooltip("medici:Q", title="Medici che ricevono"),
+            ],
+        ).properties(height=220)
+
+        st.altair_chart(heatmap, use_container_width=True)
+        st.caption(
+            "Conteggio dei medici (deduplicati per nominativo) che rispettano i filtri attuali, "
+            "escluso giorno/fascia, e che ricevono per l'intero quarto d'ora."
+        )
 
-# ---------- MICROAREE -----------------------------------------------------------
-st.write("### Microaree")
 
-microarea_lista = all_microaree.copy()
+# ---------- OTTIMIZZATORE SETTIMANA ---------------------------------------------
+# quali finestre di ricevimento, giorno per giorno, alzano di più il % MMG visti:
+# disponibilità come bitset (un uint64 per medico e giorno, un bit per quarto d'ora)
+# e scelta greedy della coppia giorno/finestra con più medici nuovi entro la capacità
+OPT_MAX_CAPACITY = 40
 
-b1, b2, b3 = st.columns([1, 1, 2])
-with b1:
-    if st.button("✅ Tutte", key="micro_all"):
-        st.session_state["microarea_scelta"] = microarea_lista.copy()
-        for m in microarea_lista:
-            mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
-            st.session_state[mk] = True
-        st.rerun()
 
-with b2:
-    if st.button("🚫 Nessuna", key="micro_none"):
-        st.session_state["microarea_scelta"] = []
-        for m in microarea_lista:
-            mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
-            st.session_state[mk] = False
-        st.rerun()
+def availability_bitsets(occupancy: np.ndarray, rows: np.ndarray, phys_id: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # medici distinti (id), prima riga di ciascuno e disponibilità OR di tutte le sue righe
+    if len(rows) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.zeros((0, occupancy.shape[1]), dtype=np.uint64)
 
-with b3:
-    st.caption(f"Selezionate: {len(st.session_state.get('microarea_scelta', []))}")
+    packed = occupancy[rows]
 
-st.markdown('<div id="microarea-box">', unsafe_allow_html=True)
+    order = np.argsort(phys_id, kind="stable")
+    ids = phys_id[order]
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    return ids[starts], rows[order][starts], np.bitwise_or.reduceat(packed[order], starts, axis=0)
 
-selected_set = set(st.session_state.get("microarea_scelta", []))
-micro_sel = []
 
-for m in microarea_lista:
-    mk = "micro_chk_" + hashlib.md5(m.encode("utf-8")).hexdigest()[:10]
-    if mk not in st.session_state:
-        st.session_state[mk] = (m in selected_set)
+def window_masks(n_buckets: int, length: int) -> np.ndarray:
+    length = min(length, n_buckets)
+    block = np.uint64((1 << length) - 1)
+    return np.left_shift(block, np.arange(n_buckets - length + 1, dtype=np.uint64))
 
-    if st.checkbox(m, key=mk):
-        micro_sel.append(m)
 
-st.markdown('</div>', unsafe_allow_html=True)
+def plan_week_coverage(avail: np.ndarray, days: list[int], capacity: int, masks: np.ndarray) -> list[dict]:
+    fits = (avail[:, :, None] & masks[None, None, :]) != 0
+    covered = np.zeros(len(avail), dtype=bool)
+    remaining = list(days)
+    plan = []
 
-st.session_state["microarea_scelta"] = micro_sel
-if micro_sel and "microarea" in df_filtrato.columns:
-    df_filtrato = df_filtrato[df_filtrato["microarea"].isin(micro_sel)].copy()
+    while remaining:
+        open_fits = fits[:, remaining, :] & ~covered[:, None, None]
+        reach = open_fits.sum(axis=0)
+        gain = np.minimum(reach, capacity)
+        if gain.max() == 0:
+            break
+        # a pari guadagno, la finestra con più medici raggiungibili (più margine sul posto)
+        d_i, w = np.unravel_index(np.argmax(gain * (len(avail) + 1) + reach), gain.shape)
 
+        cand = np.flatnonzero(open_fits[:, d_i, w])
+        if len(cand) > capacity:
+            # prima chi ha meno alternative negli altri giorni ancora liberi
+            others = [i for i in range(len(remaining)) if i != d_i]
+            flex = open_fits[cand][:, others, :].any(axis=2).sum(axis=1) if others else np.zeros(len(cand))
+            cand = cand[np.argsort(flex, kind="stable")[:capacity]]
 
-# ---------- PROVINCIA -----------------------------------------------------------
-prov_raw = df_work.get("provincia", pd.Series([], dtype=str)).dropna().unique().tolist()
-prov_lista = ["Ovunque"] + sorted([p for p in prov_raw if str(p).lower() != "nan"])
+        covered[cand] = True
+        plan.append({"giorno": remaining[d_i], "finestra": int(w), "medici": cand, "raggiungibili": int(reach[d_i, w])})
+        remaining.pop(d_i)
 
-prov_sel = st.selectbox(
-    "📍 Scegli la Provincia",
-    prov_lista,
-    index=prov_lista.index(st.session_state.get("provincia_scelta", "Ovunque")) if st.session_state.get("provincia_scelta", "Ovunque") in prov_lista else 0,
-    key="provincia_scelta",
-)
+    return sorted(plan, key=lambda p: p["giorno"])
 
-if prov_sel.lower() != "ovunque" and "provincia" in df_filtrato.columns:
-    df_filtrato = df_filtrato[df_filtrato["provincia"].str.lower() == prov_sel.lower()].copy()
 
+with st.expander("🎯 Piano settimanale per alzare il % MMG visti", expanded=False):
+    kpi_base = cycle_aggregates.get("kpi_base")
+    if kpi_base is None:
+        st.info("Il file non ha le colonne necessarie per il calcolo del % MMG visti.")
+    else:
+        o1, o2 = st.columns(2)
+        with o1:
+            opt_capacita = st.number_input("Visite al giorno", 1, OPT_MAX_CAPACITY, 8, key="opt_capacita")
+        with o2:
+            opt_ore = st.slider("Durata del giro (ore)", 1, (SLOT_DAY_END_MIN - SLOT_DAY_START_MIN) // 60, 3, key="opt_ore")
+        opt_giorni = st.multiselect(
+            "Giorni disponibili",
+            giorni_settimana,
+            default=giorni_settimana,
+            format_func=str.capitalize,
+            key="opt_giorni",
+        )
+        opt_filtri = st.checkbox(
+            "Solo medici che rispettano i filtri attuali (escluso giorno/orario)",
+            value=True,
+            key="opt_filtri",
+        )
 
-# ---------- ESCLUDI PROVINCE ----------------------------------------------------
-prov_excl_raw = df_work.get("provincia", pd.Series([], dtype=str)).dropna().unique().tolist()
-prov_excl_opts = sorted([str(p).strip() for p in prov_excl_raw if str(p).strip() and str(p).lower() != "nan"])
-
-prov_escludi = st.multiselect(
-    "🚫 Escludi province",
-    prov_excl_opts,
-    default=st.session_state.get("prov_escludi", []),
-    key="prov_escludi",
-)
+        t0 = time.perf_counter()
+        phys = dataset["phys_id"]
+        seen_phys = np.unique(phys[kpi_base & cycle_aggregates["seen"] & (phys >= 0)])
+        todo = kpi_base & (phys >= 0) & ~np.isin(phys, seen_phys)
+        if opt_filtri:
+            in_filtri = np.zeros(len(df_mmg), dtype=bool)
+            in_filtri[filter_result["pos_senza_orario"]] = True
+            todo &= in_filtri
+        todo_rows = np.flatnonzero(todo)
+
+        opt_ids, opt_rows, opt_avail = availability_bitsets(dataset["occupancy"], todo_rows, phys[todo_rows])
+        n_buckets = OCCUPANCY_BUCKETS
+        window_len = int(opt_ore) * 60 // SLOT_BUCKET_MIN
+        opt_plan = plan_week_coverage(
+            opt_avail,
+            [giorni_settimana.index(g) for g in opt_giorni],
+            int(opt_capacita),
+            window_masks(n_buckets, window_len),
+        )
+        opt_ms = (time.perf_counter() - t0) * 1000
 
-if prov_escludi and "provincia" in df_filtrato.columns:
-    excl_set = {str(p).strip().lower() for p in prov_escludi}
-    df_filtrato = df_filtrato[~df_filtrato["provincia"].astype(str).str.strip().str.lower().isin(excl_set)].copy()
+        n_ricevono = int((opt_avail != 0).any(axis=1).sum())
+        n_piano = sum(len(p["medici"]) for p in opt_plan)
+        st.caption(
+            f"MMG in target ancora da vedere nel ciclo: {len(opt_ids)}, di cui {n_ricevono} con orari di ricevimento. "
+            f"Calcolato in {opt_ms:.0f} ms."
+        )
 
+        if not opt_plan:
+            st.info("Nessun medico da vedere riceve nei giorni scelti.")
+        else:
+            kpi_ciclo = cycle_aggregates["kpi"]
+            if kpi_ciclo["total"]:
+                pct_dopo = int(round((kpi_ciclo["seen"] + n_piano) / kpi_ciclo["total"] * 100))
+                st.metric("% MMG visti a fine settimana", f"{pct_dopo}%", delta=f"+{pct_dopo - kpi_ciclo['pct']} punti")
+
+            labels = slot_bucket_labels()
+
+            def fine(w: int) -> str:
+                return _fmt_minutes(SLOT_DAY_START_MIN + (w + window_len) * SLOT_BUCKET_MIN)
+
+            st.dataframe(pd.DataFrame({
+                "giorno": [giorni_settimana[p["giorno"]].capitalize() for p in opt_plan],
+                "finestra": [f"{labels[p['finestra']]}–{fine(p['finestra'])}" for p in opt_plan],
+                "medici raggiungibili": [p["raggiungibili"] for p in opt_plan],
+                "visite nel piano": [len(p["medici"]) for p in opt_plan],
+            }), hide_index=True, use_container_width=True)
+
+            for p in opt_plan:
+                g = giorni_settimana[p["giorno"]]
+                rows = opt_rows[p["medici"]]
+                cols = [c for c in ["nome medico", "città", "microarea", f"{g} mattina", f"{g} pomeriggio"] if c in df_mmg.columns]
+                with st.expander(f"{g.capitalize()} {labels[p['finestra']]}–{fine(p['finestra'])}: {len(rows)} medici"):
+                    st.dataframe(df_mmg.iloc[rows][cols], hide_index=True, use_container_width=True)
+
+
+# ---------- PIANIFICATORE GIORNATA ----------------------------------------------
+ROUTE_VISIT_MIN = 15
+ROUTE_SPEED_KMH = 45
+ROUTE_ROAD_FACTOR = 1.3
+ROUTE_UNKNOWN_TRAVEL_MIN = 20
+ROUTE_TIME_CAP_S = 0.5
+ROUTE_PRIORITY_SCORE = 1.0
+ROUTE_OTHER_SCORE = 0.1
+
+
+def route_candidates(dataset: dict, row_pos: np.ndarray, day_idx: int, priority: np.ndarray) -> dict:
+    # finestre del giorno: tutti gli intervalli di mattina e pomeriggio, una colonna ciascuno
+    cand_pos = np.full(len(dataset["df"]), -1)
+    cand_pos[row_pos] = np.arange(len(row_pos))
+    sel = (dataset["iv_slot"] // len(fasce_giornata) == day_idx) & (cand_pos[dataset["iv_row"]] >= 0)
+    iv_cand = cand_pos[dataset["iv_row"][sel]]
+
+    has_window = np.zeros(len(row_pos), dtype=bool)
+    has_window[iv_cand] = True
+    rows = row_pos[has_window]
+
+    # la tabella è ordinata per riga: gli intervalli di un medico sono contigui
+    w = (np.cumsum(has_window) - 1)[iv_cand]
+    first = np.r_[True, w[1:] != w[:-1]] if len(w) else np.array([], dtype=bool)
+    k = np.arange(len(w)) - np.maximum.accumulate(np.where(first, np.arange(len(w)), 0))
+    width = int(k.max()) + 1 if len(k) else 1
+    win_s = np.full((len(rows), width), np.nan)
+    win_e = np.full((len(rows), width), np.nan)
+    win_s[w, k] = dataset["iv_start"][sel]
+    win_e[w, k] = dataset["iv_end"][sel]
+
+    geo = dataset_geo(dataset)
+    citta = _ascii_tokens(dataset["df"]["città"].iloc[rows]) if "città" in dataset["df"].columns else pd.Series("", index=rows)
+    citta_codes, citta_uniques = pd.factorize(citta.where(citta.ne("")))
+
+    return {
+        "rows": rows,
+        "win_s": win_s,
+        "win_e": win_e,
+        "lat": geo["lat"][rows],
+        "lon": geo["lon"][rows],
+        "citta": citta_codes,
+        "citta_uniques": pd.Index(citta_uniques),
+        "phys": dataset["phys_id"][rows],
+        "score": np.where(priority[rows], ROUTE_PRIORITY_SCORE, ROUTE_OTHER_SCORE),
+        "priority": priority[rows],
+    }
 
-# ---------- MESE LIMITE ---------------------------------------------------------
-mesi_cap = [m.capitalize() for m in mesi]
-mese_limite = st.selectbox(
-    "🕰️ Mostra solo medici visti prima di (incluso)",
-    ["Nessuno"] + mesi_cap,
-    index=0,
-    key="mese_limite_visita",
-)
 
-if mese_limite != "Nessuno":
-    sel_num_limite = month_order[mese_limite.lower()]
-    df_filtrato = df_filtrato[
-        df_filtrato["ultima visita"].str.lower().map(lambda m: month_order.get(m, 0)).le(sel_num_limite)
-    ].copy()
+def _travel_from(cand: dict, origin: Optional[dict], to: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # origin: {"lat", "lon", "citta"}; None = prima tappa, nessuno spostamento
+    if origin is None:
+        return np.zeros(len(to)), np.zeros(len(to))
+    la1, lo1 = np.radians(origin["lat"]), np.radians(origin["lon"])
+    la2, lo2 = np.radians(cand["lat"][to]), np.radians(cand["lon"][to])
+    a = np.sin((la2 - la1) / 2) ** 2 + np.cos(la1) * np.cos(la2) * np.sin((lo2 - lo1) / 2) ** 2
+    km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1))) * ROUTE_ROAD_FACTOR
+    minutes = np.where(np.isnan(km), ROUTE_UNKNOWN_TRAVEL_MIN, km / ROUTE_SPEED_KMH * 60)
+    same = (cand["citta"][to] == origin["citta"]) & (origin["citta"] >= 0)
+    return np.where(same, 0.0, minutes), np.where(same | np.isnan(km), 0.0, km)
+
+
+def _stop_origin(cand: dict, i: int) -> dict:
+    return {"lat": cand["lat"][i], "lon": cand["lon"][i], "citta": cand["citta"][i]}
+
+
+def _earliest_start(cand: dict, idx: np.ndarray, arrival: np.ndarray, visit_min: float) -> np.ndarray:
+    start = np.maximum(arrival[:, None], cand["win_s"][idx])
+    ok = start + visit_min <= cand["win_e"][idx]
+    return np.where(ok, start, np.inf).min(axis=1)
+
+
+def _schedule(cand: dict, route: list[int], origin: Optional[dict], day_start: float, day_end: float, visit_min: float):
+    t, prev, starts = day_start, origin, []
+    for i in route:
+        travel, _ = _travel_from(cand, prev, np.array([i]))
+        start = _earliest_start(cand, np.array([i]), t + travel, visit_min)[0]
+        if not np.isfinite(start) or start + visit_min > day_end:
+            return None
+        starts.append(start)
+        t, prev = start + visit_min, _stop_origin(cand, i)
+    return starts
+
+
+def plan_day_route(
+    cand: dict,
+    origin: Optional[dict],
+    day_start: float,
+    day_end: float,
+    visit_min: float = ROUTE_VISIT_MIN,
+    time_cap_s: float = ROUTE_TIME_CAP_S,
+) -> dict:
+    deadline = time.perf_counter() + time_cap_s
+    n = len(cand["rows"])
+    available = np.ones(n, dtype=bool)
+    route, t, prev = [], day_start, origin
+
+    # 1) costruzione greedy: punteggio / (spostamento + attesa + visita), vettoriale sui candidati
+    while time.perf_counter() < deadline:
+        idx = np.flatnonzero(available)
+        if len(idx) == 0:
+            break
+        travel, _ = _travel_from(cand, prev, idx)
+        start = _earliest_start(cand, idx, t + travel, visit_min)
+        ok = np.isfinite(start) & (start + visit_min <= day_end)
+        if not ok.any():
+            break
+        value = np.where(ok, cand["score"][idx] / (start - t + visit_min), -np.inf)
+        j = np.lexsort((start, -value))[0]
+        best = idx[j]
+        route.append(int(best))
+        t, prev = start[j] + visit_min, _stop_origin(cand, best)
+        # phys = -1 (senza nome) non identifica nessuno: esclude solo la riga stessa
+        if cand["phys"][best] >= 0:
+            available &= cand["phys"] != cand["phys"][best]
+        available[best] = False
+
+    # 2) inserimento dei prioritari rimasti dove la giornata resta fattibile: si provano
+    #    solo i buchi del giro in cui almeno una finestra di ricevimento può contenere la visita
+    timed_out = False
+    pending = np.flatnonzero(available & cand["priority"])
+    while len(pending) and time.perf_counter() < deadline:
+        starts = np.array(_schedule(cand, route, origin, day_start, day_end, visit_min) or [], dtype=float)
+        gap_lo = np.r_[day_start, starts + visit_min]
+        gap_hi = np.r_[starts, day_end]
+        lo = np.maximum(gap_lo[None, :, None], cand["win_s"][pending][:, None, :])
+        hi = np.minimum(gap_hi[None, :, None], cand["win_e"][pending][:, None, :])
+        fits = (lo + visit_min <= hi).any(axis=2)
+
+        inserted = False
+        for p_i, k in zip(*np.nonzero(fits)):
+            if time.perf_counter() >= deadline:
+                timed_out = True
+                break
+            i = pending[p_i]
+            trial = route[:k] + [int(i)] + route[k:]
+            if _schedule(cand, trial, origin, day_start, day_end, visit_min) is not None:
+                route = trial
+                if cand["phys"][i] >= 0:
+                    available &= cand["phys"] != cand["phys"][i]
+                available[i] = False
+                inserted = True
+                break
+        if not inserted:
+            break
+        pending = pending[available[pending]]
+
+    starts = _schedule(cand, route, origin, day_start, day_end, visit_min) or []
+    travel_min, travel_km, prev = [], [], origin
+    for i in route:
+        m, km = _travel_from(cand, prev, np.array([i]))
+        travel_min.append(float(m[0]))
+        travel_km.append(float(km[0]))
+        prev = _stop_origin(cand, i)
+
+    return {
+        "route": route,
+        "starts": starts,
+        "travel_min": travel_min,
+        "travel_km": travel_km,
+        "timed_out": timed_out or time.perf_counter() >= deadline,
+    }
 
 
-# ---------- RICERCA -------------------------------------------------------------
-query = st.text_input(
-    "🔎 Cerca nei risultati",
-    placeholder="Inserisci nome, città, microarea, ecc.",
-    key="search_query",
-)
+with st.expander("🧭 Pianifica giornata (percorso di visite)", expanded=False):
+    oggi_idx = today.weekday() if today.weekday() < 5 else 0
+    giorno_default_idx = giorni_settimana.index(giorno_scelto) if giorno_scelto in giorni_settimana else oggi_idx
+
+    col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+    with col_r1:
+        route_giorno = st.selectbox("Giorno", giorni_settimana, index=giorno_default_idx, key="route_giorno")
+    with col_r2:
+        route_inizio = st.time_input("Inizio giro", datetime.time(8, 0), step=900, key="route_inizio")
+    with col_r3:
+        route_fine = st.time_input("Fine giro", datetime.time(19, 0), step=900, key="route_fine")
+    with col_r4:
+        route_visita = st.number_input("Minuti per visita", min_value=5, max_value=60, value=ROUTE_VISIT_MIN, step=5, key="route_visita")
+
+    route_origin_point = gazetteer_point(geo_citta)
+    st.caption(
+        (f"Partenza da {geo_citta} (filtro 'Vicino a'). " if route_origin_point else "Partenza dal primo medico in elenco. ")
+        + "Priorità agli MMG in target non ancora visti nel ciclo; spostamenti stimati in linea d'aria "
+        f"×{ROUTE_ROAD_FACTOR} a {ROUTE_SPEED_KMH} km/h, nessuno spostamento nello stesso comune."
+    )
 
-if query:
-    q = query.lower()
-    df_filtrato = df_filtrato[
-        df_filtrato.drop(columns=["provincia"], errors="ignore")
-        .astype(str)
-        .apply(lambda r: q in " ".join(r).lower(), axis=1)
-    ].copy()
+    route_sig = json.dumps([
+        dataset_key, canonical_filter_state(filter_state), route_giorno,
+        _serialize_value(route_inizio), _serialize_value(route_fine), int(route_visita),
+    ])
+
+    if st.button("Calcola percorso", key="route_calcola"):
+        df_all = dataset["df"]
+        is_mmg = (df_all["spec"].astype(str).str.strip().str.upper() == "MMG").to_numpy() if "spec" in df_all.columns else np.zeros(len(df_all), dtype=bool)
+        is_in = (df_all["in target"].astype(str).str.strip().str.lower() == "x").to_numpy() if "in target" in df_all.columns else np.zeros(len(df_all), dtype=bool)
+        priority = is_mmg & is_in & ~cycle_aggregates["seen"]
+
+        cand = route_candidates(dataset, filter_result["pos_senza_orario"], giorni_settimana.index(route_giorno), priority)
+        origin = None
+        if route_origin_point is not None:
+            origin_key = _ascii_tokens(pd.Series([geo_citta])).iloc[0]
+            origin = {
+                "lat": route_origin_point[0],
+                "lon": route_origin_point[1],
+                "citta": cand["citta_uniques"].get_loc(origin_key) if origin_key in cand["citta_uniques"] else -1,
+            }
+
+        t0 = time.perf_counter()
+        plan = plan_day_route(
+            cand,
+            origin,
+            _time_to_min(route_inizio),
+            _time_to_min(route_fine),
+            visit_min=float(route_visita),
+        )
+        st.session_state["route_plan"] = {
+            "dataset_key": dataset_key,
+            "sig": route_sig,
+            "cand": cand,
+            "plan": plan,
+            "elapsed_ms": (time.perf_counter() - t0) * 1000,
+        }
+
+    saved_plan = st.session_state.get("route_plan")
+    if saved_plan is not None and saved_plan.get("dataset_key") != dataset_key:
+        # righe di un altro file: gli indici non valgono più
+        st.session_state.pop("route_plan")
+        saved_plan = None
+    if saved_plan is not None:
+        if saved_plan["sig"] != route_sig:
+            st.info("Filtri o parametri cambiati: premi 'Calcola percorso' per aggiornare il giro.")
+        cand, plan = saved_plan["cand"], saved_plan["plan"]
+
+        if not plan["route"]:
+            st.warning("Nessun medico riceve in orari compatibili con il giro scelto.")
+        else:
+            route_rows = cand["rows"][plan["route"]]
+            win_s, win_e = cand["win_s"][plan["route"]], cand["win_e"][plan["route"]]
+            starts = np.array(plan["starts"])
+            finestra = [
+                " / ".join(f"{_fmt_minutes(a)}-{_fmt_minutes(b)}" for a, b in zip(ws, we) if np.isfinite(a))
+                for ws, we in zip(win_s, win_e)
+            ]
+            df_giro = pd.DataFrame({
+                "#": np.arange(1, len(route_rows) + 1),
+                "inizio visita": [_fmt_minutes(s) for s in starts],
+                "nome medico": df_mmg["nome medico"].to_numpy()[route_rows],
+                "città": df_mmg["città"].to_numpy()[route_rows] if "città" in df_mmg.columns else "",
+                "indirizzo ambulatorio": df_mmg["indirizzo ambulatorio"].to_numpy()[route_rows] if "indirizzo ambulatorio" in df_mmg.columns else "",
+                "riceve": finestra,
+                "spostamento min": np.round(plan["travel_min"]).astype(int),
+                "prioritario": np.where(cand["priority"][plan["route"]], "⭐", ""),
+            })
+
+            g1, g2, g3, g4 = st.columns(4)
+            g1.metric("Visite", len(route_rows))
+            g2.metric("Prioritarie", int(cand["priority"][plan["route"]].sum()), f"su {int(cand['priority'].sum())} candidati")
+            g3.metric("Km stimati", f"{sum(plan['travel_km']):.0f}")
+            g4.metric("Fine giro", _fmt_minutes(starts[-1] + float(route_visita)))
+            st.dataframe(df_giro, use_container_width=True, hide_index=True)
+            st.caption(
+                f"{len(cand['rows'])} candidati valutati in {saved_plan['elapsed_ms']:.0f} ms"
+                + (" (limite di tempo raggiunto, percorso migliorabile)." if plan["timed_out"] else ".")
+            )
 
 
 # ---------- PERSISTI STATO ------------------------------------------------------
@@ -1498,6 +5235,7 @@ PERSIST_KEYS = [
     "fascia_oraria",
     "provincia_scelta",
     "microarea_scelta",
+    "microarea_gruppi",
     "search_query",
     "custom_start",
     "custom_end",
@@ -1510,6 +5248,21 @@ PERSIST_KEYS = [
     "territorio_top_n_provincia",
     "territorio_min_tot_microarea",
     "territorio_min_tot_provincia",
+    "trend_mode",
+    "confronto_a",
+    "confronto_b",
+    "confronto_stato",
+    "confronto_livello",
+    "confronto_op",
+    "confronto_target",
+    "heatmap_mode",
+    "opt_capacita",
+    "opt_ore",
+    "opt_giorni",
+    "geo_citta",
+    "geo_raggio_km",
+    "geo_ordina",
+    "filtri_in_blocco",
 ]
 
 if st.session_state.pop("_skip_url_save_once", False):
@@ -1518,42 +5271,72 @@ else:
     save_state_to_url(PERSIST_KEYS)
 
 
-# ---------- ORDINAMENTO ---------------------------------------------------------
-def min_start(row):
-    ts = []
-    for c in colonne_da_mostrare:
-        if c in ["nome medico", "città", "indirizzo ambulatorio", "microarea", "provincia", "ultima visita", "Visite ciclo"]:
-            continue
-        stt, _ = parse_interval(row.get(c))
-        if stt:
-            ts.append(stt)
-    return min(ts) if ts else datetime.time(23, 59)
-
-
-df_filtrato = df_filtrato.copy()
-df_filtrato["__start"] = df_filtrato.apply(min_start, axis=1)
-
-month_order_sort = {m: i + 1 for i, m in enumerate(mesi)}
-month_order_sort[""] = 0
-df_filtrato["__ult"] = df_filtrato["ultima visita"].str.lower().map(month_order_sort).fillna(0)
-
-df_filtrato = df_filtrato.sort_values(by=["__ult", "__start"]).copy()
-df_filtrato.drop(columns=["__ult", "__start"], inplace=True, errors="ignore")
+# ---------- DIAGNOSTICA ---------------------------------------------------------
+with st.expander("🛠️ Diagnostica cache", expanded=False):
+    fc = get_filter_result_cache()
+    with fc["lock"]:
+        fc_stats = {
+            "entries": len(fc["entries"]),
+            "bytes": fc["bytes"],
+            "hits": fc["hits"],
+            "misses": fc["misses"],
+            "evictions": fc["evictions"],
+        }
+    lookups = fc_stats["hits"] + fc_stats["misses"]
+
+    d1, d2, d3, d4 = st.columns(4)
+    d1.metric("Hit", fc_stats["hits"])
+    d2.metric("Miss", fc_stats["misses"])
+    d3.metric("Evizioni", fc_stats["evictions"])
+    d4.metric("Hit rate", f"{(fc_stats['hits'] / lookups * 100) if lookups else 0:.0f}%")
+    st.caption(
+        f"Cache risultati filtri condivisa: {fc_stats['entries']} combinazioni, "
+        f"{fc_stats['bytes'] / 1024 / 1024:.1f} / {FILTER_CACHE_MAX_BYTES / 1024 / 1024:.0f} MB. "
+        f"Questa vista: {'dalla cache' if filter_cache_hit else 'ricalcolata'}."
+    )
+    prewarm_ready = [c for c in ciclo_opts if c in dataset["cycle_aggregates"]]
+    st.caption(f"Aggregati per ciclo pronti: {len(prewarm_ready)} / {len(ciclo_opts)}.")
+    if sql_backend:
+        st.caption(f"Backend filtri: SQLite ({os.path.basename(dataset_sql(dataset)['path'])}).")
+    else:
+        st.caption(f"Backend filtri: pandas (SQLite da {SQL_BACKEND_MIN_ROWS} righe).")
+    preset_store = get_preset_scheduler()
+    st.caption(
+        f"Preset: {preset_store['materialized']} risultati preparati in {preset_store['runs']} passate"
+        + (f"; ultimo errore: {preset_store['error']}." if preset_store["error"] else ".")
+    )
+    if dataset.get("shared"):
+        st.caption("Dataset mappato dallo store condiviso: preparato da un altro processo.")
+    else:
+        st.caption(f"Dataset preparato da questo processo e pubblicato in {SHARED_DATASET_DIR}.")
+
+    metrics = get_metrics_registry()
+    with metrics["lock"]:
+        sess = metrics["sessions"].get(_session_id(), {"reruns": 0, "bytes": {}})
+        sess_reruns, sess_bytes = sess["reruns"], sum(sess["bytes"].values())
+    export = [f for f, on in [(f"file {METRICS_FILE}", METRICS_FILE), (f"http://{METRICS_HOST}:{METRICS_PORT}/metrics", METRICS_PORT)] if on]
+    blobs = get_blob_store()
+    with blobs["lock"]:
+        blob_stats = (len(blobs["memory"]), blobs["bytes"], blobs["spills"], blobs["restores"])
+    st.caption(
+        f"File caricati in memoria: {blob_stats[0]} ({blob_stats[1] / 1024 / 1024:.1f} / "
+        f"{SESSION_BLOB_CEILING_BYTES / 1024 / 1024:.0f} MB); scaricati su disco {blob_stats[2]} volte, "
+        f"riletti {blob_stats[3]}."
+    )
+    st.caption(
+        f"Questa sessione: {sess_reruns} rerun, stato ≈ {sess_bytes / 1024 / 1024:.1f} MB. "
+        f"Metriche Prometheus: {', '.join(export) if export else 'non esportate'}."
+    )
 
 
 # ---------- EMPTY ---------------------------------------------------------------
-if df_filtrato.empty:
+if filter_result["n_righe"] == 0:
     st.warning("Nessun risultato corrispondente ai filtri selezionati.")
     st.stop()
 
 
-# ---------- VISITE CICLO --------------------------------------------------------
-df_filtrato["Visite ciclo"] = df_filtrato.apply(count_visits, axis=1)
-df_filtrato["nome medico"] = df_filtrato.apply(annotate_name, axis=1)
-
-
 # ---------- VISUALIZZAZIONE -----------------------------------------------------
-st.write(f"**Numero medici:** {df_filtrato['nome medico'].astype(str).str.lower().nunique()} 🧮")
+st.write(f"**Numero medici:** {filter_result['n_medici']} 🧮")
 st.write("### Medici disponibili")
 
 df_view = df_filtrato[colonne_da_mostrare].copy()
@@ -1565,9 +5348,22 @@ st.dataframe(
     height=550,
 )
 
+if sql_backend:
+    prima = (filter_result["pagina"] - 1) * SQL_PAGE_ROWS
+    st.caption(
+        f"Righe {prima + 1}–{prima + len(df_view)} di {filter_result['n_righe']}: "
+        f"i filtri girano su SQLite e si caricano {SQL_PAGE_ROWS} righe per pagina."
+    )
+    st.number_input("Pagina", min_value=1, max_value=filter_result["n_pagine"], step=1, key="pagina_risultati")
+
+if sql_backend:
+    # con SQLite la vista ha una pagina sola: il CSV completo si genera solo al clic
+    export_csv = partial(sql_results_csv, dataset, dict(filter_state))
+else:
+    export_csv = df_view.to_csv(index=False).encode("utf-8")
 st.download_button(
     "📥 Scarica risultati CSV",
-    df_view.to_csv(index=False).encode("utf-8"),
+    export_csv,
     "risultati_medici.csv",
     "text/csv",
 )
@@ -0,0 +1,129 @@
+import io
+import os
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+import pandas as pd
+
+mesi = [
+    "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno",
+    "luglio", "agosto", "settembre", "ottobre", "novembre", "dicembre"
+]
+
+INGEST_MAX_WORKERS = int(os.getenv("MEDICI_INGEST_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+# ---------- LETTURA EXCEL -------------------------------------------------------
+def _normalize_columns(cols) -> list[str]:
+    return [str(c).strip().lower() for c in cols]
+
+
+def _is_compatible_mmg_sheet(df: pd.DataFrame) -> bool:
+    cols = _normalize_columns(df.columns)
+    if "nome medico" not in cols:
+        return False
+    months_present = sum(1 for m in mesi if m in cols)
+    return months_present >= 6
+
+
+def parse_workbook(file_bytes: bytes) -> pd.DataFrame:
+    bio = io.BytesIO(file_bytes)
+
+    try:
+        xls = pd.ExcelFile(bio)
+    except Exception as e:
+        raise ValueError(f"Impossibile aprire il file Excel: {e}")
+
+    preferred_sheets = ["MMG", "MMG_Tabella 1"]
+
+    for sheet_name in preferred_sheets:
+        if sheet_name in xls.sheet_names:
+            try:
+                df = pd.read_excel(xls, sheet_name=sheet_name)
+                if _is_compatible_mmg_sheet(df):
+                    return df
+            except Exception:
+                pass
+
+    compatible_candidates = []
+    for sheet_name in xls.sheet_names:
+        try:
+            df = pd.read_excel(xls, sheet_name=sheet_name)
+            if _is_compatible_mmg_sheet(df):
+                compatible_candidates.append((sheet_name, df))
+        except Exception:
+            continue
+
+    if len(compatible_candidates) == 1:
+        return compatible_candidates[0][1]
+
+    if len(compatible_candidates) > 1:
+        candidate_names = [name for name, _ in compatible_candidates]
+        raise ValueError(
+            "Trovati più fogli compatibili con la struttura MMG. "
+            f"Fogli compatibili: {candidate_names}."
+        )
+
+    raise ValueError(
+        "Foglio MMG non trovato. "
+        f"Fogli disponibili: {xls.sheet_names}."
+    )
+
+
+# ---------- PARSING PARALLELO ---------------------------------------------------
+def parse_workbook_safe(file_bytes: bytes):
+    try:
+        return parse_workbook(file_bytes)
+    except Exception as e:
+        return e
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if INGEST_MAX_WORKERS <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            try:
+                _pool = ProcessPoolExecutor(
+                    max_workers=INGEST_MAX_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            except Exception:
+                return None
+        return _pool
+
+
+def parse_workbooks(workbooks: list[bytes]) -> list:
+    # un elemento per file: DataFrame oppure l'eccezione sollevata dal parsing
+    global _pool
+    pool = _get_pool() if len(workbooks) > 1 else None
+
+    if pool is None:
+        return [parse_workbook_safe(file_bytes) for file_bytes in workbooks]
+
+    try:
+        futures = [pool.submit(parse_workbook, file_bytes) for file_bytes in workbooks]
+    except (BrokenProcessPool, RuntimeError):
+        with _pool_lock:
+            _pool = None
+        return [parse_workbook_safe(file_bytes) for file_bytes in workbooks]
+
+    results = []
+    for fut, file_bytes in zip(futures, workbooks):
+        try:
+            results.append(fut.result())
+        except BrokenProcessPool:
+            with _pool_lock:
+                _pool = None
+            results.append(parse_workbook_safe(file_bytes))
+        except Exception as e:
+            results.append(e)
+    return results
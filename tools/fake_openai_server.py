@@ -0,0 +1,153 @@
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# server compatibile con le API OpenAI usate da app.py (trascrizione + parser a funzione):
+# l'"audio" inviato è il testo del comando in UTF-8, la risposta del parser deriva da parole chiave.
+# Avvio: OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=finta streamlit run app.py
+
+GIORNI = ["lunedì", "martedì", "mercoledì", "giovedì", "venerdì"]
+VOICE_FIELDS = [
+    "message", "giorno_scelto", "fascia_oraria", "custom_start", "custom_end", "provincia_scelta",
+    "microarea_scelta", "microarea_gruppi", "filtro_visto", "filtro_target", "filtro_spec",
+    "ciclo_scelto", "search_query",
+]
+
+
+def fake_voice_arguments(text: str) -> dict:
+    text = text.lower()
+    args = {field: None for field in VOICE_FIELDS}
+    if "azzera" in text or "reset" in text:
+        return {**args, "action": "azzera_filtri"}
+
+    args["action"] = "apply_filters"
+    if "mattina e pomeriggio" in text:
+        args["fascia_oraria"] = "Mattina e Pomeriggio"
+    elif "mattina" in text:
+        args["fascia_oraria"] = "Mattina"
+    elif "pomeriggio" in text:
+        args["fascia_oraria"] = "Pomeriggio"
+
+    m = re.search(r"dalle (\d{1,2}) alle (\d{1,2})", text)
+    if m:
+        args.update(fascia_oraria="Personalizzato", custom_start=f"{int(m[1]):02d}:00", custom_end=f"{int(m[2]):02d}:00")
+    for g in GIORNI:
+        if g in text:
+            args["giorno_scelto"] = g
+    if "mmg" in text:
+        args["filtro_spec"] = ["MMG"]
+    if "non visti" in text:
+        args["filtro_visto"] = "Non Visto"
+    args["message"] = "Filtri aggiornati (server finto)."
+    return args
+
+
+def _multipart_file(body: bytes, content_type: str) -> bytes:
+    m = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not m:
+        return b""
+    for part in body.split(b"--" + m[1].encode()):
+        head, sep, content = part.partition(b"\r\n\r\n")
+        if sep and b'name="file"' in head:
+            return content[:-2] if content.endswith(b"\r\n") else content
+    return b""
+
+
+def make_handler(stats: dict, delay: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, payload: dict, status: int = 200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _count(self, name: str):
+            with stats["lock"]:
+                stats[name] += 1
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                with stats["lock"]:
+                    self._send_json({k: v for k, v in stats.items() if k != "lock"})
+            else:
+                self._send_json({"error": {"message": "not found"}}, 404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            path = self.path.split("?")[0].rstrip("/")
+
+            if path.endswith("/audio/transcriptions"):
+                self._count("transcriptions")
+                time.sleep(delay)
+                text = _multipart_file(body, self.headers.get("Content-Type", "")).decode("utf-8", "replace")
+                self._send_json({"text": text.strip()})
+
+            elif path.endswith("/chat/completions"):
+                self._count("completions")
+                time.sleep(delay)
+                request = json.loads(body or b"{}")
+                user_text = next((m["content"] for m in request.get("messages", []) if m.get("role") == "user"), "")
+                self._send_json({
+                    "id": f"chatcmpl-fake-{stats['completions']}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "fake"),
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": "tool_calls",
+                        "message": {
+                            "role": "assistant",
+                            "content": None,
+                            "tool_calls": [{
+                                "id": "call_fake",
+                                "type": "function",
+                                "function": {
+                                    "name": "set_filters_from_voice",
+                                    "arguments": json.dumps(fake_voice_arguments(user_text), ensure_ascii=False),
+                                },
+                            }],
+                        },
+                    }],
+                })
+            else:
+                self._send_json({"error": {"message": "not found"}}, 404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_fake_server(host: str = "127.0.0.1", port: int = 0, delay: float = 0.5):
+    # ritorna (server, stats, base_url); il server gira in un thread daemon
+    stats = {"lock": threading.Lock(), "transcriptions": 0, "completions": 0}
+    server = ThreadingHTTPServer((host, port), make_handler(stats, delay))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="fake-openai").start()
+    return server, stats, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server OpenAI finto per provare i comandi vocali.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.5, help="latenza simulata per richiesta (s)")
+    args = parser.parse_args()
+
+    server, _, base_url = start_fake_server(args.host, args.port, args.delay)
+    print(f"Server finto su {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
@@ -0,0 +1,272 @@
+import argparse
+import datetime
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+import types
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import numpy as np
+
+from streamlit import config
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_openai_server import start_fake_server
+from synthetic_workbook import build_workbook
+
+APP_PATH = os.path.join(ROOT, "app.py")
+
+CICLI = [
+    "Ciclo 1 (Gen-Feb-Mar)",
+    "Ciclo 2 (Apr-Mag-Giu)",
+    "Ciclo 3 (Lug-Ago-Set)",
+    "Ciclo 4 (Ott-Nov-Dic)",
+    "Tutti",
+]
+RICERCHE = ["m", "mi", "mil", "mila", "milano", ""]
+# il comando passa dal microfono finto a coda, trascrizione e parser (server OpenAI finto):
+# frasi ripetute tra sessioni finiscono in un'unica interpretazione
+VOICE_COMMANDS = [
+    "chi riceve domattina",
+    "solo MMG oggi pomeriggio",
+    "dalle 15 alle 17",
+    "azzera tutto",
+]
+
+
+VOICE_POLL_S = 0.1
+
+
+# ---------- RUNTIME CONDIVISO ---------------------------------------------------
+def install_shared_runtime():
+    # AppTest crea e poi azzera il Runtime globale a ogni run: con più sessioni in
+    # parallelo una cancellerebbe quello delle altre. Come nel server vero, ne usiamo uno,
+    # insieme a un'unica ScriptCache (app.py compilato una volta sola).
+    shared = MagicMock(spec=Runtime)
+    shared.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = shared
+    app_test.Runtime = types.SimpleNamespace(_instance=None)
+
+    script_cache = ScriptCache()
+    script_cache.get_bytecode(APP_PATH)
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+
+    # AppTest attiva global.appTest solo per la durata del run e poi ripristina il valore
+    # precedente: una sessione che finisce lo spegnerebbe a quelle ancora in corso
+    config.set_option("global.appTest", True)
+
+
+# ---------- MICROFONO FINTO -----------------------------------------------------
+MIC_AUDIO_KEY = "loadtest_mic_audio"
+
+
+def install_fake_mic_recorder():
+    # il componente vero registra nel browser: qui restituisce una sola volta (come just_once)
+    # i byte che la sessione simulata ha "registrato", con lo stesso formato di risposta
+    import streamlit as st
+    import streamlit_mic_recorder
+
+    def fake_mic_recorder(*args, **kwargs):
+        audio = st.session_state.pop(MIC_AUDIO_KEY, None)
+        if audio is None:
+            return None
+        return {"bytes": audio, "sample_rate": 16000, "sample_width": 2, "id": time.time_ns()}
+
+    streamlit_mic_recorder.mic_recorder = fake_mic_recorder
+
+
+# ---------- SESSIONE SIMULATA ---------------------------------------------------
+def _find_slider(at: AppTest, label: str):
+    for s in at.slider:
+        if s.label == label:
+            return s
+    return None
+
+
+def scripted_steps(session_idx: int):
+    # sequenza tipica di un informatore: upload, cambio ciclo, slider, ricerca, comando vocale
+    steps = [("upload", None)]
+    for k in range(2):
+        steps.append(("ciclo", CICLI[(session_idx + k) % len(CICLI)]))
+    steps.append(("fascia", "Personalizzato"))
+    for h in (9, 10, 15):
+        steps.append(("slider", (datetime.time(h, 0), datetime.time(h + 2, 0))))
+    for text in RICERCHE:
+        steps.append(("ricerca", text))
+    steps.append(("voce", VOICE_COMMANDS[session_idx % len(VOICE_COMMANDS)].encode("utf-8")))
+    return steps
+
+
+def apply_step(at: AppTest, kind: str, value, workbook: bytes):
+    if kind == "upload":
+        at.session_state["uploaded_file_bytes"] = workbook
+    elif kind == "ciclo":
+        at.selectbox(key="ciclo_scelto").set_value(value)
+    elif kind == "fascia":
+        at.radio(key="fascia_oraria").set_value(value)
+    elif kind == "slider":
+        slider = _find_slider(at, "Seleziona l'intervallo orario")
+        if slider is not None:
+            today = datetime.date.today()
+            slider.set_value(tuple(datetime.datetime.combine(today, t) for t in value))
+    elif kind == "ricerca":
+        at.text_input(key="search_query").set_value(value)
+    elif kind == "voce":
+        at.session_state[MIC_AUDIO_KEY] = value
+
+
+def run_session(session_idx: int, workbook: bytes, rounds: int, timeout: float, stop_at: float) -> dict:
+    latencies, errors = [], []
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+    for _ in range(rounds):
+        for kind, value in scripted_steps(session_idx):
+            if time.monotonic() > stop_at:
+                return {"latencies": latencies, "errors": errors}
+            try:
+                apply_step(at, kind, value, workbook)
+                t0 = time.perf_counter()
+                at.run()
+                # nel browser il frammento di attesa si riesegue da solo: qui si rilancia la pagina
+                while kind == "voce" and "voice_job_id" in at.session_state and not at.exception:
+                    if time.perf_counter() - t0 > timeout:
+                        raise TimeoutError("comando vocale senza esito")
+                    time.sleep(VOICE_POLL_S)
+                    at.run()
+                latencies.append((kind, time.perf_counter() - t0))
+                if at.exception:
+                    errors.append(f"{kind}: {at.exception[0].message}")
+                elif kind == "voce" and str(at.session_state["voice_feedback"]).startswith("Errore"):
+                    errors.append(f"{kind}: {at.session_state['voice_feedback']}")
+            except Exception as e:
+                errors.append(f"{kind}: {e!r}")
+                if kind == "upload":
+                    return {"latencies": latencies, "errors": errors}
+
+    return {"latencies": latencies, "errors": errors}
+
+
+# ---------- MONITOR MEMORIA -----------------------------------------------------
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_mb = _current_rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, _current_rss_mb())
+
+    def stop(self) -> float:
+        self._stop_event.set()
+        self.join()
+        # ru_maxrss è in KB su Linux
+        return max(self.peak_mb, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+# ---------- REPORT --------------------------------------------------------------
+def _percentiles(values: list[float]) -> str:
+    if not values:
+        return "n/d"
+    arr = np.array(values) * 1000
+    return f"p50 {np.percentile(arr, 50):7.1f} ms · p95 {np.percentile(arr, 95):7.1f} ms · max {arr.max():7.1f} ms"
+
+
+def print_report(results: list[dict], elapsed: float, peak_rss_mb: float, baseline_rss_mb: float):
+    all_lat = [lat for r in results for _, lat in r["latencies"]]
+    errors = [e for r in results for e in r["errors"]]
+
+    print(f"\nSessioni: {len(results)} · rerun: {len(all_lat)} · durata: {elapsed:.1f} s "
+          f"· throughput: {len(all_lat) / elapsed if elapsed else 0:.1f} rerun/s")
+    print(f"Totale      {_percentiles(all_lat)}")
+    for kind in ["upload", "ciclo", "fascia", "slider", "ricerca", "voce"]:
+        lat = [l for r in results for k, l in r["latencies"] if k == kind]
+        if lat:
+            print(f"{kind:<11} {_percentiles(lat)}  (n={len(lat)})")
+    print(f"RSS: iniziale {baseline_rss_mb:.0f} MB · picco {peak_rss_mb:.0f} MB")
+
+    if errors:
+        print(f"\nErrori: {len(errors)}")
+        for e in errors[:10]:
+            print(f"  - {e}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Test di carico di app.py con sessioni AppTest concorrenti.")
+    parser.add_argument("--sessions", type=int, default=30)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--workbook", help="file Excel da usare al posto di quello sintetico")
+    parser.add_argument("--timeout", type=float, default=120.0, help="timeout per singolo rerun (s)")
+    parser.add_argument("--max-seconds", type=float, default=600.0)
+    parser.add_argument("--fake-delay", type=float, default=0.5, help="latenza del server finto per richiesta (s)")
+    args = parser.parse_args()
+
+    _, fake_stats, base_url = start_fake_server(delay=args.fake_delay)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "finta"
+
+    if args.workbook:
+        with open(args.workbook, "rb") as f:
+            workbook = f.read()
+    else:
+        workbook = build_workbook(args.rows)
+
+    install_shared_runtime()
+    install_fake_mic_recorder()
+
+    sampler = RssSampler()
+    baseline_rss = sampler.peak_mb
+    sampler.start()
+
+    t0 = time.perf_counter()
+    stop_at = time.monotonic() + args.max_seconds
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        futures = [
+            pool.submit(run_session, i, workbook, args.rounds, args.timeout, stop_at)
+            for i in range(args.sessions)
+        ]
+        results = []
+        for fut in futures:
+            try:
+                results.append(fut.result())
+            except Exception:
+                results.append({"latencies": [], "errors": [traceback.format_exc(limit=1)]})
+    elapsed = time.perf_counter() - t0
+
+    print_report(results, elapsed, sampler.stop(), baseline_rss)
+    voice_steps = sum(1 for r in results for k, _ in r["latencies"] if k == "voce")
+    print(f"Server finto: {fake_stats['transcriptions']} trascrizioni · "
+          f"{fake_stats['completions']} interpretazioni per {voice_steps} comandi vocali")
+    return 1 if any(r["errors"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
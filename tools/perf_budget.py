@@ -0,0 +1,216 @@
+import argparse
+import ast
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+from typing import Optional
+
+import numpy as np
+
+from streamlit.testing.v1 import AppTest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_workbook import build_dataframe, build_workbook
+
+APP_PATH = os.path.join(ROOT, "app.py")
+HOT_PATH_FILES = [APP_PATH, os.path.join(ROOT, "ingest.py")]
+
+BENCH_ROWS = 50_000
+RERUN_ROWS = 5_000
+
+# budget in ms (tempo mediano) o MB (picco tracemalloc): circa 3x la mediana di 5 esecuzioni
+# sulla macchina di riferimento (1 vCPU Xeon, Python 3.11). Su macchine più lente usare --scale
+BUDGETS = {
+    "filtra_giorno_fascia Personalizzato": 17,
+    "filtra_giorno_fascia Mattina": 11,
+    "build_territory_coverage microarea": 550,
+    "build_territory_coverage provincia": 550,
+    "run_filter_pipeline default": 520,
+    "facet_counts": 85,
+    "prepare_dataset": 3500,
+    "rerun upload (MB)": 65,
+    "rerun cambio ciclo (MB)": 90,
+}
+
+
+# ---------- CARICAMENTO FUNZIONI DI APP.PY --------------------------------------
+def _uses_streamlit(node: ast.AST) -> bool:
+    return any(isinstance(n, ast.Name) and n.id == "st" for n in ast.walk(node))
+
+
+def load_app_namespace(skipped: Optional[list] = None) -> dict:
+    # app.py è uno script Streamlit: ne eseguiamo solo import, costanti e definizioni.
+    # Le assegnazioni che dipendono dallo stato della pagina (dataset, filtri scelti...)
+    # falliscono con NameError e si saltano, elencate in skipped; ogni altro errore si propaga
+    with open(APP_PATH, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), APP_PATH)
+
+    ns = {"__name__": "app_perf", "__file__": APP_PATH}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+            exec(compile(ast.Module([node], []), APP_PATH, "exec"), ns)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)) and not _uses_streamlit(node):
+            try:
+                exec(compile(ast.Module([node], []), APP_PATH, "exec"), ns)
+            except NameError as e:
+                if skipped is not None:
+                    targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                    skipped.append(f"app.py:{node.lineno} {', '.join(ast.unparse(t) for t in targets)} ({e})")
+    return ns
+
+
+# ---------- CONTROLLO APPLY RIGA PER RIGA ---------------------------------------
+def find_rowwise_apply(paths: list[str]) -> list[str]:
+    found = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)):
+                continue
+            name = node.func.attr
+            if name in ("iterrows", "itertuples"):
+                found.append(f"{os.path.basename(path)}:{node.lineno} {name}()")
+            elif name == "apply":
+                for kw in node.keywords:
+                    if kw.arg == "axis" and isinstance(kw.value, ast.Constant) and kw.value.value in (1, "columns"):
+                        found.append(f"{os.path.basename(path)}:{node.lineno} apply(axis={kw.value.value!r})")
+    return found
+
+
+# ---------- MISURE --------------------------------------------------------------
+def median_ms(fn, repeat: int, warmup: bool = True) -> float:
+    if warmup:
+        fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def bench_functions(ns: dict, repeat: int) -> dict:
+    df_raw = build_dataframe(BENCH_ROWS, seed=1)
+
+    # la prima preparazione serve anche da riscaldamento per la mediana
+    dataset = ns["prepare_dataset"](df_raw, "perf-budget")
+    results = {
+        "prepare_dataset": median_ms(lambda: ns["prepare_dataset"](df_raw, "perf-budget"), repeat, warmup=False),
+    }
+
+    df = dataset["df"]
+    cycle_cols = ns["cycle_visit_cols"]("Ciclo 1 (Gen-Feb-Mar)", df.columns)
+    seen = ns["visit_seen_mask"](dataset["visit"], cycle_cols)
+
+    results["filtra_giorno_fascia Personalizzato"] = median_ms(
+        lambda: ns["filtra_giorno_fascia"](
+            dataset, "sempre", "Personalizzato", datetime.time(9, 30), datetime.time(11, 0)
+        ),
+        repeat,
+    )
+    results["filtra_giorno_fascia Mattina"] = median_ms(
+        lambda: ns["filtra_giorno_fascia"](dataset, "martedì", "Mattina", None, None),
+        repeat,
+    )
+    for col in ["microarea", "provincia"]:
+        results[f"build_territory_coverage {col}"] = median_ms(
+            lambda col=col: ns["build_territory_coverage"](
+                df, col, cycle_cols, seen_rows=seen, phys_id=dataset["phys_id"]
+            ),
+            repeat,
+        )
+
+    state = {
+        "ciclo_scelto": "Ciclo 1 (Gen-Feb-Mar)",
+        "filtro_ultima_visita": "Nessuno",
+        "filtro_spec": ["MMG"],
+        "filtro_target": "In target",
+        "filtro_visto": "Non Visto",
+        "giorno_scelto": "sempre",
+        "fascia_oraria": "Mattina",
+        "custom_start": None,
+        "custom_end": None,
+        "microarea_scelta": [],
+        "provincia_scelta": "Ovunque",
+        "prov_escludi": [],
+        "mese_limite_visita": "Nessuno",
+        "search_query": "",
+    }
+    results["run_filter_pipeline default"] = median_ms(lambda: ns["run_filter_pipeline"](dataset, state), repeat)
+
+    masks, _ = ns["build_filter_masks"](dataset, state)
+    results["facet_counts"] = median_ms(lambda: ns["facet_counts"](dataset, masks), repeat)
+    return results
+
+
+def bench_rerun_memory() -> dict:
+    at = AppTest.from_file(APP_PATH, default_timeout=300)
+    at.session_state["uploaded_file_bytes"] = build_workbook(RERUN_ROWS, seed=2)
+
+    tracemalloc.start()
+    at.run()
+    _, peak_upload = tracemalloc.get_traced_memory()
+
+    tracemalloc.reset_peak()
+    at.selectbox(key="ciclo_scelto").set_value("Tutti")
+    at.run()
+    _, peak_cycle = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if at.exception:
+        raise RuntimeError(f"app.py ha sollevato un'eccezione: {at.exception[0].message}")
+
+    return {
+        "rerun upload (MB)": peak_upload / 1024 / 1024,
+        "rerun cambio ciclo (MB)": peak_cycle / 1024 / 1024,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Verifica i budget di tempo e memoria dei punti caldi di app.py.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="moltiplica tutti i budget (macchine più lente)")
+    parser.add_argument("--skip-rerun", action="store_true", help="salta la misura di memoria del rerun completo")
+    args = parser.parse_args()
+
+    failures = []
+
+    rowwise = find_rowwise_apply(HOT_PATH_FILES)
+    for item in rowwise:
+        failures.append(f"operazione riga per riga sul percorso caldo: {item}")
+
+    skipped = []
+    results = bench_functions(load_app_namespace(skipped), args.repeat)
+    print(f"Saltate {len(skipped)} assegnazioni che dipendono dalla pagina:")
+    for item in skipped:
+        print(f"  - {item}")
+    print()
+    if not args.skip_rerun:
+        results.update(bench_rerun_memory())
+
+    print(f"{'misura':<40} {'valore':>10} {'budget':>10}")
+    for name, value in results.items():
+        budget = BUDGETS[name] * args.scale
+        ok = value <= budget
+        print(f"{name:<40} {value:10.1f} {budget:10.1f}  {'ok' if ok else 'FUORI BUDGET'}")
+        if not ok:
+            failures.append(f"{name}: {value:.1f} > {budget:.1f}")
+
+    if failures:
+        print("\nFALLITO:")
+        for f in failures:
+            print(f"  - {f}")
+        return 1
+
+    print("\nTutti i budget rispettati.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import argparse
+import io
+import os
+import random
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import mesi
+
+GIORNI = ["lunedì", "martedì", "mercoledì", "giovedì", "venerdì"]
+MICROAREE = ["FM01", "FM02", "FM02 (Nord)", "MC03", "MC04", "SBT01", "AP04 (Centro)", "MTPR02", "TER05"]
+PROVINCE = ["MI", "MB", "CO", "LC", "VA"]
+CITTA = ["Milano", "Monza", "Como", "Lecco", "Varese", "Sesto San Giovanni", "Rho", "Cantù"]
+SPEC = ["MMG"] * 6 + ["ORT", "FIS", "REU", "DER", "END"]
+NOMI = ["Mario", "Anna", "Luca", "Giulia", "Paolo", "Chiara", "Marco", "Elena", "Andrea", "Sara"]
+COGNOMI = ["Rossi", "Bianchi", "Verdi", "Russo", "Ferrari", "Esposito", "Romano", "Colombo", "Ricci", "Marino"]
+MATTINA = [None, None, "9-12", "8:30-11", "10:00 - 12:30", "9-11 / 11:30-12"]
+POMERIGGIO = [None, None, "15-18", "14:30-17", "16-19", "15-16 / 17-18:30"]
+
+
+def build_dataframe(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        row = {
+            "nome medico": f"{rnd.choice(['Dott. ', 'Dr.ssa ', ''])}{rnd.choice(COGNOMI)}{i} {rnd.choice(NOMI)}",
+            "città": rnd.choice(CITTA),
+            "indirizzo ambulatorio": f"Via {rnd.choice(COGNOMI)} {i % 97 + 1}",
+            "microarea": rnd.choice(MICROAREE),
+            "provincia": rnd.choice(PROVINCE),
+            "spec": rnd.choice(SPEC),
+            "in target": rnd.choice(["x", "x", ""]),
+        }
+        for m in mesi:
+            row[m] = rnd.choice(["", "", "", "x", "v"])
+        for g in GIORNI:
+            row[f"{g} mattina"] = rnd.choice(MATTINA)
+            row[f"{g} pomeriggio"] = rnd.choice(POMERIGGIO)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def build_workbook(n_rows: int, seed: int = 0) -> bytes:
+    bio = io.BytesIO()
+    with pd.ExcelWriter(bio) as writer:
+        build_dataframe(n_rows, seed).to_excel(writer, sheet_name="MMG", index=False)
+    return bio.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera un file Excel MMG sintetico.")
+    parser.add_argument("output")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.output, "wb") as f:
+        f.write(build_workbook(args.rows, args.seed))
+    print(f"Scritto {args.output} ({args.rows} righe)")
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+import perf_budget
+
+# stessi budget di perf_budget.py, uno per test: python -m pytest tools/test_perf_budget.py
+# PERF_BUDGET_SCALE e PERF_BUDGET_REPEAT fanno quello che fanno --scale e --repeat
+SCALE = float(os.getenv("PERF_BUDGET_SCALE", "1"))
+REPEAT = int(os.getenv("PERF_BUDGET_REPEAT", "5"))
+
+RERUN_BUDGETS = ["rerun upload (MB)", "rerun cambio ciclo (MB)"]
+FUNCTION_BUDGETS = [name for name in perf_budget.BUDGETS if name not in RERUN_BUDGETS]
+
+
+@pytest.fixture(scope="module")
+def function_results():
+    return perf_budget.bench_functions(perf_budget.load_app_namespace(), REPEAT)
+
+
+@pytest.fixture(scope="module")
+def rerun_results():
+    return perf_budget.bench_rerun_memory()
+
+
+def _check(results: dict, name: str):
+    budget = perf_budget.BUDGETS[name] * SCALE
+    assert results[name] <= budget, f"{name}: {results[name]:.1f} > {budget:.1f}"
+
+
+def test_no_rowwise_apply():
+    assert perf_budget.find_rowwise_apply(perf_budget.HOT_PATH_FILES) == []
+
+
+@pytest.mark.parametrize("name", FUNCTION_BUDGETS)
+def test_function_budget(function_results, name):
+    _check(function_results, name)
+
+
+@pytest.mark.parametrize("name", RERUN_BUDGETS)
+def test_rerun_budget(rerun_results, name):
+    _check(rerun_results, name)